@@ -1,12 +1,19 @@
 import os
-from boxdetect import config
-from boxdetect.pipelines import get_boxes
-import cv2
-import numpy as np
 import argparse
+import base64
+import contextlib
+import gc
+import hashlib
+import importlib
 import json
 import logging
+import math
+import queue
+import re
+import shutil
 import sys
+import threading
+import time
 
 logging.basicConfig(
     level=logging.ERROR,
@@ -15,46 +22,600 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# CLI arguments for input/output and IDs
 script_dir = os.path.dirname(os.path.abspath(__file__))
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "-i", "--input", dest="input", required=True, help="input image path"
-)
-parser.add_argument(
-    "-o", "--output", dest="output_dir", required=True, help="output directory"
-)
-parser.add_argument("-t", "--test", dest="test_id", required=True, help="test ID")
-parser.add_argument(
-    "-s", "--student", dest="student_id", required=True, help="student ID"
-)
-parser.add_argument("-n", dest="n", type=int, default=0, help="check first n boxes")
-args = parser.parse_args()
 
-input_file = args.input
-output_dir = args.output_dir
-test_id = args.test_id
-student_id = args.student_id
-check_n = args.n
+# Heavy modules are imported on first use, so argument and input errors fail
+# before any of them loads and sheets the contour engine handles never pay for
+# boxdetect (which pulls in scikit-learn). Import time is reported under the
+# "import" stage of the sheet that triggered it.
+IMPORT_MS = 0.0
+
+
+def load_module(name):
+    """Import `name` once per process, adding the time it took to IMPORT_MS."""
+    global IMPORT_MS
+    module = sys.modules.get(name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        IMPORT_MS += (time.perf_counter() - started) * 1000.0
+    return module
+
+
+class LazyModule:
+    """Placeholder global; the first attribute lookup imports the module and rebinds the global."""
+
+    def __init__(self, alias, name):
+        self._alias = alias
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = load_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+cv2 = LazyModule("cv2", "cv2")
+np = LazyModule("np", "numpy")
+
+# 0: errors only, 1: one-line progress diagnostics, 2: also per-candidate and
+# per-question detail. Diagnostics go to stdout in the plain CLI and to stderr
+# whenever stdout carries results (--json, --worker, --batch).
+VERBOSITY = 2
+
+
+def diag(message, level=1, file=None, flush=False):
+    if VERBOSITY >= level:
+        print(message, file=file, flush=flush)
+
+
+class GradingError(Exception):
+    """Raised when a sheet cannot be graded (no boxes, no output image, ...)."""
+
+
+class StageTimer:
+    """
+    Wall-clock milliseconds per grading stage plus every detection candidate.
+    Stages are exclusive: time spent in a nested stage or in module imports
+    is not counted again in the enclosing stage, so they add up to at most
+    total_ms.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.imported_ms = IMPORT_MS
+        self.stages = {}
+        self.candidates = []
+        # Per open stage: [ms spent in nested stages, import ms within those]
+        self.open = []
+
+    def _add(self, name, own_ms, span_ms, imported_ms):
+        # The enclosing stage excludes the whole span, imports included
+        if self.open:
+            self.open[-1][0] += span_ms
+            self.open[-1][1] += imported_ms
+        self.stages[name] = self.stages.get(name, 0.0) + own_ms
+
+    def record(self, name, seconds):
+        self._add(name, seconds * 1000.0, seconds * 1000.0, 0.0)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started, imported = time.perf_counter(), IMPORT_MS
+        self.open.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            nested_ms, nested_imports = self.open.pop()
+            span_ms = (time.perf_counter() - started) * 1000.0
+            imported = IMPORT_MS - imported
+            own_ms = span_ms - nested_ms - (imported - nested_imports)
+            self._add(name, max(0.0, own_ms), span_ms, imported)
+
+    def add_candidate(self, variant, preset, count, rank, seconds):
+        self.candidates.append(
+            {
+                "variant": variant,
+                "preset": preset,
+                "rectangles": count,
+                "rank": list(rank),
+                "ms": round(seconds * 1000.0, 2),
+            }
+        )
+
+    def as_dict(self, **selected):
+        # Module imports paid while grading this sheet, wherever they happened
+        imported = IMPORT_MS - self.imported_ms
+        if imported > 0:
+            self.stages["import"] = imported
+        return {
+            **selected,
+            "stages_ms": {k: round(v, 2) for k, v in self.stages.items()},
+            "candidates": self.candidates,
+            "total_ms": round((time.perf_counter() - self.started) * 1000.0, 2),
+        }
+
+
+def build_parser():
+    """CLI arguments for input/output and IDs"""
+    from job_queue import QUEUE_LEASE_S, QUEUE_MAX_ATTEMPTS
+    from service import SERVE_QUEUE_SIZE
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        help="input image path, or - to read the encoded image from stdin",
+    )
+    parser.add_argument("-o", "--output", dest="output_dir", help="output directory")
+    parser.add_argument("-t", "--test", dest="test_id", help="test ID")
+    parser.add_argument("-s", "--student", dest="student_id", help="student ID")
+    parser.add_argument("-n", dest="n", type=int, default=0, help="check first n boxes")
+    parser.add_argument(
+        "--shm",
+        dest="shm",
+        help="grade raw uint8 pixels from this POSIX shared-memory segment "
+        "(instead of -i; needs --shape)",
+    )
+    parser.add_argument(
+        "--shape",
+        dest="shape",
+        help="--shm pixel layout: HxW (gray), HxWx3 (BGR) or HxWx4 (BGRA)",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="stay alive and grade JSON-line jobs read from stdin",
+    )
+    parser.add_argument(
+        "--batch",
+        dest="batch",
+        help="grade a manifest (.json/.jsonl) or a directory of sheets in parallel",
+    )
+    parser.add_argument(
+        "--stack",
+        dest="stack",
+        help="grade every page of a multi-page scanned PDF or TIFF (needs -t, -o)",
+    )
+    parser.add_argument(
+        "--students",
+        dest="students",
+        help="stack page -> student mapping, inline or a .json file: JSON list in "
+        'page order or {"page": "student_id"} (default: student ID = page number)',
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=0,
+        help="batch worker processes (default: CPUs allowed by the container quota)",
+    )
+    parser.add_argument(
+        "--max-rss-mb",
+        dest="max_rss_mb",
+        type=float,
+        default=0,
+        help="batch memory budget: start no new sheet while the batch's processes "
+        "use more than this (default: unlimited)",
+    )
+    parser.add_argument(
+        "--serve",
+        dest="serve",
+        metavar="[HOST:]PORT",
+        help="serve grading over HTTP with a warm pool of -j worker processes "
+        "(default host: 127.0.0.1)",
+    )
+    parser.add_argument(
+        "--queue-size",
+        dest="queue_size",
+        type=int,
+        default=SERVE_QUEUE_SIZE,
+        help="--serve: queued sheets accepted before submissions get 429",
+    )
+    parser.add_argument(
+        "--queue",
+        dest="queue",
+        metavar="DB",
+        help="durable SQLite job queue for --enqueue, --drain and --status",
+    )
+    parser.add_argument(
+        "--enqueue",
+        dest="enqueue",
+        metavar="SOURCE",
+        help="--queue: add the sheets of a manifest or directory (like --batch); "
+        "sheets already queued for the batch are skipped",
+    )
+    parser.add_argument(
+        "--drain",
+        dest="drain",
+        action="store_true",
+        help="--queue: grade queued jobs with -j worker processes until none are "
+        "left; any number of drains can share one queue",
+    )
+    parser.add_argument(
+        "--follow",
+        dest="follow",
+        action="store_true",
+        help="with --drain: keep waiting for new jobs instead of exiting",
+    )
+    parser.add_argument(
+        "--status",
+        dest="status",
+        action="store_true",
+        help="--queue: print job counts per batch, or every job of --batch-id",
+    )
+    parser.add_argument(
+        "--batch-id",
+        dest="batch_id",
+        help="--queue: batch name for --enqueue (default: the source path) "
+        "and --status",
+    )
+    parser.add_argument(
+        "--lease",
+        dest="lease",
+        type=float,
+        default=QUEUE_LEASE_S,
+        help="--drain: seconds a claimed job stays leased without renewal before "
+        "another worker may take it over",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        dest="max_attempts",
+        type=int,
+        default=QUEUE_MAX_ATTEMPTS,
+        help="--drain: attempts per job before it is marked failed",
+    )
+    parser.add_argument(
+        "--rescore",
+        dest="rescore",
+        help="reapply the marking strategies to stored *.features.npz (a file or "
+        "a directory tree) without reading any image; answers go to -o if given",
+    )
+    parser.add_argument(
+        "--factors",
+        dest="factors",
+        help="with --rescore: JSON object or .json file overriding decision "
+        f"factors ({', '.join(DECISION_FACTORS)})",
+    )
+    parser.add_argument(
+        "--early-exit-penalty",
+        dest="early_exit_penalty",
+        type=float,
+        default=EARLY_EXIT_PENALTY,
+        help="stop the preset search at the expected box count with a size penalty under this "
+        "bound (0 runs every preset)",
+    )
+    parser.add_argument(
+        "--detect-threads",
+        dest="detect_threads",
+        type=int,
+        default=0,
+        help="evaluate detection variant/preset passes on this many threads "
+        "(interactive regrades; keep 0 with --batch)",
+    )
+    parser.add_argument(
+        "--layout-cache",
+        dest="layout_dir",
+        help="directory of per-test layout templates; later sheets of a test are "
+        "registered against the first fully detected one",
+    )
+    parser.add_argument(
+        "--canonical-width",
+        dest="canonical_width",
+        type=int,
+        default=0,
+        help=f"grade large scans/photos at this page width in px (e.g. "
+        f"{CANONICAL_SHEET_WIDTH}); JPEGs are decoded at reduced resolution",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="reuse results for byte-identical scans graded with the same settings",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        dest="cache_max_mb",
+        type=float,
+        default=CACHE_MAX_MB,
+        help="result cache size bound; least recently used entries are evicted",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="ignore cached results (fresh results still refresh the cache)",
+    )
+    parser.add_argument(
+        "--sheet-spec",
+        dest="sheet_spec",
+        default=DEFAULT_SHEET_SPEC,
+        help="sheet layout spec: a name in sheet_specs/ or a .json path",
+    )
+    parser.add_argument(
+        "--no-grid-crop",
+        dest="no_grid_crop",
+        action="store_true",
+        help="run the box search on the whole page instead of the located answer grid",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=DETECT_ENGINES,
+        default="boxdetect",
+        help="box detector: boxdetect presets, or the contour engine with "
+        "boxdetect as fallback (default: boxdetect)",
+    )
+    parser.add_argument(
+        "--min-confidence",
+        dest="min_confidence",
+        type=float,
+        default=0.0,
+        help="tiered grading: recheck answers below this confidence (0..1) with "
+        "the slower variants and list the rest for review (default: off)",
+    )
+    parser.add_argument(
+        "--no-normalize",
+        dest="no_normalize",
+        action="store_true",
+        help="skip the orientation, deskew and perspective correction",
+    )
+    parser.add_argument(
+        "--no-render",
+        dest="no_render",
+        action="store_true",
+        help="skip the annotated image; geometry is still saved for --render",
+    )
+    parser.add_argument(
+        "--render",
+        dest="render_geometry",
+        help="draw the annotated image for a saved {test}-{student}.geometry.json "
+        "(into -o, default: next to the geometry file)",
+    )
+    parser.add_argument(
+        "--inline-image",
+        dest="inline_image",
+        action="store_true",
+        help="return the annotated image base64-encoded as image_b64 in the JSON "
+        "result instead of writing it (--json, --worker, --batch, --stack)",
+    )
+    parser.add_argument(
+        "--image-format",
+        dest="image_format",
+        choices=sorted(IMAGE_FORMATS),
+        default="jpg",
+        help="annotated image format",
+    )
+    parser.add_argument(
+        "--image-quality",
+        dest="image_quality",
+        type=int,
+        help="encoder quality 1-100 (default: 95 for jpg, 80 for webp)",
+    )
+    parser.add_argument(
+        "--preview-width",
+        dest="preview_width",
+        type=int,
+        default=0,
+        help="downscale the annotated image to at most this width in px",
+    )
+    parser.add_argument(
+        "--json",
+        dest="json_output",
+        action="store_true",
+        help="print the result as one JSON document on stdout; diagnostics go "
+        "to stderr",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbosity",
+        dest="verbosity",
+        type=int,
+        choices=(0, 1, 2),
+        help="0 errors only, 1 progress, 2 per-candidate and per-question detail "
+        "(default: 2 for the plain CLI, 1 with --json/--worker/--batch)",
+    )
+    return parser
+
+
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.factors and not args.rescore:
+        parser.error("--factors only applies to --rescore")
+    if args.shm and not args.shape:
+        parser.error("--shm requires --shape")
+    queue_actions = args.enqueue or args.drain or args.status
+    if queue_actions and not args.queue:
+        parser.error("--enqueue, --drain and --status need --queue DB")
+    if args.queue and not queue_actions:
+        parser.error("--queue needs --enqueue, --drain or --status")
+    if args.follow and not args.drain:
+        parser.error("--follow only applies to --drain")
+    if args.inline_image and not (
+        args.json_output
+        or args.worker
+        or args.batch
+        or args.stack
+        or args.serve
+        or args.queue
+    ):
+        parser.error(
+            "--inline-image needs a JSON result: --json, --worker, --batch, --stack, "
+            "--serve or --queue"
+        )
+    if args.stack:
+        missing = [
+            flag
+            for flag, value in (
+                ("-o/--output", args.output_dir),
+                ("-t/--test", args.test_id),
+            )
+            if not value
+        ]
+        if missing:
+            parser.error(f"--stack requires: {', '.join(missing)}")
+    elif not (
+        args.worker
+        or args.batch
+        or args.render_geometry
+        or args.rescore
+        or args.serve
+        or args.queue
+    ):
+        missing = [
+            flag
+            for flag, value in (
+                ("-i/--input", args.input or args.shm),
+                ("-o/--output", args.output_dir),
+                ("-t/--test", args.test_id),
+                ("-s/--student", args.student_id),
+            )
+            if not value
+        ]
+        if missing:
+            parser.error(f"the following arguments are required: {', '.join(missing)}")
+    return args
+
+
+def grading_options(args):
+    """grade_sheet() keyword arguments derived from the CLI flags."""
+    return {
+        "early_exit_penalty": args.early_exit_penalty,
+        "detect_threads": args.detect_threads,
+        "layout_dir": args.layout_dir,
+        "canonical_width": args.canonical_width,
+        "cache_dir": args.cache_dir,
+        "cache_max_mb": args.cache_max_mb,
+        "refresh_cache": args.no_cache,
+        "render": not args.no_render,
+        "image_format": args.image_format,
+        "image_quality": args.image_quality,
+        "preview_width": args.preview_width,
+        "sheet_spec": args.sheet_spec,
+        "grid_crop": not args.no_grid_crop,
+        "normalize": not args.no_normalize,
+        "engine": args.engine,
+        "min_confidence": args.min_confidence,
+        "inline_image": args.inline_image,
+    }
+
+
+def dump_result(response):
+    """One compact JSON line: the only thing machine modes write to stdout."""
+    return json.dumps(response, separators=(",", ":")) + "\n"
+
+
+def prepare_outputs(input_file, output_dir, test_id, student_id, image_format="jpg"):
+    """Create the output directory and remove stale results for this sheet."""
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Output filenames based on IDs
+    output_file = os.path.join(output_dir, f"{test_id}-{student_id}.{image_format}")
+    output_json = os.path.join(output_dir, f"{test_id}-{student_id}.json")
+
+    input_abs = os.path.abspath(input_file)
+    for output_path in [
+        output_file,
+        output_json,
+        timings_path(output_json),
+        geometry_path(output_json),
+        features_path(output_json),
+    ]:
+        output_abs = os.path.abspath(output_path)
+        if output_abs == input_abs:
+            diag(f"[GRADING] skipping deletion because input==output: {output_path}")
+            continue
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    return output_file, output_json
+
+
+def timings_path(output_json):
+    """Per-stage timings sit next to the answers JSON, which stays a plain map."""
+    return os.path.splitext(output_json)[0] + ".timings.json"
+
+
+def geometry_path(output_json):
+    """Box/circle geometry needed to render the annotated image later."""
+    return os.path.splitext(output_json)[0] + ".geometry.json"
+
+
+def features_path(output_json):
+    """Per-bubble darkness features, enough to rescore without the image."""
+    return os.path.splitext(output_json)[0] + FEATURES_SUFFIX
+
 
-# Ensure output directory exists
-os.makedirs(output_dir, exist_ok=True)
+# Sheet layout specs: question numbering, column positions and bubble offsets
+# of a printed answer sheet, described in sheet_specs/*.json and loaded once.
+SHEET_SPEC_DIR = os.path.join(script_dir, "sheet_specs")
+DEFAULT_SHEET_SPEC = "standard-55"
 
-# Output filenames based on IDs
-output_file = os.path.join(output_dir, f"{test_id}-{student_id}.jpg")
-output_json = os.path.join(output_dir, f"{test_id}-{student_id}.json")
+_SHEET_SPECS = {}
 
-input_abs = os.path.abspath(input_file)
-for output_path in [output_file, output_json]:
-    output_abs = os.path.abspath(output_path)
-    if output_abs == input_abs:
-        print(f"[GRADING] skipping deletion because input==output: {output_path}")
-        continue
-    if os.path.exists(output_path):
-        os.remove(output_path)
 
+def load_sheet_spec(name=DEFAULT_SHEET_SPEC):
+    """
+    Load a sheet spec by name (`sheet_specs/{name}.json`) or .json path and
+    precompute its lookup tables; cached per process.
+    """
+    if name in _SHEET_SPECS:
+        return _SHEET_SPECS[name]
+
+    path = (
+        name if name.endswith(".json") else os.path.join(SHEET_SPEC_DIR, f"{name}.json")
+    )
+    try:
+        with open(path) as f:
+            spec = json.load(f)
+        column_questions = [
+            list(range(col["first"], col["first"] + col["count"]))
+            for col in spec["columns"]
+        ]
+        shifts = {}
+        for shift in spec["bubbles"].get("shifts", []):
+            for q in range(shift["first"], shift["last"] + 1):
+                shifts[q] = (shift.get("dx", 0), shift.get("dy", 0))
+        options = list(spec["options"])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise GradingError(f"Invalid sheet spec {name}: {str(e)}")
+
+    spec.update(
+        column_questions=column_questions,
+        question_column={q: c for c, qs in enumerate(column_questions) for q in qs},
+        total=sum(len(qs) for qs in column_questions),
+        letters=dict(enumerate(options)),
+        letter_index={letter: i for i, letter in enumerate(options)},
+        bubble_shifts=shifts,
+    )
+    _SHEET_SPECS[name] = spec
+    return spec
+
+
+def spec_columns(spec, n=0):
+    """Indices of the columns holding questions 1..n (every column for n <= 0)."""
+    if n <= 0 or n >= spec["total"]:
+        return list(range(len(spec["columns"])))
+    return sorted(
+        {
+            spec["question_column"][q]
+            for q in range(1, n + 1)
+            if q in spec["question_column"]
+        }
+    )
 
-def cluster_by_column(boxes, n_cols=4):
+
+def column_crop(spec, columns, width):
+    """Page slice (x0, x1) in px covering `columns`; None when all are needed."""
+    if len(columns) == len(spec["columns"]):
+        return None
+    x0 = min(spec["columns"][c]["x_range"][0] for c in columns)
+    x1 = max(spec["columns"][c]["x_range"][1] for c in columns)
+    return max(0, int(x0 * width)), min(width, int(round(x1 * width)))
+
+
+def cluster_by_column(boxes, col_sizes):
     """Cluster boxes into columns based on X position"""
     if not boxes:
         return []
@@ -63,11 +624,10 @@ def cluster_by_column(boxes, n_cols=4):
         boxes, key=lambda b: b[2], reverse=True
     )  # Sort by center X, right to left
 
-    # Expected column sizes
+    # Expected column sizes, unless too many boxes are missing to rely on them
     total = len(boxes_sorted)
-    if total >= 50:
-        col_sizes = [15, 15, 15, 10]
-    else:
+    n_cols = len(col_sizes)
+    if total < sum(col_sizes) - 5:
         base = total // n_cols
         rem = total % n_cols
         col_sizes = [base + (1 if i < rem else 0) for i in range(n_cols)]
@@ -82,8 +642,11 @@ def cluster_by_column(boxes, n_cols=4):
     return columns
 
 
-def infer_missing_boxes(columns, expected_structure):
-    """Infer missing boxes based on spatial relationships and expected structure"""
+def infer_missing_boxes(columns, expected_structure, row_spacing=70):
+    """
+    Infer missing boxes based on spatial relationships and expected structure
+    (column index -> question numbers, top to bottom).
+    """
     all_boxes = {}
 
     for col_idx, column in enumerate(columns):
@@ -94,14 +657,7 @@ def infer_missing_boxes(columns, expected_structure):
         column_sorted = sorted(column, key=lambda b: b[3])
 
         # Expected question numbers for this column
-        if col_idx == 0:
-            expected_nums = list(range(1, 16))
-        elif col_idx == 1:
-            expected_nums = list(range(16, 31))
-        elif col_idx == 2:
-            expected_nums = list(range(31, 46))
-        else:
-            expected_nums = list(range(46, 56))
+        expected_nums = expected_structure.get(col_idx, [])
 
         # Calculate average spacing
         if len(column_sorted) > 1:
@@ -111,7 +667,7 @@ def infer_missing_boxes(columns, expected_structure):
             ]
             avg_spacing = np.median(spacings) if spacings else 0
         else:
-            avg_spacing = 70  # Default spacing
+            avg_spacing = row_spacing  # Default spacing
 
         # Assign detected boxes to question numbers
         for i, box in enumerate(column_sorted):
@@ -166,94 +722,266 @@ def infer_missing_boxes(columns, expected_structure):
     return all_boxes
 
 
-def detect_answer_intensity(src_rgb, circles, threshold_factor=0.92, q_num=None):
+# Circle index -> answer letter (circles run D..A left to right); the default
+# for sheet specs that do not list their own options
+LETTER_MAP = {0: "D", 1: "C", 2: "B", 3: "A"}
+BUBBLE_SAMPLE_R = 10
+# Confidence is the distance to the nearest marking-strategy boundary, with
+# each condition scaled by how far it must move to count as certain
+CONFIDENCE_DIFF_SPAN = 6  # gap between darkest and second darkest
+CONFIDENCE_LEVEL_SPAN = 20  # darkness against the average / absolute limits
+SINGLE_CIRCLE_DARK = 175
+# Marking-strategy thresholds; --rescore can reapply stored features with others
+DECISION_FACTORS = {
+    "threshold_factor": 0.92,  # strong: darkest under this share of the average
+    "strong_gap": 8,
+    "faint_gap": 6,
+    "faint_level": 0.95,  # of the average
+    "faint_mean": 220,
+    "pencil_gap": 5,
+    "pencil_mean": 200,
+    "pencil_ratio": 0.15,  # gap stays under this share of the second darkest
+    "separated_gap": 15,
+    "separated_level": 1.05,  # of the average
+    "single_dark": SINGLE_CIRCLE_DARK,
+}
+
+
+def bubble_darkness(src_gray, circles):
     """
-    Detect marked answer based on intensity with adaptive thresholding.
-    Uses multi-signal approach: mean, percentiles, and separation for robust detection.
-    Returns answer letter or "-" if none detected.
+    Darkness features for a flat list of circles, computed in one pass.
+    Returns float arrays (blended, mean, p25); blended favours darker pixels.
+    Bubbles whose sample window falls outside the image score 255 (blank).
     """
-    if not circles:
-        return "-"
-
-    darkness_vals = []
-    letter_map = {0: "D", 1: "C", 2: "B", 3: "A"}  # Reversed order
+    n = len(circles)
+    blended = np.full(n, 255.0)
+    means = np.full(n, 255.0)
+    p25s = np.full(n, 255.0)
+    if n == 0:
+        return blended, means, p25s
+
+    r = BUBBLE_SAMPLE_R
+    img_h, img_w = src_gray.shape[:2]
+    centers = np.array([(cx, cy) for cx, cy, _ in circles], dtype=np.int64)
+    x0 = np.maximum(0, centers[:, 0] - r)
+    y0 = np.maximum(0, centers[:, 1] - r)
+    x1 = np.minimum(img_w, centers[:, 0] + r)
+    y1 = np.minimum(img_h, centers[:, 1] + r)
+
+    # Full-size windows are gathered into one (k, 2r*2r) stack
+    full = ((x1 - x0) == 2 * r) & ((y1 - y0) == 2 * r)
+    idx = np.nonzero(full)[0]
+    if idx.size:
+        offsets = np.arange(2 * r)
+        ys = y0[idx][:, None] + offsets
+        xs = x0[idx][:, None] + offsets
+        flat = src_gray[ys[:, :, None], xs[:, None, :]].reshape(idx.size, -1)
+        mean = flat.mean(axis=1)
+        p10, p25 = np.percentile(flat, [10, 25], axis=1)
+        blended[idx] = (p10 * 0.3) + (p25 * 0.3) + (mean * 0.4)
+        means[idx] = mean
+        p25s[idx] = p25
+
+    # Windows clipped by the image border have ragged shapes
+    for i in np.nonzero(~full & (x1 > x0) & (y1 > y0))[0]:
+        patch = src_gray[y0[i] : y1[i], x0[i] : x1[i]]
+        mean = float(np.mean(patch))
+        p10, p25 = np.percentile(patch, [10, 25])
+        blended[i] = (p10 * 0.3) + (p25 * 0.3) + (mean * 0.4)
+        means[i] = mean
+        p25s[i] = p25
+
+    return blended, means, p25s
+
+
+def decide_answers(
+    blended, means, threshold_factor=None, letter_map=None, factors=None
+):
+    """
+    Apply the marking strategies to (questions x circles) darkness arrays.
+    Returns (letters, diagnostics) with one entry per question row;
+    diagnostics["confidence"] holds a 0..1 confidence per row.
+    `factors` overrides entries of DECISION_FACTORS.
+    """
+    letter_map = letter_map or LETTER_MAP
+    f = {**DECISION_FACTORS, **(factors or {})}
+    if threshold_factor is not None:
+        f["threshold_factor"] = threshold_factor
+    threshold_factor = f["threshold_factor"]
+    n_q, n_c = blended.shape
+    rows = np.arange(n_q)
+    order = np.argsort(blended, axis=1, kind="stable")
+    darkest_idx = order[:, 0]
+    darkest = blended[rows, darkest_idx]
+
+    if n_c > 1:
+        second = blended[rows, order[:, 1]]
+        diff = second - darkest
+        avg = blended.mean(axis=1)
+        darkest_mean = means[rows, darkest_idx]
+
+        # Signed margins (> 0: condition holds) of every strategy condition
+        def gap(threshold):
+            return (diff - threshold) / CONFIDENCE_DIFF_SPAN
+
+        def below(limit, value):
+            return (limit - value) / CONFIDENCE_LEVEL_SPAN
 
-    for ci, (cx, cy, r) in enumerate(circles):
-        sample_r = 10
-        xx0, yy0 = max(0, cx - sample_r), max(0, cy - sample_r)
-        xx1, yy1 = (
-            min(src_rgb.shape[1], cx + sample_r),
-            min(src_rgb.shape[0], cy + sample_r),
+        # Strategy 1: Strong signal - clearly darker than average with good separation
+        strong = np.minimum(
+            below(avg * threshold_factor, darkest), gap(f["strong_gap"])
+        )
+        # Strategy 2: Medium contrast faint marks - moderate separation is enough
+        # for light scans where all bubbles are bright
+        faint = np.minimum.reduce(
+            [
+                gap(f["faint_gap"]),
+                below(avg * f["faint_level"], darkest),
+                below(f["faint_mean"], darkest_mean),
+            ]
+        )
+        # Strategy 3: Light pencil - if there's clear separation and not too bright
+        # this catches feint but intentional marks; the second darkest shouldn't be
+        # too close to the darkest (diff is <15% of second-darkest)
+        pencil = np.minimum.reduce(
+            [
+                gap(f["pencil_gap"]),
+                below(f["pencil_mean"], darkest_mean),
+                (second * f["pencil_ratio"] - diff) / CONFIDENCE_DIFF_SPAN,
+            ]
+        )
+        # Strategy 4: Very strong separation even if average threshold not met
+        # This handles overlapping marks or smudges
+        separated = np.minimum(
+            gap(f["separated_gap"]), below(avg * f["separated_level"], darkest)
+        )
+        margin = np.maximum.reduce([strong, faint, pencil, separated])
+        marked = (
+            ((darkest < avg * threshold_factor) & (diff >= f["strong_gap"]))
+            | (
+                (diff >= f["faint_gap"])
+                & (darkest < avg * f["faint_level"])
+                & (darkest_mean < f["faint_mean"])
+            )
+            | (
+                (diff >= f["pencil_gap"])
+                & (darkest_mean < f["pencil_mean"])
+                & (diff < second * f["pencil_ratio"])
+            )
+            | ((diff >= f["separated_gap"]) & (darkest < avg * f["separated_level"]))
         )
+        confidence = np.abs(margin)
+    else:
+        # Only one circle, check if it's dark enough
+        diff = avg = None
+        marked = darkest < f["single_dark"]
+        confidence = np.abs(darkest - f["single_dark"]) / CONFIDENCE_LEVEL_SPAN
+
+    letters = [
+        letter_map.get(int(darkest_idx[q]), "-") if marked[q] else "-"
+        for q in range(n_q)
+    ]
+    diagnostics = {
+        "threshold_factor": threshold_factor,
+        "darkest_idx": darkest_idx,
+        "diff": diff,
+        "avg": avg,
+        "confidence": np.clip(confidence, 0.0, 1.0),
+    }
+    return letters, diagnostics
+
+
+def bubble_features(src_gray, circles_per_q):
+    """
+    Darkness features of every bubble, sampled in one pass.
+    `circles_per_q` maps question number -> [(cx, cy, r), ...]; returns
+    {q_num: (blended, mean, p25)} with one value per circle in each array.
+    """
+    q_nums = list(circles_per_q)
+    flat_circles = [c for q in q_nums for c in circles_per_q[q]]
+    blended, means, p25s = bubble_darkness(src_gray, flat_circles)
+
+    features = {}
+    start = 0
+    for q in q_nums:
+        end = start + len(circles_per_q[q])
+        features[q] = (blended[start:end], means[start:end], p25s[start:end])
+        start = end
+    return features
 
-        if xx1 <= xx0 or yy1 <= yy0:
-            darkness_vals.append((ci, 255, 255, 255))
-            continue
 
-        patch = src_rgb[yy0:yy1, xx0:xx1]
-        if patch.size == 0:
-            darkness_vals.append((ci, 255, 255, 255))
+def answers_from_features(
+    features, threshold_factor=None, letter_map=None, factors=None
+):
+    """
+    Apply the marking strategies to bubble_features() output; no image needed.
+    Returns ({q_num: letter or "-"}, {q_num: confidence 0..1}).
+    """
+    letter_map = letter_map or LETTER_MAP
+    results = {}
+    confidence = {}
+
+    # Questions normally all have 4 circles; group by count to keep arrays square
+    by_count = {}
+    for q, (blended, _, _) in features.items():
+        by_count.setdefault(len(blended), []).append(q)
+
+    log_lines = {}
+    for count, q_nums in by_count.items():
+        if count == 0:
+            for q in q_nums:
+                results[q] = "-"
+                confidence[q] = 0.0
             continue
+        q_blended = np.array([features[q][0] for q in q_nums])
+        q_means = np.array([features[q][1] for q in q_nums])
+        letters, decision = decide_answers(
+            q_blended, q_means, threshold_factor, letter_map, factors
+        )
+        threshold = decision["threshold_factor"]
 
-        gray_patch = cv2.cvtColor(patch, cv2.COLOR_RGB2GRAY)
-        mean_intensity = float(np.mean(gray_patch))
-        p10_intensity = float(np.percentile(gray_patch, 10))
-        p25_intensity = float(np.percentile(gray_patch, 25))
-        p50_intensity = float(np.percentile(gray_patch, 50))
-        # Robust darkness score: weighted blend favoring darker pixels
-        blended_score = (p10_intensity * 0.3) + (p25_intensity * 0.3) + (mean_intensity * 0.4)
-        darkness_vals.append((ci, blended_score, mean_intensity, p25_intensity))
-
-    if not darkness_vals:
-        return "-"
-
-    # Find darkest and second darkest
-    sorted_darkness = sorted(darkness_vals, key=lambda t: t[1])
-    darkest = sorted_darkness[0]
-
-    if len(sorted_darkness) > 1:
-        second_darkest = sorted_darkness[1]
-        diff = second_darkest[1] - darkest[1]
-        avg = np.mean([d[1] for d in darkness_vals])
-        darkest_mean = darkest[2]
-
-        if q_num is not None:
+        for row, q in enumerate(q_nums):
+            results[q] = letters[row]
+            confidence[q] = round(float(decision["confidence"][row]), 2)
+            if decision["diff"] is None or VERBOSITY < 2:
+                continue
             intensities_str = " ".join(
-                [
-                    f"{letter_map.get(ci, '?')}={int(val)}"
-                    for ci, val, _, _ in darkness_vals
-                ]
+                f"{letter_map.get(ci, '?')}={int(val)}"
+                for ci, val in enumerate(q_blended[row])
             )
-            print(
-                f"  Q{q_num}: {intensities_str} | avg={avg:.0f} darkest={letter_map.get(darkest[0], '?')}={darkest[1]:.0f} diff={diff:.0f} thr={avg * threshold_factor:.0f}"
+            d_idx = int(decision["darkest_idx"][row])
+            avg = decision["avg"][row]
+            log_lines[q] = (
+                f"  Q{q}: {intensities_str} | avg={avg:.0f} darkest={letter_map.get(d_idx, '?')}={q_blended[row, d_idx]:.0f} diff={decision['diff'][row]:.0f} thr={avg * threshold:.0f} conf={confidence[q]:.2f}"
             )
 
-        # Strategy 1: Strong signal - clearly darker than average with good separation
-        if darkest[1] < avg * threshold_factor and diff >= 8:
-            return letter_map.get(darkest[0], "-")
-
-        # Strategy 2: Medium contrast faint marks - moderate separation is enough
-        # for light scans where all bubbles are bright
-        if diff >= 6 and darkest[1] < avg * 0.95 and darkest_mean < 220:
-            return letter_map.get(darkest[0], "-")
+    if log_lines:
+        diag("\n".join(log_lines[q] for q in sorted(log_lines)), level=2)
+    return results, confidence
 
-        # Strategy 3: Light pencil - if there's clear separation and not too bright
-        # this catches feint but intentional marks
-        if diff >= 5 and darkest_mean < 200:
-            # Additional safety: second darkest shouldn't be too close to darkest
-            if diff < second_darkest[1] * 0.15:  # diff is <15% of second-darkest
-                return letter_map.get(darkest[0], "-")
 
-        # Strategy 4: Very strong separation even if average threshold not met
-        # This handles overlapping marks or smudges
-        if diff >= 15 and darkest[1] < avg * 1.05:
-            return letter_map.get(darkest[0], "-")
-    else:
-        # Only one circle, check if it's dark enough
-        if darkest[1] < 175:
-            return letter_map.get(darkest[0], "-")
+def read_answers(src_gray, all_boxes, circles_per_box, questions, letter_map=None):
+    """
+    Answers and confidences for `questions` (ints) as string-keyed dicts, plus
+    the bubble_features() they were decided from (int keys, read boxes only).
+    Missing or undetected (inferred) boxes read "-" with confidence 0.
+    """
+    answers = {str(q): "-" for q in questions}
+    confidence = {str(q): 0.0 for q in questions}
+    to_read = {}
+    for q in questions:
+        box_info = all_boxes.get(q)
+        if box_info is None or not box_info["detected"]:
+            continue
+        if circles_per_box.get(q):
+            to_read[q] = circles_per_box[q]
 
-    return "-"
+    features = bubble_features(src_gray, to_read)
+    letters, scores = answers_from_features(features, letter_map=letter_map)
+    for q, letter in letters.items():
+        answers[str(q)] = letter
+        confidence[str(q)] = scores[q]
+    return answers, confidence, features
 
 
 def build_cfg(
@@ -265,7 +993,7 @@ def build_cfg(
     dilation=None,
     kernels=None,
 ):
-    cfg = config.PipelinesConfig()
+    cfg = load_module("boxdetect.config").PipelinesConfig()
     cfg.width_range = width_range
     cfg.height_range = height_range
     cfg.scaling_factors = scales
@@ -276,334 +1004,2697 @@ def build_cfg(
     return cfg
 
 
-def preprocess_for_detection(image_path, output_root):
-    src = cv2.imread(image_path)
-    if src is None:
-        return None
+_CLAHE = None
+_PRESETS = None
 
-    gray = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
-    clahe = cv2.createCLAHE(clipLimit=2.5, tileGridSize=(8, 8))
-    enhanced = clahe.apply(gray)
-    enhanced = cv2.convertScaleAbs(enhanced, alpha=1.35, beta=-20)
-    enhanced = cv2.GaussianBlur(enhanced, (3, 3), 0)
-    enhanced_bgr = cv2.cvtColor(enhanced, cv2.COLOR_GRAY2BGR)
+# Stop the preset search once a candidate has every expected box and their width/height
+# coefficient of variation sum stays under this bound (<= 0 disables it)
+EARLY_EXIT_PENALTY = 0.05
 
-    tmp_path = os.path.join(output_root, "_preprocessed_input.jpg")
-    cv2.imwrite(tmp_path, enhanced_bgr)
-    return tmp_path
 
+def get_clahe():
+    """CLAHE object reused across sheets (kept warm in worker mode)."""
+    global _CLAHE
+    if _CLAHE is None:
+        _CLAHE = cv2.createCLAHE(clipLimit=2.5, tileGridSize=(8, 8))
+    return _CLAHE
 
-def candidate_rank(rects_list):
-    """Rank detection candidates by count closeness and box-size consistency."""
-    count = len(rects_list)
-    if count == 0:
-        return (0, 999, 999.0)
 
-    widths = np.array([r[2] for r in rects_list], dtype=np.float32)
-    heights = np.array([r[3] for r in rects_list], dtype=np.float32)
+# Detection presets as plain parameters, so callers that only need the box
+# limits (the contour engine) never import boxdetect
+PRESET_PARAMS = [
+    (
+        "strict",
+        dict(
+            width_range=(180, 280),
+            height_range=(45, 95),
+            scales=[0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4],
+            wh_ratio=(2.0, 5.0),
+            group_size=(1, 10),
+            dilation=[2],
+            kernels=[3],
+        ),
+    ),
+    (
+        "balanced",
+        dict(
+            width_range=(150, 240),
+            height_range=(35, 80),
+            scales=[0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2],
+            wh_ratio=(1.8, 5.0),
+            group_size=(1, 12),
+            dilation=[1, 2, 3],
+            kernels=[2, 3, 4],
+        ),
+    ),
+    (
+        "relaxed",
+        dict(
+            width_range=(120, 260),
+            height_range=(25, 100),
+            scales=[0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4],
+            wh_ratio=(1.5, 6.0),
+            group_size=(1, 14),
+            dilation=[1, 2, 3],
+            kernels=[2, 3, 4, 5],
+        ),
+    ),
+]
 
-    w_mean = float(np.mean(widths)) if widths.size else 1.0
-    h_mean = float(np.mean(heights)) if heights.size else 1.0
-    w_cv = float(np.std(widths) / max(w_mean, 1e-6))
-    h_cv = float(np.std(heights) / max(h_mean, 1e-6))
-    consistency_penalty = w_cv + h_cv
 
-    return (min(count, 55), abs(count - 55), consistency_penalty)
+def get_presets():
+    """Detection presets, built once per process and reused across sheets."""
+    global _PRESETS
+    if _PRESETS is None:
+        _PRESETS = [(name, build_cfg(**params)) for name, params in PRESET_PARAMS]
+    return _PRESETS
 
 
-def detect_boxes_with_fallback(image_path, output_root):
-    presets = [
-        (
-            "strict",
-            build_cfg(
-                (180, 280),
-                (45, 95),
-                [0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4],
-                wh_ratio=(2.0, 5.0),
-                group_size=(1, 10),
-                dilation=[2],
-                kernels=[3],
-            ),
-        ),
-        (
-            "balanced",
-            build_cfg(
-                (150, 240),
-                (35, 80),
-                [0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2],
-                wh_ratio=(1.8, 5.0),
-                group_size=(1, 12),
-                dilation=[1, 2, 3],
-                kernels=[2, 3, 4],
-            ),
-        ),
-        (
-            "relaxed",
-            build_cfg(
-                (120, 260),
-                (25, 100),
-                [0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4],
-                wh_ratio=(1.5, 6.0),
-                group_size=(1, 14),
-                dilation=[1, 2, 3],
-                kernels=[2, 3, 4, 5],
-            ),
-        ),
-    ]
+# Page width (px) the presets, circle offsets and sampling radii are tuned for
+CANONICAL_SHEET_WIDTH = 1040
+_REDUCED_DECODE_FLAGS = (
+    (8, "IMREAD_REDUCED_COLOR_8"),
+    (4, "IMREAD_REDUCED_COLOR_4"),
+    (2, "IMREAD_REDUCED_COLOR_2"),
+)
 
-    enhanced_input = preprocess_for_detection(image_path, output_root)
-    variants = [("original", image_path)]
-    if enhanced_input and os.path.exists(enhanced_input):
-        variants.append(("enhanced", enhanced_input))
 
-    best_rects = []
-    best_output_image = None
-    best_variant = "none"
-    best_name = "none"
-    best_count = 0
-    best_rank = (0, 999, 999.0)
+# Raw pixels handed over in POSIX shared memory (shm_open() names live here)
+SHM_DIR = "/dev/shm"
+
 
+def parse_shape(shape):
+    """ "HxW" or "HxWxC" (C = 1, 3 or 4) -> tuple of ints."""
     try:
-        for variant_name, variant_path in variants:
-            for name, cfg in presets:
-                rects, _, _, output_image = get_boxes(variant_path, cfg=cfg, plot=False)
-                rects_list = [tuple(r) for r in rects] if rects is not None else []
-                count = len(rects_list)
-                rank = candidate_rank(rects_list)
-                print(
-                    f"[GRADING] detect variant={variant_name} preset={name} rectangles={count} rank={rank}"
-                )
+        dims = tuple(int(v) for v in str(shape).lower().split("x"))
+    except ValueError:
+        dims = ()
+    if (
+        len(dims) not in (2, 3)
+        or min(dims) <= 0
+        or (len(dims) == 3 and dims[2] not in (1, 3, 4))
+    ):
+        raise GradingError(
+            f"Invalid image shape {shape!r}: expected HxW or HxWxC with C 1, 3 or 4"
+        )
+    return dims
 
-                if output_image is None:
-                    continue
 
-                better = (
-                    rank[0] > best_rank[0]
-                    or (rank[0] == best_rank[0] and rank[1] < best_rank[1])
-                    or (
-                        rank[0] == best_rank[0]
-                        and rank[1] == best_rank[1]
-                        and rank[2] < best_rank[2]
-                    )
-                )
+def read_shared_image(name, shape):
+    """
+    Copy raw uint8 pixels out of a POSIX shared-memory segment and return a
+    BGR page. `shape` is "HxW" (gray), "HxWx3" (BGR) or "HxWx4" (BGRA), rows
+    first. The segment is mapped read-only and left for its creator to unlink.
+    """
+    import mmap
 
-                if better:
-                    best_rects = rects_list
-                    best_output_image = output_image
-                    best_variant = variant_name
-                    best_name = name
-                    best_rank = rank
-                    best_count = count
-    finally:
-        if enhanced_input and os.path.exists(enhanced_input):
-            try:
-                os.remove(enhanced_input)
-            except OSError:
-                pass
+    dims = parse_shape(shape)
+    segment = name.lstrip("/")
+    if not segment or "/" in segment:
+        raise GradingError(f"Invalid shared memory name: {name}")
+    size = math.prod(dims)
+    try:
+        f = open(os.path.join(SHM_DIR, segment), "rb")
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Shared memory segment not found: {name}")
+    with f:
+        available = os.fstat(f.fileno()).st_size
+        if available < size:
+            raise GradingError(
+                f"Shared memory {name} holds {available} bytes, {shape} needs {size}"
+            )
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+            pixels = np.frombuffer(mapped, np.uint8, size).reshape(dims).copy()
 
-    return best_rects, best_output_image, best_variant, best_name, max(best_count, 0)
+    if pixels.ndim == 2 or pixels.shape[2] == 1:
+        return cv2.cvtColor(pixels.reshape(dims[:2]), cv2.COLOR_GRAY2BGR)
+    if pixels.shape[2] == 4:
+        return cv2.cvtColor(pixels, cv2.COLOR_BGRA2BGR)
+    return pixels
 
 
-try:
-    if not os.path.exists(input_file):
-        raise FileNotFoundError(f"Input file not found: {input_file}")
+def in_memory_source(input_file):
+    """Stdin ("-") and shared-memory ("shm:NAME") sources have no file to reread."""
+    return input_file == "-" or input_file.startswith("shm:")
 
-    print(f"Processing file: {input_file}")
-    rects_list, output_image, variant_name, preset_name, preset_rect_count = (
-        detect_boxes_with_fallback(input_file, output_dir)
-    )
-    print(
-        f"[GRADING] selected variant={variant_name} preset={preset_name} with {preset_rect_count} rectangles"
-    )
 
-    if output_image is not None:
-        output_image_bgr = cv2.cvtColor(output_image, cv2.COLOR_RGB2BGR)
+def source_label(input_file):
+    return input_file if in_memory_source(input_file) else os.path.abspath(input_file)
+
+
+def load_sheet(buf, canonical_width=0):
+    """
+    Decode the sheet's encoded bytes once. With `canonical_width`, scans wider than that are
+    decoded at the largest JPEG DCT reduction that stays above it and then
+    resized to it, so 600-DPI scans and phone photos cost about as much as a
+    200-DPI scan. Smaller images are never upscaled.
+    """
+    if not canonical_width or canonical_width <= 0:
+        return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+    # 1/8 decode is cheap and tells us roughly how wide the page is
+    probe = cv2.imdecode(buf, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if probe is None:
+        return None
+    approx_width = probe.shape[1] * 8
+
+    flag, factor = cv2.IMREAD_COLOR, 1
+    for reduce_by, reduced_flag in _REDUCED_DECODE_FLAGS:
+        if approx_width / reduce_by >= canonical_width:
+            flag, factor = getattr(cv2, reduced_flag), reduce_by
+            break
+    src_bgr = cv2.imdecode(buf, flag)
+    if src_bgr is None:
+        return None
 
-        # Load source image
-        src_bgr = cv2.imread(input_file)
-        src_rgb = (
-            cv2.cvtColor(src_bgr, cv2.COLOR_BGR2RGB) if src_bgr is not None else None
+    src_bgr, resized = fit_canonical_width(src_bgr, canonical_width)
+    if factor > 1 or resized:
+        diag(
+            f"[GRADING] normalized ~{approx_width}px wide scan to {src_bgr.shape[1]}x{src_bgr.shape[0]} (decode 1/{factor})"
         )
-        if src_bgr is not None:
-            print(f"[GRADING] image size: {src_bgr.shape[1]}x{src_bgr.shape[0]}")
+    return src_bgr
+
+
+def fit_canonical_width(src_bgr, canonical_width=0):
+    """Downscale an already decoded page to `canonical_width`; (image, resized)."""
+    decoded_w, decoded_h = src_bgr.shape[1], src_bgr.shape[0]
+    # Within 10% of the canonical width the resize isn't worth the blur
+    if not canonical_width or decoded_w <= canonical_width * 1.1:
+        return src_bgr, False
+    scale = canonical_width / decoded_w
+    src_bgr = cv2.resize(
+        src_bgr,
+        (canonical_width, max(1, int(round(decoded_h * scale)))),
+        interpolation=cv2.INTER_AREA,
+    )
+    return src_bgr, True
 
-        # Prepare boxes with indices and centers
-        indexed_boxes = []
-        for idx, r in enumerate(rects_list):
-            x, y, w, h = r
-            cx = x + w / 2.0
-            cy = y + h / 2.0
-            indexed_boxes.append((idx, r, cx, cy))
-        before_filter_count = len(indexed_boxes)
 
-        # Filter out false positives detected below the bubble-sheet area
-        src_h = src_bgr.shape[0] if src_bgr is not None else 0
-        if src_h > 0:
-            initial_count = len(indexed_boxes)
-            primary_ratio = 0.96
-            relaxed_ratio = 0.99
+def preprocess_for_detection(src_bgr):
+    """Contrast-enhanced copy of the decoded sheet, kept in memory."""
+    if src_bgr is None:
+        return None
 
-            primary_filtered = [
-                b for b in indexed_boxes if b[3] < src_h * primary_ratio
-            ]
-            if len(primary_filtered) >= 45:
-                indexed_boxes = primary_filtered
-                print(
-                    f"[GRADING] bottom filter ratio={primary_ratio:.2f} kept={len(indexed_boxes)}/{initial_count}"
-                )
-            else:
-                relaxed_filtered = [
-                    b for b in indexed_boxes if b[3] < src_h * relaxed_ratio
-                ]
-                if len(relaxed_filtered) >= 45:
-                    indexed_boxes = relaxed_filtered
-                    print(
-                        f"[GRADING] bottom filter ratio={relaxed_ratio:.2f} kept={len(indexed_boxes)}/{initial_count}"
-                    )
-                else:
-                    print(
-                        "[GRADING] bottom filter skipped (too few boxes kept by thresholds)"
-                    )
+    gray = cv2.cvtColor(src_bgr, cv2.COLOR_BGR2GRAY)
+    enhanced = get_clahe().apply(gray)
+    enhanced = cv2.convertScaleAbs(enhanced, alpha=1.35, beta=-20)
+    enhanced = cv2.GaussianBlur(enhanced, (3, 3), 0)
+    return cv2.cvtColor(enhanced, cv2.COLOR_GRAY2BGR)
 
-        if len(indexed_boxes) > 55:
-            indexed_boxes.sort(key=lambda b: (b[3], -(b[1][2] * b[1][3]), b[2]))
-            indexed_boxes = indexed_boxes[:55]
-        print(
-            f"[GRADING] rectangles before filter={before_filter_count} after filter={len(indexed_boxes)}"
-        )
 
-        if len(indexed_boxes) == 0:
-            logger.error("No candidate boxes detected after filtering")
-            sys.exit(1)
+def candidate_rank(rects_list, expected):
+    """Rank detection candidates by count closeness and box-size consistency."""
+    count = len(rects_list)
+    if count == 0:
+        return (0, 999, 999.0)
 
-        # Cluster into columns
-        columns = cluster_by_column(indexed_boxes)
+    widths = np.array([r[2] for r in rects_list], dtype=np.float32)
+    heights = np.array([r[3] for r in rects_list], dtype=np.float32)
 
-        # Expected structure: 55 total questions
-        expected_structure = {
-            0: list(range(1, 16)),  # Column 1: Q1-15
-            1: list(range(16, 31)),  # Column 2: Q16-30
-            2: list(range(31, 46)),  # Column 3: Q31-45
-            3: list(range(46, 56)),  # Column 4: Q46-55
-        }
+    w_mean = float(np.mean(widths)) if widths.size else 1.0
+    h_mean = float(np.mean(heights)) if heights.size else 1.0
+    w_cv = float(np.std(widths) / max(w_mean, 1e-6))
+    h_cv = float(np.std(heights) / max(h_mean, 1e-6))
+    consistency_penalty = w_cv + h_cv
 
-        # Infer missing boxes
-        all_boxes = infer_missing_boxes(columns, expected_structure)
-        detected_box_count = len([b for b in all_boxes.values() if b["detected"]])
-        print(f"[GRADING] detected boxes after inference: {detected_box_count}")
+    return (min(count, expected), abs(count - expected), consistency_penalty)
 
-        if detected_box_count == 0:
-            logger.error("No answer boxes detected after inference")
-            sys.exit(1)
 
-        # Create circle positions for all boxes
-        detected_circles_per_box = {}
-        shrink_factor = 0.7
-        rel_y = 29
-        const_r = 12
+def render_detection_overlay(variant_bgr, rects, grouping_rects, thickness):
+    """Redraw boxdetect's overlay (boxes + groups) for the winning candidate only."""
+    overlay = variant_bgr.copy()
+    # Same drawing as boxdetect's img_proc.draw_rects, without importing it
+    for rect_list, color in ((rects, (0, 255, 0)), (grouping_rects, (255, 0, 0))):
+        for x, y, w, h in rect_list:
+            cv2.rectangle(overlay, (x, y), (x + w, y + h), color, thickness)
+    return overlay
 
-        for q_num in range(1, 56):
-            if q_num not in all_boxes:
-                continue
 
-            box_info = all_boxes[q_num]
-            rect = box_info["rect"]
-            x, y, w, h = rect
+def preset_cost(cfg):
+    """Relative cost of a preset: boxdetect runs every config set at every scale."""
+    cfg.update_num_iterations()
+    return len(cfg.scaling_factors) * cfg.num_iterations
 
-            margin_left = int(w * 0.15)
-            anchor_rel_x = margin_left
-            raw_span = w - 2 * margin_left
-            adj_span = raw_span * shrink_factor
-            step = adj_span / 3
 
-            equi_rel_xs = [anchor_rel_x + i * step for i in range(4)]
-            centers = [(int(x + rel_x), int(y + rel_y)) for rel_x in equi_rel_xs]
+def is_perfect_candidate(rank, max_penalty, expected):
+    """Exactly the expected boxes with consistent sizes: no attempt can beat it."""
+    return (
+        max_penalty > 0
+        and rank[0] == expected
+        and rank[1] == 0
+        and rank[2] <= max_penalty
+    )
 
-            # Adjust for single-digit question numbers
-            if 1 <= q_num <= 9:
-                centers = [(cx + 8, cy) for (cx, cy) in centers]
 
-            detected_circles_per_box[q_num] = [
-                (cx, cy, const_r) for (cx, cy) in centers
-            ]
+def detect_attempts():
+    """(variant, preset name, cfg) attempts ordered cheapest preset first."""
+    # Imported here, once, rather than by each (possibly threaded) attempt
+    load_module("boxdetect.pipelines")
+    presets = sorted(get_presets(), key=lambda p: preset_cost(p[1]))
+    return [
+        (variant_name, name, cfg)
+        for name, cfg in presets
+        for variant_name in ("original", "enhanced")
+    ]
 
-        # Answer detection
-        if check_n and check_n > 0 and src_rgb is not None:
-            max_check = min(check_n, 55)
-            json_results = {}
-            darkest_center_map = {}
 
-            for box_num in range(1, max_check + 1):
-                if box_num not in all_boxes:
-                    json_results[str(box_num)] = "-"
-                    continue
+def evaluate_attempt(variant_name, variant_image, name, cfg, timer, expected):
+    """Run one boxdetect pass; returns (rects, grouping rects, rank) or None."""
+    started = time.perf_counter()
+    get_boxes = load_module("boxdetect.pipelines").get_boxes
+    rects, grouping_rects, _, output_image = get_boxes(
+        variant_image, cfg=cfg, plot=False
+    )
+    rects_list = [tuple(r) for r in rects] if rects is not None else []
+    rank = candidate_rank(rects_list, expected)
+    if timer is not None:
+        timer.add_candidate(
+            variant_name, name, len(rects_list), rank, time.perf_counter() - started
+        )
+    diag(
+        f"[GRADING] detect variant={variant_name} preset={name} rectangles={len(rects_list)} rank={rank}",
+        level=2,
+    )
 
-                box_info = all_boxes[box_num]
+    if output_image is None:
+        return None
+    # Only rects are kept; the winner's overlay is redrawn at the end
+    return rects_list, [tuple(g) for g in grouping_rects], rank
+
+
+# Contour engine: the answer boxes are cells of a ruled table, so one
+# adaptive threshold, a morphological pass that keeps only long straight
+# strokes and a hole search on that line mask finds them all in a few ms.
+# Boxes are accepted with the strict preset's size and aspect window.
+DETECT_ENGINES = ("boxdetect", "contour")
+CONTOUR_BLOCK = 31  # adaptive threshold window, px
+CONTOUR_C = 10
+CONTOUR_GAP = 9  # px of faint or broken ruling bridged before line extraction
+CONTOUR_LINE = (60, 40)  # shortest horizontal / vertical ruling kept, px
+CONTOUR_INSET = (2, 3, 2, 2)  # hole edges to boxdetect's box edges: l, t, r, b
+_CONTOUR_KERNELS = None
+
+
+def contour_kernels():
+    global _CONTOUR_KERNELS
+    if _CONTOUR_KERNELS is None:
+        rect = cv2.MORPH_RECT
+        _CONTOUR_KERNELS = (
+            cv2.getStructuringElement(rect, (CONTOUR_GAP, 1)),
+            cv2.getStructuringElement(rect, (CONTOUR_LINE[0], 1)),
+            cv2.getStructuringElement(rect, (1, CONTOUR_GAP)),
+            cv2.getStructuringElement(rect, (1, CONTOUR_LINE[1])),
+        )
+    return _CONTOUR_KERNELS
+
+
+def contour_box_limits():
+    """(width, height, aspect) ranges the strict preset accepts, in page px."""
+    params = dict(PRESET_PARAMS)["strict"]
+    scales = params["scales"]
+    (w0, w1), (h0, h1) = params["width_range"], params["height_range"]
+    return (
+        (w0 / max(scales), w1 / min(scales)),
+        (h0 / max(scales), h1 / min(scales)),
+        tuple(params["wh_ratio"]),
+    )
 
-                # If box wasn't detected, mark as "-"
-                if not box_info["detected"]:
-                    json_results[str(box_num)] = "-"
-                    continue
 
-                circles = detected_circles_per_box.get(box_num, [])
-                if not circles:
-                    json_results[str(box_num)] = "-"
-                    continue
+def detect_boxes_contour(src_bgr):
+    """Answer-box rects (x, y, w, h) found as the cells of the ruled table."""
+    gray = cv2.cvtColor(src_bgr, cv2.COLOR_BGR2GRAY)
+    ink = cv2.adaptiveThreshold(
+        gray,
+        255,
+        cv2.ADAPTIVE_THRESH_MEAN_C,
+        cv2.THRESH_BINARY_INV,
+        CONTOUR_BLOCK,
+        CONTOUR_C,
+    )
+    h_gap, h_line, v_gap, v_line = contour_kernels()
+    horizontal = cv2.morphologyEx(
+        cv2.morphologyEx(ink, cv2.MORPH_CLOSE, h_gap), cv2.MORPH_OPEN, h_line
+    )
+    vertical = cv2.morphologyEx(
+        cv2.morphologyEx(ink, cv2.MORPH_CLOSE, v_gap), cv2.MORPH_OPEN, v_line
+    )
+    contours, hierarchy = cv2.findContours(
+        cv2.bitwise_or(horizontal, vertical), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
+    )
+    if hierarchy is None:
+        return []
 
-                # Detect answer
-                answer = detect_answer_intensity(src_rgb, circles, q_num=box_num)
-                json_results[str(box_num)] = answer
+    (w_min, w_max), (h_min, h_max), (r_min, r_max) = contour_box_limits()
+    left, top, right, bottom = CONTOUR_INSET
+    rects = []
+    for contour, (_, _, _, parent) in zip(contours, hierarchy[0]):
+        # Cells are the holes of the ruling; outer contours are the ruling itself
+        if parent < 0:
+            continue
+        x, y, w, h = cv2.boundingRect(contour)
+        w, h = w - left - right, h - top - bottom
+        if w_min <= w <= w_max and h_min <= h <= h_max and r_min <= w / h <= r_max:
+            rects.append((x + left, y + top, w, h))
+    return rects
+
+
+def evaluate_contour_attempt(src_bgr, timer, expected):
+    """The contour engine as a detection attempt: (rects, [], rank)."""
+    started = time.perf_counter()
+    rects_list = detect_boxes_contour(src_bgr)
+    rank = candidate_rank(rects_list, expected)
+    if timer is not None:
+        timer.add_candidate(
+            "original", "contour", len(rects_list), rank, time.perf_counter() - started
+        )
+    diag(
+        f"[GRADING] detect variant=original preset=contour rectangles={len(rects_list)} rank={rank}",
+        level=2,
+    )
+    return rects_list, [], rank
 
-                # Store for visualization
-                if answer != "-":
-                    letter_to_idx = {"A": 3, "B": 2, "C": 1, "D": 0}
-                    darkest_center_map[box_num] = letter_to_idx.get(answer, None)
 
-            # Draw circles + fill selected
-            for box_num, circles in detected_circles_per_box.items():
-                if box_num > max_check:
-                    continue
+def _contour_first(src_bgr, timer, expected, attempts):
+    # boxdetect passes only start if the contour pass is not good enough
+    try:
+        yield "original", src_bgr, "contour", None, evaluate_contour_attempt(
+            src_bgr, timer, expected
+        )
+        yield from attempts
+    finally:
+        attempts.close()
+
+
+def _sequential_attempts(src_bgr, timer, expected):
+    # The enhanced variant is only built if a cheap pass on the original fails
+    variant_images = {"original": src_bgr}
+    for variant_name, name, cfg in detect_attempts():
+        if variant_name not in variant_images:
+            with timer.stage("preprocess"):
+                variant_images[variant_name] = preprocess_for_detection(src_bgr)
+        variant_image = variant_images[variant_name]
+        if variant_image is None:
+            continue
+        yield variant_name, variant_image, name, cfg, evaluate_attempt(
+            variant_name, variant_image, name, cfg, timer, expected
+        )
 
-                chosen_idx = darkest_center_map.get(box_num)
-
-                for i, (cx, cy, r) in enumerate(circles):
-                    if i == chosen_idx:
-                        # Blue fill for selected answer
-                        cv2.circle(
-                            output_image_bgr, (cx, cy), r, (255, 0, 0), -1, cv2.LINE_AA
-                        )
-                    else:
-                        # Green outline for unselected
-                        cv2.circle(
-                            output_image_bgr, (cx, cy), r, (0, 255, 0), 2, cv2.LINE_AA
-                        )
-
-                # Mark undetected boxes with red X
-                if box_num in all_boxes and not all_boxes[box_num]["detected"]:
-                    rect = all_boxes[box_num]["rect"]
-                    x, y, w, h = rect
-                    cv2.line(output_image_bgr, (x, y), (x + w, y + h), (0, 0, 255), 3)
-                    cv2.line(output_image_bgr, (x + w, y), (x, y + h), (0, 0, 255), 3)
-
-            with open(output_json, "w") as jf:
-                json.dump(json_results, jf, indent=2)
-
-            cv2.imwrite(output_file, output_image_bgr)
-            print(f"Detected {detected_box_count} out of 55 boxes")
-            print(f"Output saved: {output_file}")
-        else:
-            logger.error("No output image generated or n questions was not provided")
-            sys.exit(1)
-    else:
-        logger.error("Box detection returned no output image")
+
+def _concurrent_attempts(src_bgr, detect_threads, timer, expected):
+    # boxdetect spends most of its time in OpenCV calls that release the GIL,
+    # so the independent variant x preset passes overlap well on threads.
+    # Results are still yielded in attempt order to keep the winner deterministic.
+    import copy
+    from concurrent.futures import ThreadPoolExecutor
+
+    with timer.stage("preprocess"):
+        variant_images = {
+            "original": src_bgr,
+            "enhanced": preprocess_for_detection(src_bgr),
+        }
+    # get_boxes() recounts cfg.num_iterations in place, so threads sharing a
+    # preset's config could cut each other's config sets short: each attempt
+    # gets its own copy.
+    attempts = [
+        (variant_name, variant_images[variant_name], name, copy.deepcopy(cfg))
+        for variant_name, name, cfg in detect_attempts()
+        if variant_images[variant_name] is not None
+    ]
+
+    def timed_attempt(attempt):
+        # Candidates go to a timer of its own so that a pass left running
+        # after an early exit cannot touch the sheet's timings
+        own = StageTimer()
+        return evaluate_attempt(*attempt, own, expected), own.candidates
+
+    pool = ThreadPoolExecutor(max_workers=detect_threads)
+    futures = [pool.submit(timed_attempt, attempt) for attempt in attempts]
+    try:
+        for attempt, future in zip(attempts, futures):
+            outcome, candidates = future.result()
+            timer.candidates.extend(candidates)
+            yield (*attempt, outcome)
+    finally:
+        # Early exit: return now, dropping passes that have not started; the
+        # ones already running finish in the background and are discarded
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def detect_boxes_with_fallback(
+    src_bgr,
+    early_exit_penalty=EARLY_EXIT_PENALTY,
+    detect_threads=0,
+    timer=None,
+    expected=None,
+    engine="boxdetect",
+):
+    """
+    Best box candidate over the variant x preset attempts, stopping at the
+    first perfect one. With `engine="contour"` the contour engine runs first
+    and the boxdetect presets are only the fallback.
+    """
+    timer = timer or StageTimer()
+    expected = expected or load_sheet_spec()["total"]
+    best_rects = []
+    best_groups = []
+    best_image = None
+    best_thickness = 2
+    best_variant = "none"
+    best_name = "none"
+    best_count = 0
+    best_rank = (0, 999, 999.0)
+
+    if detect_threads and detect_threads > 1:
+        attempts = _concurrent_attempts(src_bgr, detect_threads, timer, expected)
+    else:
+        attempts = _sequential_attempts(src_bgr, timer, expected)
+    if engine == "contour":
+        attempts = _contour_first(src_bgr, timer, expected, attempts)
+
+    for variant_name, variant_image, name, cfg, outcome in attempts:
+        if outcome is None:
+            continue
+        rects_list, grouping_rects, rank = outcome
+        count = len(rects_list)
+
+        better = (
+            rank[0] > best_rank[0]
+            or (rank[0] == best_rank[0] and rank[1] < best_rank[1])
+            or (
+                rank[0] == best_rank[0]
+                and rank[1] == best_rank[1]
+                and rank[2] < best_rank[2]
+            )
+        )
+
+        if better:
+            best_rects = rects_list
+            best_groups = grouping_rects
+            best_image = variant_image
+            best_thickness = cfg.thickness if cfg is not None else 2
+            best_variant = variant_name
+            best_name = name
+            best_rank = rank
+            best_count = count
+
+        if is_perfect_candidate(best_rank, early_exit_penalty, expected):
+            diag(
+                f"[GRADING] early exit: variant={best_variant} preset={best_name} is a perfect candidate"
+            )
+            break
+
+    attempts.close()
+
+    # The overlay itself is drawn later, and only if the sheet is rendered
+    return (
+        best_rects,
+        best_groups,
+        best_thickness,
+        best_image,
+        best_variant,
+        best_name,
+        max(best_count, 0),
+    )
+
+
+def detect_in_region(
+    src_bgr,
+    region,
+    early_exit_penalty,
+    detect_threads,
+    timer,
+    expected,
+    engine="boxdetect",
+):
+    """detect_boxes_with_fallback() on a page region, mapped back to page px."""
+    x0, y0, x1, y1 = region
+    rects, groups, thickness, _, variant_name, preset_name, count = (
+        detect_boxes_with_fallback(
+            np.ascontiguousarray(src_bgr[y0:y1, x0:x1]),
+            early_exit_penalty,
+            detect_threads,
+            timer,
+            expected,
+            engine,
+        )
+    )
+    return (
+        [(x + x0, y + y0, w, h) for x, y, w, h in rects],
+        [(x + x0, y + y0, w, h) for x, y, w, h in groups],
+        thickness,
+        # The overlay is drawn on the whole page; render_sheet() rebuilds the
+        # enhanced variant for it if that one won
+        src_bgr if variant_name == "original" else None,
+        variant_name,
+        preset_name,
+        count,
+    )
+
+
+# Answer-grid location: the printed answer table is one connected blob of ink
+# on a small binarised copy of the page, so its bounding box takes a few ms
+# and the multi-scale box search only has to cover that region.
+GRID_LOCATE_WIDTH = 347
+GRID_MIN_SPAN = (0.5, 0.3)  # of the page width/height
+GRID_MIN_DOMINANCE = 3.0  # ink pixels over the next largest blob
+GRID_PAD = 0.02  # of the page width, on every side
+
+
+def ink_components(ink):
+    """
+    Connected components of a binary ink mask as (labels, stats, grid), where
+    grid is the label of the dominant blob or None. Blobs touching three or
+    more edges (the table around a photographed page) are never the grid.
+    """
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    if count < 2:
+        return labels, stats, None
+
+    h, w = ink.shape[:2]
+    x, y = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+    edges = (x == 0).astype(int) + (y == 0)
+    edges += x + stats[:, cv2.CC_STAT_WIDTH] == w
+    edges += y + stats[:, cv2.CC_STAT_HEIGHT] == h
+    areas = np.where(edges < 3, stats[:, cv2.CC_STAT_AREA], 0)
+    areas[0] = 0
+    order = np.argsort(areas)[::-1]
+    if areas[order[0]] == 0 or areas[order[0]] < areas[order[1]] * GRID_MIN_DOMINANCE:
+        return labels, stats, None
+    return labels, stats, int(order[0])
+
+
+def thumbnail(src_gray, width):
+    scale = width / src_gray.shape[1]
+    small = cv2.resize(
+        src_gray,
+        (width, max(1, round(src_gray.shape[0] * scale))),
+        interpolation=cv2.INTER_AREA,
+    )
+    return small, scale
+
+
+def locate_answer_grid(src_gray):
+    """Padded (x0, y0, x1, y1) page box of the answer grid, or None."""
+    h, w = src_gray.shape[:2]
+    small, scale = thumbnail(src_gray, GRID_LOCATE_WIDTH)
+    _, ink = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    _, stats, grid = ink_components(ink)
+    if grid is None:
+        return None
+
+    x, y, bw, bh, _ = stats[grid]
+    if bw < GRID_MIN_SPAN[0] * small.shape[1] or bh < GRID_MIN_SPAN[1] * small.shape[0]:
+        return None
+
+    pad = GRID_PAD * w
+    return (
+        max(0, int(x / scale - pad)),
+        max(0, int(y / scale - pad)),
+        min(w, int(round((x + bw) / scale + pad))),
+        min(h, int(round((y + bh) / scale + pad))),
+    )
+
+
+# Orientation and skew: the answer grid is one framed block of ink with the
+# sheet header above it, so on a thumbnail the side holding the other ink is
+# the top of the page and the grid's outline is a quad to rectify onto an
+# upright rectangle. A local threshold keeps faint frame lines in the outline.
+NORMALIZE_MIN_TEXT_RATIO = 2.0  # header-side ink over the opposite side's
+NORMALIZE_MIN_TEXT_BLOB = 4  # thumbnail px; smaller blobs are speckle
+NORMALIZE_MIN_SHIFT = 8  # px, page scale; smaller corrections are left alone
+NORMALIZE_MAX_SHIFT = 0.2  # of the page width; larger means a bad outline
+_ROTATIONS = {
+    "bottom": "ROTATE_180",
+    "left": "ROTATE_90_CLOCKWISE",
+    "right": "ROTATE_90_COUNTERCLOCKWISE",
+}
+_OPPOSITE = {"top": "bottom", "bottom": "top", "left": "right", "right": "left"}
+
+
+def sheet_ink(src_gray):
+    """Locally thresholded thumbnail ink and its components, for normalize_sheet()."""
+    small, scale = thumbnail(src_gray, GRID_LOCATE_WIDTH)
+    ink = cv2.adaptiveThreshold(
+        small, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 8
+    )
+    return (*ink_components(ink), scale)
+
+
+def page_top(labels, stats, grid):
+    """Side of the grid the sheet header is on: top/bottom/left/right, or None."""
+    h, w = labels.shape[:2]
+    x, y, bw, bh = stats[grid][:4]
+    left, top, width, height, area = stats.T
+    # Text is anything smaller than the grid that is neither speckle nor
+    # touching the edge (scan shadows, the background around a photo)
+    text = (area < area[grid]) & (area >= NORMALIZE_MIN_TEXT_BLOB)
+    text &= (left > 0) & (top > 0) & (left + width < w) & (top + height < h)
+    text[[0, grid]] = False
+    text = text[labels]
+    ink = {
+        "top": np.count_nonzero(text[:y, x : x + bw]),
+        "bottom": np.count_nonzero(text[y + bh :, x : x + bw]),
+        "left": np.count_nonzero(text[y : y + bh, :x]),
+        "right": np.count_nonzero(text[y : y + bh, x + bw :]),
+    }
+    side = max(ink, key=ink.get)
+    if ink[side] < NORMALIZE_MIN_TEXT_RATIO * max(1, ink[_OPPOSITE[side]]):
+        return None
+    return side
+
+
+def order_quad(points):
+    """Corners as top-left, top-right, bottom-right, bottom-left."""
+    points = np.asarray(points, dtype=np.float32).reshape(4, 2)
+    total, diff = points.sum(axis=1), np.diff(points, axis=1).ravel()
+    return np.array(
+        [
+            points[np.argmin(total)],
+            points[np.argmin(diff)],
+            points[np.argmax(total)],
+            points[np.argmax(diff)],
+        ],
+        dtype=np.float32,
+    )
+
+
+def _line_intersection(p1, p2, p3, p4):
+    d1, d2 = p2 - p1, p4 - p3
+    denom = d1[0] * d2[1] - d1[1] * d2[0]
+    if abs(denom) < 1e-6:
+        return None
+    t = ((p3[0] - p1[0]) * d2[1] - (p3[1] - p1[1]) * d2[0]) / denom
+    return p1 + t * d1
+
+
+def grid_quad(mask):
+    """Outline of the grid blob as four ordered corners (thumbnail pixels)."""
+    contours, _ = cv2.findContours(
+        mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+    )
+    hull = cv2.convexHull(max(contours, key=cv2.contourArea))
+    approx = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True)
+    points = approx.reshape(-1, 2).astype(np.float32)
+    if len(points) == 5:
+        # A short column leaves one corner of the grid unframed: extend the
+        # two sides next to the cut until they meet
+        k = len(points)
+        lengths = [np.linalg.norm(points[(i + 1) % k] - points[i]) for i in range(k)]
+        i = int(np.argmin(lengths))
+        corner = _line_intersection(
+            points[(i - 1) % k], points[i], points[(i + 2) % k], points[(i + 1) % k]
+        )
+        if corner is not None:
+            points = np.delete(points, [i, (i + 1) % k], axis=0)
+            points = np.insert(points, i if i + 1 < k else 0, corner, axis=0)
+    if len(points) == 4:
+        return order_quad(points)
+    # No usable outline (marks touching the frame): skew only
+    return order_quad(cv2.boxPoints(cv2.minAreaRect(hull)))
+
+
+def rectify_homography(quad, scale, target_width=0):
+    """
+    Page-scale homography taking `quad` onto an upright rectangle (resized to
+    `target_width` if given), and the largest corner shift it causes.
+    """
+    quad = quad / scale
+    tl, tr, br, bl = quad
+    width = (np.linalg.norm(tr - tl) + np.linalg.norm(br - bl)) / 2
+    height = (np.linalg.norm(bl - tl) + np.linalg.norm(br - tr)) / 2
+    if target_width:
+        width, height = target_width, height * target_width / width
+    cx, cy = quad.mean(axis=0)
+    x0, y0 = cx - width / 2, cy - height / 2
+    target = np.array(
+        [[x0, y0], [x0 + width, y0], [x0 + width, y0 + height], [x0, y0 + height]],
+        dtype=np.float32,
+    )
+    shift = float(np.linalg.norm(target - quad, axis=1).max())
+    return cv2.getPerspectiveTransform(quad, target), shift
+
+
+def normalize_sheet(src_bgr, grid_width=0):
+    """
+    Turn a rotated, skewed or photographed sheet upright before the box search.
+    Orientation (90/180 degrees) and the grid outline are found on a thumbnail;
+    the page is then rotated losslessly and warped once. A warped grid is also
+    resized to span `grid_width` of the page, the size the box presets expect.
+    Returns (image, transform); transform is None for sheets that need no
+    correction and can be replayed with apply_normalization().
+    """
+    src_gray = cv2.cvtColor(src_bgr, cv2.COLOR_BGR2GRAY)
+    labels, stats, grid, scale = sheet_ink(src_gray)
+    if grid is None:
+        return src_bgr, None
+
+    transform = {}
+    side = page_top(labels, stats, grid)
+    if side in _ROTATIONS:
+        transform["rotate"] = side
+        rotation = getattr(cv2, _ROTATIONS[side])
+        src_bgr = cv2.rotate(src_bgr, rotation)
+        labels, stats, grid, scale = sheet_ink(cv2.rotate(src_gray, rotation))
+
+    if grid is not None:
+        quad = grid_quad(labels == grid)
+        _, shift = rectify_homography(quad, scale)
+        if NORMALIZE_MIN_SHIFT <= shift <= NORMALIZE_MAX_SHIFT * src_bgr.shape[1]:
+            homography, shift = rectify_homography(
+                quad, scale, grid_width * src_bgr.shape[1]
+            )
+            transform["homography"] = homography.tolist()
+            transform["shift"] = round(shift, 1)
+            src_bgr = _warp(src_bgr, homography)
+
+    return src_bgr, transform or None
+
+
+def _warp(src_bgr, homography):
+    return cv2.warpPerspective(
+        src_bgr,
+        np.asarray(homography, dtype=np.float64),
+        (src_bgr.shape[1], src_bgr.shape[0]),
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_REPLICATE,
+    )
+
+
+def apply_normalization(src_bgr, transform):
+    """Replay a normalize_sheet() transform on the same decoded page."""
+    if not transform:
+        return src_bgr
+    if transform.get("rotate"):
+        src_bgr = cv2.rotate(src_bgr, getattr(cv2, _ROTATIONS[transform["rotate"]]))
+    if transform.get("homography"):
+        src_bgr = _warp(src_bgr, transform["homography"])
+    return src_bgr
+
+
+# Layout templates: every sheet of a test is the same printed form, so the box
+# geometry of one good sheet is cached per test id and later sheets are mapped
+# onto it with a cheap ORB feature registration instead of the box search;
+# each box is then snapped into place by matching its template patch.
+LAYOUT_FEATURE_WIDTH = 600
+LAYOUT_MIN_INLIERS = 12
+LAYOUT_SCALE_RANGE = (0.8, 1.25)
+LAYOUT_MAX_ROTATION = 0.05  # radians
+LAYOUT_PATCH_MARGIN = 12
+LAYOUT_SEARCH_PX = 8
+LAYOUT_MIN_SCORE = 0.6
+LAYOUT_MIN_VERIFIED = 0.9
+
+_ORB = None
+_LAYOUTS = {}
+
+
+def get_orb():
+    global _ORB
+    if _ORB is None:
+        _ORB = cv2.ORB_create(nfeatures=1500)
+    return _ORB
+
+
+def layout_features(src_gray):
+    """ORB keypoints (in full-resolution coordinates) and descriptors."""
+    scale = LAYOUT_FEATURE_WIDTH / src_gray.shape[1]
+    small = cv2.resize(
+        src_gray,
+        (LAYOUT_FEATURE_WIDTH, max(1, int(round(src_gray.shape[0] * scale)))),
+        interpolation=cv2.INTER_AREA,
+    )
+    keypoints, descriptors = get_orb().detectAndCompute(small, None)
+    points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2) / scale
+    return points, descriptors
+
+
+def layout_template_path(layout_dir, test_id):
+    safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", str(test_id))
+    return os.path.join(layout_dir, f"layout-{safe_id}.npz")
+
+
+def layout_template_stamp(path):
+    """(mtime_ns, size) of a layout template file, or None if there is none."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def layout_key(layout_dir, test_id):
+    """Cache key part naming the test's layout template and its version."""
+    path = layout_template_path(layout_dir, test_id)
+    stamp = layout_template_stamp(path)
+    return stamp and [path, *stamp]
+
+
+def load_layout_template(layout_dir, test_id):
+    """Template for this test from memory or disk, or None if none is cached."""
+    path = layout_template_path(layout_dir, test_id)
+    stamp = layout_template_stamp(path)
+    if stamp is None:
+        return None
+    # A template rewritten on disk replaces the one held in memory
+    if path in _LAYOUTS and _LAYOUTS[path][0] == stamp:
+        return _LAYOUTS[path][1]
+    try:
+        with np.load(path) as data:
+            template = {key: data[key] for key in data.files}
+    except (OSError, ValueError) as e:
+        logger.error(f"Ignoring unreadable layout template {path}: {str(e)}")
+        return None
+    _LAYOUTS[path] = (stamp, template)
+    return template
+
+
+def save_layout_template(layout_dir, test_id, src_gray, all_boxes):
+    """Cache the box geometry of a fully detected sheet for its test."""
+    points, descriptors = layout_features(src_gray)
+    if descriptors is None or len(points) < LAYOUT_MIN_INLIERS:
+        return
+    q_nums = sorted(all_boxes)
+    boxes = np.array([[q, *all_boxes[q]["rect"]] for q in q_nums], dtype=np.int32)
+    template = {"points": points, "descriptors": descriptors, "boxes": boxes}
+    m = LAYOUT_PATCH_MARGIN
+    for q, x, y, w, h in boxes:
+        template[f"patch_{q}"] = src_gray[
+            max(0, y - m) : y + h + m, max(0, x - m) : x + w + m
+        ].copy()
+
+    os.makedirs(layout_dir, exist_ok=True)
+    path = layout_template_path(layout_dir, test_id)
+    # Write then rename so parallel batch workers never read a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **template)
+    os.replace(tmp_path, path)
+    _LAYOUTS[path] = (layout_template_stamp(path), template)
+    diag(f"[GRADING] saved layout template for test {test_id}: {path}")
+
+
+def refine_boxes(src_gray, rects, patches, scale, search=LAYOUT_SEARCH_PX):
+    """
+    Snap each mapped rect onto this sheet by matching the template's box patch
+    (box plus LAYOUT_PATCH_MARGIN) within a few pixels of its mapped position.
+    Returns refined rects and the normalized correlation score of each match.
+    """
+    img_h, img_w = src_gray.shape[:2]
+    margin = int(round(LAYOUT_PATCH_MARGIN * scale))
+    refined = rects.copy()
+    scores = np.zeros(len(rects))
+    for i, (x, y, w, h) in enumerate(rects):
+        patch = cv2.resize(
+            patches[i], None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+        )
+        x0, y0 = max(0, x - margin - search), max(0, y - margin - search)
+        x1 = min(img_w, x + w + margin + search)
+        y1 = min(img_h, y + h + margin + search)
+        window = src_gray[y0:y1, x0:x1]
+        if window.shape[0] < patch.shape[0] or window.shape[1] < patch.shape[1]:
+            continue
+        match = cv2.matchTemplate(window, patch, cv2.TM_CCOEFF_NORMED)
+        _, best, _, loc = cv2.minMaxLoc(match)
+        refined[i, 0] = x0 + loc[0] + margin
+        refined[i, 1] = y0 + loc[1] + margin
+        scores[i] = best
+    return refined, scores
+
+
+def register_layout(src_gray, template):
+    """
+    Map the cached template boxes onto this sheet.
+    Returns all_boxes like locate_answer_boxes(), or None if registration fails.
+    """
+    points, descriptors = layout_features(src_gray)
+    if descriptors is None or len(points) < LAYOUT_MIN_INLIERS:
+        return None
+
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    matches = matcher.match(template["descriptors"], descriptors)
+    if len(matches) < LAYOUT_MIN_INLIERS:
+        return None
+
+    src_pts = template["points"][[m.queryIdx for m in matches]]
+    dst_pts = points[[m.trainIdx for m in matches]]
+    affine, inliers = cv2.estimateAffinePartial2D(
+        src_pts, dst_pts, method=cv2.RANSAC, ransacReprojThreshold=4.0
+    )
+    if affine is None or int(inliers.sum()) < LAYOUT_MIN_INLIERS:
+        return None
+
+    scale = float(np.hypot(affine[0, 0], affine[1, 0]))
+    rotation = float(np.arctan2(affine[1, 0], affine[0, 0]))
+    if not (LAYOUT_SCALE_RANGE[0] <= scale <= LAYOUT_SCALE_RANGE[1]) or (
+        abs(rotation) > LAYOUT_MAX_ROTATION
+    ):
+        return None
+
+    # Map box centres through the similarity transform and scale the sizes
+    boxes = template["boxes"].astype(np.float64)
+    centers = (
+        np.c_[
+            boxes[:, 1] + boxes[:, 3] / 2,
+            boxes[:, 2] + boxes[:, 4] / 2,
+            np.ones(len(boxes)),
+        ]
+        @ affine.T
+    )
+    sizes = boxes[:, 3:5] * scale
+    rects = np.c_[centers - sizes / 2, sizes].round().astype(np.int64)
+
+    patches = [template[f"patch_{q}"] for q in template["boxes"][:, 0]]
+    rects, scores = refine_boxes(src_gray, rects, patches, scale)
+    verified = scores >= LAYOUT_MIN_SCORE
+    if verified.mean() < LAYOUT_MIN_VERIFIED:
+        return None
+
+    return {
+        int(q): {
+            "rect": tuple(int(v) for v in rect),
+            "detected": bool(ok),
+            "orig_idx": None,
+        }
+        for q, rect, ok in zip(template["boxes"][:, 0], rects, verified)
+    }
+
+
+def locate_answer_boxes(rects_list, src_h, timer=None, spec=None, columns=None):
+    """
+    Turn raw detected rects into {q_num: {"rect", "detected", "orig_idx"}}:
+    drop false positives below the sheet, cluster into columns, infer gaps.
+    `columns` limits the layout to those spec columns (all by default).
+    """
+    timer = timer or StageTimer()
+    spec = spec or load_sheet_spec()
+    if columns is None:
+        columns = list(range(len(spec["columns"])))
+    col_sizes = [spec["columns"][c]["count"] for c in columns]
+    expected = sum(col_sizes)
+    primary_ratio, relaxed_ratio = spec["bottom_filter"]["ratios"]
+    min_kept = round(expected * spec["bottom_filter"]["min_kept"])
+    started = time.perf_counter()
+    # Prepare boxes with indices and centers
+    indexed_boxes = []
+    for idx, r in enumerate(rects_list):
+        x, y, w, h = r
+        cx = x + w / 2.0
+        cy = y + h / 2.0
+        indexed_boxes.append((idx, r, cx, cy))
+    before_filter_count = len(indexed_boxes)
+
+    # Filter out false positives detected below the bubble-sheet area
+    if src_h > 0:
+        initial_count = len(indexed_boxes)
+
+        primary_filtered = [b for b in indexed_boxes if b[3] < src_h * primary_ratio]
+        if len(primary_filtered) >= min_kept:
+            indexed_boxes = primary_filtered
+            diag(
+                f"[GRADING] bottom filter ratio={primary_ratio:.2f} kept={len(indexed_boxes)}/{initial_count}"
+            )
+        else:
+            relaxed_filtered = [
+                b for b in indexed_boxes if b[3] < src_h * relaxed_ratio
+            ]
+            if len(relaxed_filtered) >= min_kept:
+                indexed_boxes = relaxed_filtered
+                diag(
+                    f"[GRADING] bottom filter ratio={relaxed_ratio:.2f} kept={len(indexed_boxes)}/{initial_count}"
+                )
+            else:
+                diag(
+                    "[GRADING] bottom filter skipped (too few boxes kept by thresholds)"
+                )
+
+    if len(indexed_boxes) > expected:
+        indexed_boxes.sort(key=lambda b: (b[3], -(b[1][2] * b[1][3]), b[2]))
+        indexed_boxes = indexed_boxes[:expected]
+    diag(
+        f"[GRADING] rectangles before filter={before_filter_count} after filter={len(indexed_boxes)}"
+    )
+
+    if len(indexed_boxes) == 0:
+        raise GradingError("No candidate boxes detected after filtering")
+
+    # Cluster into columns
+    clustered = cluster_by_column(indexed_boxes, col_sizes)
+    timer.record("filter_cluster", time.perf_counter() - started)
+
+    # Expected structure: question numbers of each located column
+    expected_structure = {i: spec["column_questions"][c] for i, c in enumerate(columns)}
+
+    # Infer missing boxes
+    with timer.stage("inference"):
+        all_boxes = infer_missing_boxes(
+            clustered, expected_structure, spec["row_spacing"]
+        )
+    return all_boxes
+
+
+def circle_positions(all_boxes, spec=None):
+    """Bubble centres (cx, cy, r) for every located answer box."""
+    spec = spec or load_sheet_spec()
+    bubbles = spec["bubbles"]
+    n_options = len(spec["options"])
+    detected_circles_per_box = {}
+    shrink_factor = bubbles["span"]
+    rel_y = bubbles["row_offset"]
+    const_r = bubbles["radius"]
+
+    for q_num in range(1, spec["total"] + 1):
+        if q_num not in all_boxes:
+            continue
+
+        box_info = all_boxes[q_num]
+        rect = box_info["rect"]
+        x, y, w, h = rect
+
+        margin_left = int(w * bubbles["margin"])
+        anchor_rel_x = margin_left
+        raw_span = w - 2 * margin_left
+        adj_span = raw_span * shrink_factor
+        step = adj_span / max(n_options - 1, 1)
+
+        equi_rel_xs = [anchor_rel_x + i * step for i in range(n_options)]
+        centers = [(int(x + rel_x), int(y + rel_y)) for rel_x in equi_rel_xs]
+
+        # Per-question nudges, e.g. single-digit question numbers sit narrower
+        if q_num in spec["bubble_shifts"]:
+            dx, dy = spec["bubble_shifts"][q_num]
+            centers = [(cx + dx, cy + dy) for (cx, cy) in centers]
+
+        detected_circles_per_box[q_num] = [(cx, cy, const_r) for (cx, cy) in centers]
+
+    return detected_circles_per_box
+
+
+# Result cache: bump GRADER_VERSION whenever a change alters grading output so
+# stale entries stop matching.
+GRADER_VERSION = "8"
+CACHE_MAX_MB = 512
+
+
+def cache_key(buf, settings):
+    """Hash of the image bytes plus everything that influences the result."""
+    digest = hashlib.sha256()
+    # Decoded pixels (shm, stack pages) of different shapes can share bytes
+    digest.update(f"{buf.dtype}{buf.shape}".encode())
+    digest.update(buf.tobytes())
+    digest.update(
+        json.dumps({"version": GRADER_VERSION, **settings}, sort_keys=True).encode()
+    )
+    return digest.hexdigest()
+
+
+def _cache_paths(cache_dir, key):
+    entry_dir = os.path.join(cache_dir, key[:2])
+    # The image keeps a neutral suffix: its format is part of the key
+    return (
+        os.path.join(entry_dir, f"{key}.json"),
+        os.path.join(entry_dir, f"{key}.img"),
+        os.path.join(entry_dir, f"{key}.npz"),
+    )
+
+
+def cache_lookup(cache_dir, key, output_file, output_json, inline_image=False):
+    """
+    Copy a cached result to this sheet's output paths; None on a miss.
+    `output_file` is None for unrendered results, which have no cached image,
+    and for `inline_image` results, which get it as "image_b64" instead.
+    """
+    entry_json, entry_img, entry_features = _cache_paths(cache_dir, key)
+    output_features = features_path(output_json)
+    try:
+        with open(entry_json) as f:
+            summary = json.load(f)
+        if output_file is not None:
+            shutil.copyfile(entry_img, output_file)
+        elif inline_image:
+            with open(entry_img, "rb") as f:
+                image_b64 = base64.b64encode(f.read()).decode("ascii")
+        shutil.copyfile(entry_features, output_features)
+    except (OSError, ValueError):
+        return None
+
+    with open(output_json, "w") as jf:
+        json.dump(summary["answers"], jf, indent=2)
+
+    # Mark as recently used for LRU eviction
+    for path in (entry_json, entry_img, entry_features):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    summary.update(
+        output_json=output_json,
+        output_image=output_file,
+        output_features=output_features,
+        cached=True,
+    )
+    if inline_image:
+        summary["image_b64"] = image_b64
+    return summary
+
+
+def cache_store(cache_dir, key, summary, max_mb=CACHE_MAX_MB, image_bytes=None):
+    """
+    Store a fresh result and evict least recently used entries over budget.
+    `image_bytes` is the encoded image of a result that was not written to disk.
+    """
+    entry_json, entry_img, entry_features = _cache_paths(cache_dir, key)
+    try:
+        os.makedirs(os.path.dirname(entry_json), exist_ok=True)
+        # Temp + rename: concurrent batch workers may store the same key
+        tmp_suffix = f".{os.getpid()}.tmp"
+        for output_path, entry_path in (
+            (summary["output_image"], entry_img),
+            (summary["output_features"], entry_features),
+        ):
+            if output_path:
+                shutil.copyfile(output_path, entry_path + tmp_suffix)
+                os.replace(entry_path + tmp_suffix, entry_path)
+        if image_bytes is not None:
+            with open(entry_img + tmp_suffix, "wb") as f:
+                f.write(image_bytes)
+            os.replace(entry_img + tmp_suffix, entry_img)
+        stored = {
+            k: v
+            for k, v in summary.items()
+            if k not in ("output_json", "output_image", "output_features", "timings")
+        }
+        with open(entry_json + tmp_suffix, "w") as f:
+            json.dump(stored, f)
+        os.replace(entry_json + tmp_suffix, entry_json)
+    except OSError as e:
+        logger.error(f"Could not store result cache entry: {str(e)}")
+        return
+    cache_evict(cache_dir, max_mb)
+
+
+def cache_evict(cache_dir, max_mb=CACHE_MAX_MB):
+    """Delete least recently used entries until the cache fits in `max_mb`."""
+    entries = {}
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            key = os.path.splitext(name)[0]
+            size, mtime, paths = entries.get(key, (0, 0.0, []))
+            entries[key] = (size + st.st_size, max(mtime, st.st_mtime), paths + [path])
+
+    budget = max_mb * 1024 * 1024
+    total = sum(size for size, _, _ in entries.values())
+    for size, _, paths in sorted(entries.values(), key=lambda e: e[1]):
+        if total <= budget:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+
+
+# Rendering: the annotated image is optional. Its inputs are kept as a small
+# geometry document so it can be drawn later, only for sheets someone opens.
+IMAGE_FORMATS = {"jpg": "IMWRITE_JPEG_QUALITY", "webp": "IMWRITE_WEBP_QUALITY"}
+DEFAULT_IMAGE_QUALITY = {"jpg": 95, "webp": 80}
+
+
+def sheet_geometry(
+    name,
+    input_file,
+    canonical_width,
+    src_bgr,
+    variant_name,
+    rects_list,
+    grouping_rects,
+    thickness,
+    all_boxes,
+    circles_per_box,
+    answers,
+    max_check,
+    letter_index,
+    normalization=None,
+    raster_width=None,
+):
+    """JSON-serialisable description of everything drawn on the annotated image."""
+    return {
+        "name": name,
+        "source": source_label(input_file),
+        "raster_width": raster_width,
+        "canonical_width": canonical_width,
+        "normalization": normalization,
+        "image_size": [int(src_bgr.shape[1]), int(src_bgr.shape[0])],
+        "variant": variant_name,
+        "thickness": int(thickness),
+        "rects": [[int(v) for v in r] for r in rects_list],
+        "grouping_rects": [[int(v) for v in g] for g in grouping_rects],
+        "boxes": {
+            str(q): {
+                "rect": [int(v) for v in b["rect"]],
+                "detected": bool(b["detected"]),
+            }
+            for q, b in all_boxes.items()
+        },
+        "circles": {
+            str(q): [[int(v) for v in c] for c in circles]
+            for q, circles in circles_per_box.items()
+            if q <= max_check
+        },
+        "marked": {q: letter_index[a] for q, a in answers.items() if a in letter_index},
+    }
+
+
+def draw_answers(image_bgr, geometry):
+    """Circles per question (selected answer filled) and a red X on inferred boxes."""
+    boxes = geometry["boxes"]
+    for q, circles in geometry["circles"].items():
+        chosen_idx = geometry["marked"].get(q)
+
+        for i, (cx, cy, r) in enumerate(circles):
+            if i == chosen_idx:
+                # Blue fill for selected answer
+                cv2.circle(image_bgr, (cx, cy), r, (255, 0, 0), -1, cv2.LINE_AA)
+            else:
+                # Green outline for unselected
+                cv2.circle(image_bgr, (cx, cy), r, (0, 255, 0), 2, cv2.LINE_AA)
+
+        # Mark undetected boxes with red X
+        if q in boxes and not boxes[q]["detected"]:
+            x, y, w, h = boxes[q]["rect"]
+            cv2.line(image_bgr, (x, y), (x + w, y + h), (0, 0, 255), 3)
+            cv2.line(image_bgr, (x + w, y), (x, y + h), (0, 0, 255), 3)
+    return image_bgr
+
+
+def render_sheet(src_bgr, geometry, variant_image=None):
+    """Detection overlay of the winning variant plus the answer marks."""
+    if variant_image is None:
+        variant_image = (
+            preprocess_for_detection(src_bgr)
+            if geometry["variant"] == "enhanced"
+            else src_bgr
+        )
+    overlay = render_detection_overlay(
+        variant_image,
+        [tuple(r) for r in geometry["rects"]],
+        [tuple(g) for g in geometry["grouping_rects"]],
+        geometry["thickness"],
+    )
+    return draw_answers(cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR), geometry)
+
+
+def encode_image(
+    image_bgr, output_file, image_format="jpg", quality=None, preview_width=0
+):
+    """Write the image to `output_file`; with None, return the encoded bytes."""
+    if preview_width and image_bgr.shape[1] > preview_width:
+        scale = preview_width / image_bgr.shape[1]
+        image_bgr = cv2.resize(
+            image_bgr,
+            (preview_width, max(1, round(image_bgr.shape[0] * scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+    quality = quality or DEFAULT_IMAGE_QUALITY[image_format]
+    params = [getattr(cv2, IMAGE_FORMATS[image_format]), quality]
+    if output_file is None:
+        ok, encoded = cv2.imencode(f".{image_format}", image_bgr, params)
+        if not ok:
+            raise GradingError(f"Could not encode {image_format} image")
+        return encoded.tobytes()
+    if not cv2.imwrite(output_file, image_bgr, params):
+        raise GradingError(f"Could not write image: {output_file}")
+    return None
+
+
+def render_from_geometry(
+    geometry_file, output_dir=None, image_format="jpg", quality=None, preview_width=0
+):
+    """Draw the annotated image for a sheet graded with rendering skipped."""
+    with open(geometry_file) as f:
+        geometry = json.load(f)
+
+    if in_memory_source(geometry["source"]):
+        raise GradingError(
+            f"{geometry['name']} was graded from memory ({geometry['source']}); "
+            "there is no source image to render from"
+        )
+    path, stacked, page = geometry["source"].partition("#page=")
+    if stacked:
+        src_bgr = read_stack_page(path, int(page), geometry.get("raster_width"))
+        src_bgr, _ = fit_canonical_width(src_bgr, geometry["canonical_width"])
+    else:
+        src_bgr = load_sheet(
+            np.fromfile(path, dtype=np.uint8), geometry["canonical_width"]
+        )
+    if src_bgr is None:
+        raise GradingError(f"Could not decode image: {geometry['source']}")
+    src_bgr = apply_normalization(src_bgr, geometry.get("normalization"))
+    if [src_bgr.shape[1], src_bgr.shape[0]] != geometry["image_size"]:
+        raise GradingError(
+            f"Source image size {src_bgr.shape[1]}x{src_bgr.shape[0]} does not match "
+            f"the graded {geometry['image_size'][0]}x{geometry['image_size'][1]}"
+        )
+
+    output_dir = output_dir or os.path.dirname(os.path.abspath(geometry_file))
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = os.path.join(output_dir, f"{geometry['name']}.{image_format}")
+    encode_image(
+        render_sheet(src_bgr, geometry),
+        output_file,
+        image_format,
+        quality,
+        preview_width,
+    )
+    diag(f"Output saved: {output_file}")
+    return output_file
+
+
+def write_sidecar(path, data, what):
+    try:
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+    except OSError as e:
+        logger.error(f"Could not write {what}: {str(e)}")
+
+
+# Stored features: the (blended, mean, p25) darkness of every bubble read,
+# so the marking strategies can be reapplied (--rescore) without the image.
+# Values stay float64: rescoring with the default factors must reproduce the
+# graded answers exactly, and compressed they are a few KB per sheet.
+FEATURES_SUFFIX = ".features.npz"
+FEATURES_FORMAT = 1
+
+
+def write_features(path, features, circles_per_box, answers, options, enhanced=()):
+    """
+    Save bubble_features() output with the circle geometry it was sampled at.
+    `answers` are the graded letters for questions 1..n, `options` the
+    spec's letters by circle index, `enhanced` the questions read on the
+    contrast-enhanced variant.
+    """
+    q_nums = sorted(features)
+
+    def flat(i):
+        return np.concatenate([features[q][i] for q in q_nums] or [np.zeros(0)])
+
+    try:
+        np.savez_compressed(
+            path,
+            format=np.int16(FEATURES_FORMAT),
+            questions=np.array(q_nums, dtype=np.int16),
+            counts=np.array([len(features[q][0]) for q in q_nums], dtype=np.int16),
+            circles=np.array(
+                [c for q in q_nums for c in circles_per_box[q]], dtype=np.int32
+            ).reshape(-1, 3),
+            blended=flat(0),
+            mean=flat(1),
+            p25=flat(2),
+            enhanced=np.array([str(q) in enhanced for q in q_nums], dtype=bool),
+            answers=np.array(list(answers.values()), dtype=str),
+            options=np.array(list(options), dtype=str),
+        )
+    except OSError as e:
+        logger.error(f"Could not write features: {str(e)}")
+
+
+def load_features(path):
+    """
+    Read a write_features() file back: {"features": {q: (blended, mean, p25)},
+    "answers": graded letters for questions 1..n, "letters": circle index ->
+    letter, "enhanced": questions read on the enhanced variant}.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        stored = {name: data[name] for name in data.files}
+    if int(stored.get("format", 0)) != FEATURES_FORMAT:
+        raise GradingError(f"Unsupported features file: {path}")
+
+    features = {}
+    start = 0
+    for q, count in zip(stored["questions"].tolist(), stored["counts"].tolist()):
+        end = start + count
+        features[q] = tuple(stored[k][start:end] for k in ("blended", "mean", "p25"))
+        start = end
+    return {
+        "features": features,
+        "answers": stored["answers"].tolist(),
+        "letters": dict(enumerate(stored["options"].tolist())),
+        "enhanced": stored["questions"][stored["enhanced"]].tolist(),
+    }
+
+
+def find_answer_boxes(
+    src_bgr,
+    src_gray,
+    spec,
+    check_n,
+    grid_crop,
+    early_exit_penalty,
+    detect_threads,
+    engine,
+    timer,
+):
+    """
+    Box search for one sheet: (all_boxes, rects, grouping rects, thickness,
+    variant image, variant name, preset name). Raises GradingError when no
+    candidate is found.
+    """
+    # Search only the answer grid and, for short quizzes, only the
+    # columns that hold questions 1..n
+    columns = spec_columns(spec, check_n or 0)
+    expected = sum(spec["columns"][c]["count"] for c in columns)
+    src_h, src_w = src_gray.shape[:2]
+    region = None
+    if grid_crop:
+        with timer.stage("locate_grid"):
+            region = locate_answer_grid(src_gray)
+        if region is None:
+            diag("[GRADING] answer grid not found, searching the full page")
+    crop = column_crop(spec, columns, src_w)
+    if crop is not None:
+        x0, y0, x1, y1 = region or (0, 0, src_w, src_h)
+        region = (max(x0, crop[0]), y0, min(x1, crop[1]), y1)
+        diag(f"[GRADING] n={check_n}: searching columns {columns}")
+    if region is not None and region[2] > region[0]:
+        diag(
+            f"[GRADING] box search region x={region[0]}..{region[2]} y={region[1]}..{region[3]}"
+        )
+        with timer.stage("detect"):
+            detected = detect_in_region(
+                src_bgr,
+                region,
+                early_exit_penalty,
+                detect_threads,
+                timer,
+                expected,
+                engine,
+            )
+        if detected[6] < round(expected * spec["bottom_filter"]["min_kept"]):
+            diag("[GRADING] region search came up short, searching the full page")
+            region = None
+    else:
+        region = None
+    if region is None:
+        columns = spec_columns(spec)
+        with timer.stage("detect"):
+            detected = detect_boxes_with_fallback(
+                src_bgr,
+                early_exit_penalty,
+                detect_threads,
+                timer,
+                spec["total"],
+                engine,
+            )
+    (
+        rects_list,
+        grouping_rects,
+        thickness,
+        variant_image,
+        variant_name,
+        preset_name,
+        preset_rect_count,
+    ) = detected
+    diag(
+        f"[GRADING] selected variant={variant_name} preset={preset_name} with {preset_rect_count} rectangles"
+    )
+    if variant_name == "none":
+        raise GradingError("Box detection returned no output image")
+    all_boxes = locate_answer_boxes(rects_list, src_bgr.shape[0], timer, spec, columns)
+    return (
+        all_boxes,
+        rects_list,
+        grouping_rects,
+        thickness,
+        variant_image,
+        variant_name,
+        preset_name,
+    )
+
+
+def grade_sheet(
+    input_file,
+    output_dir,
+    test_id,
+    student_id,
+    check_n,
+    early_exit_penalty=EARLY_EXIT_PENALTY,
+    detect_threads=0,
+    layout_dir=None,
+    canonical_width=0,
+    cache_dir=None,
+    cache_max_mb=CACHE_MAX_MB,
+    refresh_cache=False,
+    render=True,
+    image_format="jpg",
+    image_quality=None,
+    preview_width=0,
+    sheet_spec=DEFAULT_SHEET_SPEC,
+    grid_crop=True,
+    normalize=True,
+    engine="boxdetect",
+    min_confidence=0.0,
+    inline_image=False,
+    image=None,
+    data=None,
+    raster_width=None,
+):
+    """
+    Grade a single bubble sheet and write `{test}-{student}.json`/`.jpg`.
+    Returns a summary dict; raises FileNotFoundError or GradingError on failure.
+    With `cache_dir`, byte-identical scans graded with the same settings are
+    served from the result cache; `refresh_cache` regrades and overwrites.
+    Per-stage timings are returned under "timings" and written to
+    `{test}-{student}.timings.json`. The drawing geometry is returned under
+    "geometry" and written to `{test}-{student}.geometry.json`; with
+    `render=False` no image is produced and "output_image" is None. Bubble
+    darkness features go to `{test}-{student}.features.npz` for --rescore.
+    `sheet_spec` names the printed layout; only the columns holding questions
+    1..check_n are searched for boxes, and with `grid_crop` only inside the
+    located answer grid. With `normalize`, rotated, skewed and photographed
+    sheets are turned upright first (see normalize_sheet()). `engine` picks
+    the box detector ("contour" tries the contour engine before boxdetect).
+    Every answer gets a 0..1 confidence under "confidence". With
+    `min_confidence`, sheets with undetected boxes or a low mean confidence
+    get a full box search, doubtful questions are re-read on the enhanced variant, and the
+    ones still doubtful are listed under "review".
+    With `inline_image` the annotated image is not written but returned
+    base64-encoded under "image_b64".
+    `image` grades an already decoded BGR page (a stack page, shared memory)
+    and `data` the encoded bytes of a scan (stdin); then `input_file` only
+    names the source ("-", "shm:NAME" or the page's path#page=N).
+    `raster_width` is the width a PDF stack page was rasterised at, kept in
+    the geometry so a deferred render rasterises the page identically.
+    """
+    timer = StageTimer()
+    spec = load_sheet_spec(sheet_spec)
+    if data is not None and not len(data):
+        raise GradingError(f"No image bytes received for {input_file}")
+    if image is None and data is None and not os.path.exists(input_file):
+        raise FileNotFoundError(f"Input file not found: {input_file}")
+
+    output_file, output_json = prepare_outputs(
+        input_file, output_dir, test_id, student_id, image_format
+    )
+    inline_image = render and inline_image
+    if not render or inline_image:
+        output_file = None
+
+    # Inputs are checked; now pay for the heavy imports (once per process)
+    load_module("numpy")
+    load_module("cv2")
+
+    diag(f"Processing file: {input_file}")
+    # Read once: the bytes feed both the cache key and the decoder
+    if image is not None:
+        buf = image
+    elif data is not None:
+        buf = np.frombuffer(data, dtype=np.uint8)
+    else:
+        with timer.stage("read"):
+            buf = np.fromfile(input_file, dtype=np.uint8)
+
+    key = None
+    if cache_dir:
+        with timer.stage("cache"):
+            key = cache_key(
+                buf,
+                {
+                    "n": min(check_n or 0, spec["total"]),
+                    # The whole spec: an edited spec file must not hit
+                    "sheet_spec": spec,
+                    "grid_crop": grid_crop,
+                    "normalize": normalize,
+                    "engine": engine,
+                    "min_confidence": min_confidence,
+                    "early_exit_penalty": early_exit_penalty,
+                    "canonical_width": canonical_width,
+                    # Which template registers the sheet, if any
+                    "layout": layout_dir and layout_key(layout_dir, test_id),
+                    "render": render and [image_format, image_quality, preview_width],
+                },
+            )
+            cached = None
+            if not refresh_cache:
+                cached = cache_lookup(
+                    cache_dir, key, output_file, output_json, inline_image
+                )
+        if cached is not None:
+            diag(f"[GRADING] result cache hit {key[:12]}: {output_json}")
+            # The entry may come from another student's identical scan
+            cached["geometry"]["source"] = source_label(input_file)
+            cached["geometry"]["name"] = f"{test_id}-{student_id}"
+            cached["geometry"]["raster_width"] = raster_width
+            cached["timings"] = timer.as_dict(variant="cache", preset="hit")
+            write_sidecar(geometry_path(output_json), cached["geometry"], "geometry")
+            write_sidecar(timings_path(output_json), cached["timings"], "timings")
+            return cached
+
+    # Decode once; detection, answer reading and drawing all share this array
+    with timer.stage("decode"):
+        if image is None:
+            src_bgr = load_sheet(buf, canonical_width)
+        else:
+            src_bgr, _ = fit_canonical_width(image, canonical_width)
+    if src_bgr is None:
+        raise GradingError(f"Could not decode image: {input_file}")
+
+    transform = None
+    if normalize:
+        with timer.stage("normalize"):
+            src_bgr, transform = normalize_sheet(src_bgr, spec.get("grid_width", 0))
+        if transform is not None:
+            diag(
+                f"[GRADING] normalized sheet: rotate={transform.get('rotate', 'none')} "
+                f"warp shift={transform.get('shift', 0)}px"
+            )
+
+    # Layout template registration replaces the box search when it succeeds
+    src_gray = cv2.cvtColor(src_bgr, cv2.COLOR_BGR2GRAY)
+    all_boxes = None
+    template = load_layout_template(layout_dir, test_id) if layout_dir else None
+    if template is not None:
+        with timer.stage("register"):
+            all_boxes = register_layout(src_gray, template)
+        if all_boxes is None:
+            diag("[GRADING] layout registration failed, running full box search")
+
+    if all_boxes is not None:
+        variant_name, preset_name = "template", "registered"
+        rects_list = [b["rect"] for b in all_boxes.values() if b["detected"]]
+        grouping_rects, thickness, variant_image = [], 2, src_bgr
+        diag(
+            f"[GRADING] registered layout for test {test_id}: {len(rects_list)} boxes verified"
+        )
+    else:
+        (
+            all_boxes,
+            rects_list,
+            grouping_rects,
+            thickness,
+            variant_image,
+            variant_name,
+            preset_name,
+        ) = find_answer_boxes(
+            src_bgr,
+            src_gray,
+            spec,
+            check_n,
+            grid_crop,
+            early_exit_penalty,
+            detect_threads,
+            engine,
+            timer,
+        )
+
+    diag(f"[GRADING] image size: {src_bgr.shape[1]}x{src_bgr.shape[0]}")
+
+    detected_box_count = len([b for b in all_boxes.values() if b["detected"]])
+    diag(f"[GRADING] detected boxes after inference: {detected_box_count}")
+
+    if detected_box_count == 0:
+        raise GradingError("No answer boxes detected after inference")
+
+    if layout_dir and template is None and detected_box_count == spec["total"]:
+        save_layout_template(layout_dir, test_id, src_gray, all_boxes)
+
+    with timer.stage("circles"):
+        detected_circles_per_box = circle_positions(all_boxes, spec)
+
+    if not (check_n and check_n > 0):
+        raise GradingError("No output image generated or n questions was not provided")
+
+    # Answer detection: every readable question in one vectorized pass
+    max_check = min(check_n, spec["total"])
+    questions = range(1, max_check + 1)
+    with timer.stage("answers"):
+        json_results, confidence, features = read_answers(
+            src_gray, all_boxes, detected_circles_per_box, questions, spec["letters"]
+        )
+
+    # Tiered grading: the slow paths only run for doubtful sheets/questions
+    tier = "fast"
+    rechecked = []
+    if min_confidence > 0:
+        # Undetected boxes or a doubtful sheet overall mean the boxes
+        # themselves are suspect: redo the search on the full page
+        undetected = sum(
+            not all_boxes.get(q, {"detected": False})["detected"] for q in questions
+        )
+        mean_confidence = sum(confidence.values()) / max_check
+        if undetected or mean_confidence < min_confidence:
+            diag(
+                f"[GRADING] {undetected} undetected boxes, mean confidence {mean_confidence:.2f}: full box search"
+            )
+            try:
+                found = find_answer_boxes(
+                    src_bgr,
+                    src_gray,
+                    spec,
+                    check_n,
+                    False,
+                    0,
+                    detect_threads,
+                    "boxdetect",
+                    timer,
+                )
+            except GradingError as e:
+                # The escalation may only improve on the fast path's answers
+                diag(f"[GRADING] full box search failed, keeping the fast result: {e}")
+                found = None
+            if found is not None:
+                with timer.stage("circles"):
+                    circles = circle_positions(found[0], spec)
+                with timer.stage("answers"):
+                    answers, scores, found_features = read_answers(
+                        src_gray, found[0], circles, questions, spec["letters"]
+                    )
+                if sum(scores.values()) > sum(confidence.values()):
+                    tier = "redetected"
+                    (
+                        all_boxes,
+                        rects_list,
+                        grouping_rects,
+                        thickness,
+                        variant_image,
+                        variant_name,
+                        preset_name,
+                    ) = found
+                    detected_circles_per_box, json_results, confidence, features = (
+                        circles,
+                        answers,
+                        scores,
+                        found_features,
+                    )
+                    detected_box_count = sum(b["detected"] for b in all_boxes.values())
+
+        low = [q for q, c in confidence.items() if c < min_confidence]
+        if low:
+            # Faint marks separate better on the contrast-enhanced variant
+            with timer.stage("recheck"):
+                enhanced = cv2.cvtColor(
+                    preprocess_for_detection(src_bgr), cv2.COLOR_BGR2GRAY
+                )
+                answers, scores, enhanced_features = read_answers(
+                    enhanced,
+                    all_boxes,
+                    detected_circles_per_box,
+                    [int(q) for q in low],
+                    spec["letters"],
+                )
+            for q in low:
+                if scores[q] > confidence[q]:
+                    json_results[q], confidence[q] = answers[q], scores[q]
+                    features[int(q)] = enhanced_features[int(q)]
+                    rechecked.append(q)
+
+    geometry = sheet_geometry(
+        f"{test_id}-{student_id}",
+        input_file,
+        canonical_width,
+        src_bgr,
+        variant_name,
+        rects_list,
+        grouping_rects,
+        thickness,
+        all_boxes,
+        detected_circles_per_box,
+        json_results,
+        max_check,
+        spec["letter_index"],
+        transform,
+        raster_width,
+    )
+
+    output_features = features_path(output_json)
+    with timer.stage("write_json"):
+        with open(output_json, "w") as jf:
+            json.dump(json_results, jf, indent=2)
+        write_sidecar(geometry_path(output_json), geometry, "geometry")
+        write_features(
+            output_features,
+            features,
+            detected_circles_per_box,
+            json_results,
+            spec["options"],
+            rechecked,
+        )
+
+    image_bytes = None
+    if render:
+        with timer.stage("draw"):
+            output_image_bgr = render_sheet(src_bgr, geometry, variant_image)
+        with timer.stage("encode"):
+            image_bytes = encode_image(
+                output_image_bgr,
+                output_file,
+                image_format,
+                image_quality,
+                preview_width,
+            )
+    diag(f"Detected {detected_box_count} out of {spec['total']} boxes")
+    diag(f"Output saved: {output_file or output_json}")
+
+    box_states = {}
+    for box_num in range(1, max_check + 1):
+        box_info = all_boxes.get(box_num)
+        if box_info is None:
+            box_states[str(box_num)] = "missing"
+        else:
+            box_states[str(box_num)] = (
+                "detected" if box_info["detected"] else "inferred"
+            )
+
+    summary = {
+        "answers": json_results,
+        "boxes": box_states,
+        "output_json": output_json,
+        "output_image": output_file,
+        "output_features": output_features,
+        "detected_boxes": detected_box_count,
+        "variant": variant_name,
+        "preset": preset_name,
+        "confidence": confidence,
+        "geometry": geometry,
+    }
+    if min_confidence > 0:
+        summary["tier"] = tier
+        summary["rechecked"] = rechecked
+        summary["review"] = [q for q, c in confidence.items() if c < min_confidence]
+    if key is not None:
+        with timer.stage("cache"):
+            cache_store(cache_dir, key, summary, cache_max_mb, image_bytes)
+    if inline_image:
+        summary["image_b64"] = base64.b64encode(image_bytes).decode("ascii")
+    summary["timings"] = timer.as_dict(variant=variant_name, preset=preset_name)
+    write_sidecar(timings_path(output_json), summary["timings"], "timings")
+    return summary
+
+
+def job_image(job):
+    """
+    In-memory image of a job: (encoded bytes from "image_b64", decoded page
+    from "shm" + "shape"); (None, None) when the job names a file.
+    """
+    data = image = None
+    if job.get("image_b64") is not None:
+        data = base64.b64decode(job["image_b64"], validate=True)
+    if job.get("shm"):
+        image = read_shared_image(job["shm"], job.get("shape"))
+    return data, image
+
+
+def run_job(
+    job, default_output_dir=None, default_n=0, options=None, image=None, data=None
+):
+    """
+    Grade one job dict and return a JSON-serialisable response.
+    `options` are extra grade_sheet() keyword arguments shared by all jobs;
+    `image` is a decoded page and `data` encoded image bytes to grade instead
+    of reading `input`.
+
+    Job fields: input, test_id, student_id, n (optional), output (optional), id (optional).
+    Instead of an input file: image_b64 (encoded image bytes, base64) or
+    shm + shape (raw pixels in shared memory, see read_shared_image()).
+    inline_image (optional) overrides --inline-image for this job.
+    Failures from unexpected errors say whether a retry may succeed ("retryable").
+    Diagnostics are redirected to stderr so stdout only carries results.
+    """
+    job_id = job.get("id") if isinstance(job, dict) else None
+    try:
+        if not isinstance(job, dict):
+            raise GradingError("Job is not a JSON object")
+        output_dir = job.get("output") or default_output_dir
+        if not output_dir:
+            raise GradingError("Job has no output directory")
+        if image is None and data is None:
+            data, image = job_image(job)
+        input_file = job.get("input")
+        if not input_file:
+            if image is None and data is None:
+                raise GradingError("Job has no input")
+            input_file = f"shm:{job['shm']}" if job.get("shm") else "-"
+        if "inline_image" in job:
+            options = {**(options or {}), "inline_image": bool(job["inline_image"])}
+        with contextlib.redirect_stdout(sys.stderr):
+            result = grade_sheet(
+                input_file,
+                output_dir,
+                job["test_id"],
+                job["student_id"],
+                int(job.get("n", default_n) or 0),
+                image=image,
+                data=data,
+                **(options or {}),
+            )
+        return {"id": job_id, "ok": True, **result}
+    except FileNotFoundError as e:
+        logger.error(str(e))
+        return {"id": job_id, "ok": False, "error": str(e)}
+    except Exception as e:
+        logger.error(f"Error processing job: {str(e)}")
+        # Ungradeable sheets fail the same way every time; anything else
+        # (I/O, memory) may pass on another attempt
+        retryable = not isinstance(e, (GradingError, KeyError, ValueError))
+        return {"id": job_id, "ok": False, "error": str(e), "retryable": retryable}
+
+
+def run_worker(default_output_dir=None, default_n=0, options=None):
+    """
+    Long-lived worker: read one JSON job per line from stdin and write one JSON
+    result per line to stdout. Imports, CLAHE and presets stay warm across jobs.
+    """
+    out = sys.stdout
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            logger.error(f"Invalid job line: {str(e)}")
+            response = {"id": None, "ok": False, "error": f"Invalid job: {str(e)}"}
+        else:
+            response = run_job(job, default_output_dir, default_n, options)
+
+        out.write(dump_result(response))
+        out.flush()
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+
+def available_cpus():
+    """CPU count honouring the container's cgroup quota and the affinity mask."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            q, period = f.read().split()[:2]
+            if q != "max":
+                quota = int(q) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                q = int(f.read().strip())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read().strip())
+            if q > 0 and period > 0:
+                quota = q / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota)))
+    return max(1, cpus)
+
+
+def load_batch_jobs(source, test_id=None, n=0):
+    """
+    Build job dicts from a manifest (.json list or JSON lines) or a directory.
+
+    Manifest entries: {"input"|"image", "test_id", "student_id", "n", "output"};
+    in-memory entries give "image_b64" or "shm" + "shape" instead (see run_job()).
+    For a directory, every image is a sheet of `test_id` and the student ID is
+    taken from the first number in the file name (falling back to the stem).
+    """
+    jobs = []
+    if os.path.isdir(source):
+        if not test_id:
+            raise GradingError("Directory batches need -t/--test")
+        for name in sorted(os.listdir(source)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            digits = "".join(ch if ch.isdigit() else " " for ch in stem).split()
+            jobs.append(
+                {
+                    "input": os.path.join(source, name),
+                    "test_id": test_id,
+                    "student_id": digits[0] if digits else stem,
+                }
+            )
+    else:
+        with open(source) as f:
+            raw = f.read()
+        stripped = raw.lstrip()
+        if stripped.startswith("["):
+            entries = json.loads(stripped)
+        else:
+            entries = [json.loads(line) for line in raw.splitlines() if line.strip()]
+        base_dir = os.path.dirname(os.path.abspath(source))
+        for idx, entry in enumerate(entries, 1):
+            if not isinstance(entry, dict):
+                raise GradingError(f"Manifest entry {idx} is not an object")
+            job = dict(entry)
+            if "input" not in job and "image" in job:
+                job["input"] = job.pop("image")
+            job.setdefault("test_id", test_id)
+            if job.get("input") and not os.path.isabs(job["input"]):
+                job["input"] = os.path.join(base_dir, job["input"])
+            jobs.append(job)
+
+    for idx, job in enumerate(jobs):
+        job.setdefault("id", idx)
+        job.setdefault("n", n)
+    return jobs
+
+
+# Batch memory budget: resident memory is read from /proc (Linux); where that
+# is unavailable the budget is not enforced.
+_LIBC = None
+
+
+def process_rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def tree_rss_mb(pid=None):
+    """Resident memory of a process plus all of its descendants, in MB."""
+    pid = pid or os.getpid()
+    total = process_rss_mb(pid)
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return total
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children = [int(c) for c in f.read().split()]
+        except (OSError, ValueError):
+            continue
+        total += sum(tree_rss_mb(child) for child in children)
+    return total
+
+
+def peak_rss_mb():
+    """Largest resident set of this process or any child it has reaped, in MB."""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024.0
+
+
+def release_memory():
+    """Free a finished sheet's buffers now and hand the heap back to the OS."""
+    global _LIBC
+    gc.collect()
+    if _LIBC is None:
+        try:
+            import ctypes
+
+            _LIBC = ctypes.CDLL("libc.so.6")
+        except (OSError, ImportError):
+            _LIBC = False
+    if _LIBC:
+        _LIBC.malloc_trim(0)
+
+
+def run_pool_job(job, output_dir, n, options, data=None):
+    """run_job() in a grading_pool() process, handing freed memory back after."""
+    response = run_job(job, output_dir, n, options, data=data)
+    release_memory()
+    return response
+
+
+def _init_batch_process(verbosity):
+    global VERBOSITY
+    VERBOSITY = verbosity
+    # One sheet per process: keep OpenCV from spawning its own thread pool
+    # on every core and oversubscribing the CPUs the pool already uses.
+    cv2.setNumThreads(1)
+
+
+def grading_pool(workers):
+    """Process pool of `workers` grading processes (see run_pool_job())."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_batch_process,
+        initargs=(VERBOSITY,),
+    )
+
+
+def run_batch(
+    source,
+    output_dir=None,
+    test_id=None,
+    n=0,
+    jobs_count=0,
+    options=None,
+    max_rss_mb=0,
+):
+    """
+    Grade many sheets in parallel with a process pool.
+    At most one sheet per worker is queued at a time; with `max_rss_mb`, no
+    new sheet starts while the batch's processes together exceed that budget
+    (one sheet always keeps running). Each result is written as one JSON line
+    on stdout as soon as it finishes. Returns the number of failed sheets.
+    """
+    from collections import deque
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    jobs = deque(load_batch_jobs(source, test_id, n))
+    total = len(jobs)
+    workers = min(jobs_count or available_cpus(), max(1, total))
+    budget = f", RSS budget {max_rss_mb:.0f} MB" if max_rss_mb else ""
+    diag(
+        f"[GRADING] batch of {total} sheets with {workers} worker processes{budget}",
+        file=sys.stderr,
+    )
+
+    failed = 0
+    throttled_s = 0.0
+    peak_total = 0.0
+    in_flight = set()
+    with grading_pool(workers) as pool:
+        while jobs or in_flight:
+            rss = tree_rss_mb()
+            peak_total = max(peak_total, rss)
+            held = False
+            while jobs and len(in_flight) < workers:
+                if max_rss_mb and in_flight and rss >= max_rss_mb:
+                    held = True
+                    break
+                in_flight.add(
+                    pool.submit(run_pool_job, jobs.popleft(), output_dir, n, options)
+                )
+
+            # Short timeout: keeps RSS sampled while long sheets are running
+            waited = time.perf_counter()
+            done, in_flight = wait(in_flight, timeout=0.25, return_when=FIRST_COMPLETED)
+            if held:
+                throttled_s += time.perf_counter() - waited
+            for future in done:
+                response = future.result()
+                if not response["ok"]:
+                    failed += 1
+                sys.stdout.write(dump_result(response))
+                sys.stdout.flush()
+
+    diag(
+        f"[GRADING] batch finished: {total - failed} ok, {failed} failed",
+        file=sys.stderr,
+    )
+    diag(
+        f"[GRADING] batch peak RSS: {peak_total:.0f} MB across processes (sampled), "
+        f"{peak_rss_mb():.0f} MB largest process; throttled for {throttled_s:.1f} s",
+        file=sys.stderr,
+    )
+    return failed
+
+
+# Multi-page stacks: one scanned PDF or multi-page TIFF per stack of sheets.
+# A reader thread rasterises pages one at a time and stays at most
+# STACK_QUEUE_PAGES ahead of grading, so memory does not grow with the stack.
+STACK_QUEUE_PAGES = 2
+PDF_EXTENSIONS = (".pdf",)
+
+
+def _pdf_module():
+    try:
+        import pymupdf
+    except ImportError:
+        raise GradingError("PDF stacks need PyMuPDF (pip install pymupdf)")
+    return pymupdf
+
+
+def _pdf_raster_width(page, page_width):
+    # Sheets are portrait: a landscape page is a sideways sheet that
+    # normalize_sheet() turns upright, so its height is what becomes the width
+    width, height = page.rect.width, page.rect.height
+    return page_width * width / height if width > height else page_width
+
+
+def _rasterize_pdf_page(pymupdf, page, raster_width):
+    zoom = raster_width / page.rect.width
+    pix = page.get_pixmap(
+        matrix=pymupdf.Matrix(zoom, zoom), colorspace=pymupdf.csRGB, alpha=False
+    )
+    rgb = (
+        np.frombuffer(pix.samples, dtype=np.uint8)
+        .reshape(pix.height, pix.stride)[:, : pix.width * pix.n]
+        .reshape(pix.height, pix.width, pix.n)
+    )
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+
+def _tiff_page(path, index):
+    ok, pages = cv2.imreadmulti(path, start=index, count=1, flags=cv2.IMREAD_COLOR)
+    if not ok or not pages:
+        raise GradingError(f"Could not decode page {index + 1} of {path}")
+    return pages[0]
+
+
+def iter_stack_pages(path, page_width=CANONICAL_SHEET_WIDTH):
+    """
+    Yield (page number, BGR page, raster width) for a PDF or multi-page TIFF,
+    one page at a time. PDF pages are rasterised straight to `page_width` once
+    upright (sideways pages by their height); the raster width is None for
+    TIFF pages, which are decoded as stored.
+    """
+    if os.path.splitext(path)[1].lower() in PDF_EXTENSIONS:
+        pymupdf = _pdf_module()
+        with pymupdf.open(path) as doc:
+            for index, page in enumerate(doc):
+                raster_width = _pdf_raster_width(page, page_width)
+                image = _rasterize_pdf_page(pymupdf, page, raster_width)
+                yield index + 1, image, raster_width
+        return
+
+    count = cv2.imcount(path)
+    if count <= 0:
+        raise GradingError(f"Could not read pages of {path}")
+    for index in range(count):
+        yield index + 1, _tiff_page(path, index), None
+
+
+def read_stack_page(path, page_number, raster_width=None):
+    """
+    A single page (1-based) of a stack; PDF pages are rasterised at the
+    `raster_width` iter_stack_pages() reported for them.
+    """
+    if os.path.splitext(path)[1].lower() in PDF_EXTENSIONS:
+        pymupdf = _pdf_module()
+        with pymupdf.open(path) as doc:
+            page = doc[page_number - 1]
+            raster_width = raster_width or _pdf_raster_width(
+                page, CANONICAL_SHEET_WIDTH
+            )
+            return _rasterize_pdf_page(pymupdf, page, raster_width)
+    return _tiff_page(path, page_number - 1)
+
+
+def load_stack_students(value):
+    """
+    --students: page number -> student ID. A JSON list of student IDs in page
+    order or an object mapping page numbers to student IDs, given inline or
+    as a .json file.
+    """
+    try:
+        if value.endswith(".json") or os.path.isfile(value):
+            with open(value) as f:
+                entries = json.load(f)
+        else:
+            entries = json.loads(value)
+        if isinstance(entries, list):
+            return {page: str(sid) for page, sid in enumerate(entries, start=1)}
+        return {int(page): str(sid) for page, sid in entries.items()}
+    except (OSError, ValueError, AttributeError) as e:
+        raise GradingError(f"Invalid student mapping: {str(e)}")
+
+
+def run_stack(stack_path, output_dir, test_id, n=0, students=None, options=None):
+    """
+    Grade every page of a multi-page PDF/TIFF while the next pages are being
+    rasterised. Pages map to students through `students` (page -> ID) or, by
+    default, to their page number. One JSON line per page on stdout; returns
+    the number of failed pages.
+    """
+    options = options or {}
+    stack_abs = os.path.abspath(stack_path)
+    if not os.path.exists(stack_abs):
+        raise GradingError(f"Stack not found: {stack_path}")
+    page_width = options.get("canonical_width") or CANONICAL_SHEET_WIDTH
+    pages = queue.Queue(maxsize=STACK_QUEUE_PAGES)
+
+    def read_pages():
+        try:
+            for page in iter_stack_pages(stack_abs, page_width):
+                pages.put(page)
+        except Exception as e:
+            pages.put(e)
+        else:
+            pages.put(None)
+
+    threading.Thread(target=read_pages, daemon=True).start()
+
+    graded = failed = 0
+    while True:
+        item = pages.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            logger.error(f"Cannot read stack: {str(item)}")
+            sys.stdout.write(dump_result({"id": None, "ok": False, "error": str(item)}))
+            failed += 1
+            break
+
+        page_number, image, raster_width = item
+        student_id = (
+            students.get(page_number) if students is not None else str(page_number)
+        )
+        if student_id is None:
+            response = {
+                "id": page_number,
+                "ok": False,
+                "error": f"No student for page {page_number}",
+            }
+        else:
+            job = {
+                "id": page_number,
+                "input": f"{stack_abs}#page={page_number}",
+                "test_id": test_id,
+                "student_id": student_id,
+            }
+            page_options = {**options, "raster_width": raster_width}
+            response = run_job(job, output_dir, n, page_options, image=image)
+        # Drop the page before waiting for the next one
+        del item, image
+        release_memory()
+        response["page"] = page_number
+        graded += 1
+        if not response["ok"]:
+            failed += 1
+        sys.stdout.write(dump_result(response))
+        sys.stdout.flush()
+
+    diag(
+        f"[GRADING] stack finished: {graded - failed} ok, {failed} failed, "
+        f"peak RSS {peak_rss_mb():.0f} MB",
+        file=sys.stderr,
+    )
+    return failed
+
+
+def load_decision_factors(value):
+    """--factors: a JSON object, or a .json file, overriding DECISION_FACTORS."""
+    try:
+        if value.endswith(".json"):
+            with open(value) as f:
+                factors = json.load(f)
+        else:
+            factors = json.loads(value)
+    except (OSError, ValueError) as e:
+        raise GradingError(f"Invalid decision factors: {str(e)}")
+    if not isinstance(factors, dict):
+        raise GradingError("Decision factors must be a JSON object")
+    unknown = sorted(set(factors) - set(DECISION_FACTORS))
+    if unknown:
+        raise GradingError(f"Unknown decision factor(s): {', '.join(unknown)}")
+    for name, value in factors.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise GradingError(f"Decision factor {name} must be a number")
+    return factors
+
+
+def features_files(source):
+    """A features file, or every *.features.npz under a directory (sorted)."""
+    if not os.path.isdir(source):
+        if not os.path.exists(source):
+            raise FileNotFoundError(f"Features not found: {source}")
+        return [source]
+    paths = []
+    for root, _, files in os.walk(source):
+        paths.extend(
+            os.path.join(root, name) for name in files if name.endswith(FEATURES_SUFFIX)
+        )
+    return sorted(paths)
+
+
+def rescore_sheet(path, factors=None, min_confidence=0.0):
+    """
+    Reapply the marking strategies to one stored features file, optionally
+    with other `factors`. Questions read on the enhanced variant are rescored
+    from those readings; boxes that were never read stay "-".
+    Returns answers, confidences and the answers that changed ({q: [old, new]}).
+    """
+    stored = load_features(path)
+    letters, scores = answers_from_features(
+        stored["features"], letter_map=stored["letters"], factors=factors
+    )
+    answers = {}
+    confidence = {}
+    for q in range(1, len(stored["answers"]) + 1):
+        answers[str(q)] = letters.get(q, "-")
+        confidence[str(q)] = scores.get(q, 0.0)
+    changed = {
+        q: [old, answers[q]]
+        for q, old in zip(answers, stored["answers"])
+        if old != answers[q]
+    }
+    result = {"answers": answers, "confidence": confidence, "changed": changed}
+    if min_confidence > 0:
+        result["review"] = [q for q, c in confidence.items() if c < min_confidence]
+    return result
+
+
+def run_rescore(source, output_dir=None, factors=None, min_confidence=0.0):
+    """
+    Rescore stored features (a file or a directory tree of them) without
+    decoding any image. One JSON line per sheet goes to stdout; with
+    `output_dir` the rescored answers are also written as `{test}-{student}.json`;
+    diagnostics go to stderr.
+    Returns the number of sheets that failed.
+    """
+    paths = features_files(source)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    failed = changed = 0
+    for path in paths:
+        response = {"input": path}
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                result = rescore_sheet(path, factors, min_confidence)
+            if output_dir:
+                name = os.path.basename(path)[: -len(FEATURES_SUFFIX)]
+                output_json = os.path.join(output_dir, f"{name}.json")
+                with open(output_json, "w") as jf:
+                    json.dump(result["answers"], jf, indent=2)
+                response["output_json"] = output_json
+            response.update(ok=True, **result)
+            changed += len(result["changed"])
+        except Exception as e:
+            logger.error(f"Cannot rescore {path}: {str(e)}")
+            response.update(ok=False, error=str(e))
+            failed += 1
+        sys.stdout.write(dump_result(response))
+        sys.stdout.flush()
+
+    diag(
+        f"[GRADING] rescored {len(paths) - failed}/{len(paths)} sheets in "
+        f"{time.perf_counter() - started:.2f} s; {changed} answers changed",
+        file=sys.stderr,
+    )
+    return failed
+
+
+def main(argv=None):
+    global VERBOSITY
+    args = parse_args(argv)
+    options = grading_options(args)
+    machine = (
+        args.json_output
+        or args.worker
+        or args.batch
+        or args.stack
+        or args.rescore
+        or args.serve
+        or args.queue
+    )
+    if args.verbosity is not None:
+        VERBOSITY = args.verbosity
+    elif machine:
+        VERBOSITY = 1
+
+    if args.worker:
+        run_worker(args.output_dir, args.n, options)
+        return
+
+    if args.serve:
+        try:
+            from service import run_service
+
+            run_service(
+                args.serve,
+                args.output_dir,
+                args.n,
+                args.jobs,
+                options,
+                args.queue_size,
+                args.max_rss_mb,
+            )
+        except (OSError, GradingError) as e:
+            logger.error(f"Cannot serve: {str(e)}")
+            sys.exit(1)
+        return
+
+    if args.queue:
+        import sqlite3
+
+        from job_queue import enqueue_batch, open_queue, queue_status, run_queue_worker
+
+        try:
+            failed = 0
+            if args.enqueue:
+                with contextlib.closing(open_queue(args.queue)) as conn:
+                    counts = enqueue_batch(
+                        conn,
+                        args.enqueue,
+                        args.batch_id,
+                        args.test_id,
+                        args.n,
+                        args.output_dir,
+                    )
+                diag(
+                    f"[GRADING] queued {counts['added']} of {counts['jobs']} sheets "
+                    f"for batch {counts['batch']} ({counts['known']} already queued)",
+                    file=sys.stderr,
+                )
+            if args.drain:
+                failed = run_queue_worker(
+                    args.queue,
+                    args.output_dir,
+                    args.n,
+                    args.jobs,
+                    options,
+                    args.lease,
+                    args.max_attempts,
+                    args.follow,
+                    args.max_rss_mb,
+                )
+            if args.status:
+                with contextlib.closing(open_queue(args.queue)) as conn:
+                    for entry in queue_status(conn, args.batch_id):
+                        sys.stdout.write(dump_result(entry))
+        except (OSError, ValueError, GradingError, sqlite3.Error) as e:
+            logger.error(f"Queue {args.queue}: {str(e)}")
+            sys.exit(1)
+        sys.exit(1 if failed else 0)
+
+    if args.rescore:
+        try:
+            factors = load_decision_factors(args.factors) if args.factors else None
+            failed = run_rescore(
+                args.rescore, args.output_dir, factors, args.min_confidence
+            )
+        except (OSError, GradingError) as e:
+            logger.error(f"Cannot rescore: {str(e)}")
+            sys.exit(1)
+        sys.exit(1 if failed else 0)
+
+    if args.stack:
+        try:
+            students = load_stack_students(args.students) if args.students else None
+            failed = run_stack(
+                args.stack, args.output_dir, args.test_id, args.n, students, options
+            )
+        except (OSError, ValueError, AttributeError, GradingError) as e:
+            logger.error(f"Cannot grade stack: {str(e)}")
+            sys.exit(1)
+        sys.exit(1 if failed else 0)
+
+    if args.batch:
+        try:
+            failed = run_batch(
+                args.batch,
+                args.output_dir,
+                args.test_id,
+                args.n,
+                args.jobs,
+                options,
+                args.max_rss_mb,
+            )
+        except (OSError, ValueError, GradingError) as e:
+            logger.error(f"Cannot load batch: {str(e)}")
+            sys.exit(1)
+        sys.exit(1 if failed else 0)
+
+    if args.render_geometry:
+        # In --json mode stdout only carries the result document
+        diagnostics = sys.stderr if args.json_output else sys.stdout
+        try:
+            with contextlib.redirect_stdout(diagnostics):
+                output_file = render_from_geometry(
+                    args.render_geometry,
+                    args.output_dir,
+                    args.image_format,
+                    args.image_quality,
+                    args.preview_width,
+                )
+        except (OSError, ValueError, KeyError, GradingError) as e:
+            logger.error(f"Cannot render {args.render_geometry}: {str(e)}")
+            if args.json_output:
+                sys.stdout.write(dump_result({"ok": False, "error": str(e)}))
+            sys.exit(1)
+        if args.json_output:
+            sys.stdout.write(dump_result({"ok": True, "output_image": output_file}))
+        return
+
+    # Encoded bytes on stdin (-i -) never touch the filesystem
+    data = sys.stdin.buffer.read() if args.input == "-" else None
+
+    if args.json_output:
+        response = run_job(
+            {
+                "input": args.input,
+                "test_id": args.test_id,
+                "student_id": args.student_id,
+                "shm": args.shm,
+                "shape": args.shape,
+            },
+            args.output_dir,
+            args.n,
+            options,
+            data=data,
+        )
+        del response["id"]
+        sys.stdout.write(dump_result(response))
+        sys.exit(0 if response["ok"] else 1)
+
+    input_file = args.input or f"shm:{args.shm}"
+    try:
+        image = read_shared_image(args.shm, args.shape) if args.shm else None
+        grade_sheet(
+            input_file,
+            args.output_dir,
+            args.test_id,
+            args.student_id,
+            args.n,
+            image=image,
+            data=data,
+            **options,
+        )
+    except FileNotFoundError as e:
+        logger.error(str(e) if args.shm else f"Input file '{input_file}' not found.")
+        sys.exit(1)
+    except GradingError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    except Exception as e:
+        logger.error(f"Error processing image: {str(e)}")
+        import traceback
+
+        traceback.print_exc()
         sys.exit(1)
 
-except FileNotFoundError:
-    logger.error(f"Input file '{input_file}' not found.")
-    sys.exit(1)
-except Exception as e:
-    logger.error(f"Error processing image: {str(e)}")
-    import traceback
 
-    traceback.print_exc()
-    sys.exit(1)
+if __name__ == "__main__":
+    # service.py and job_queue.py import this script as "app": share one copy
+    sys.modules.setdefault("app", sys.modules[__name__])
+    main()
@@ -0,0 +1,354 @@
+"""
+Durable grading job queue (app.py --queue DB): jobs live in a SQLite file, so
+a restart loses nothing and a batch resumes where it stopped. Any number of
+--drain processes, on this machine or others sharing the volume, claim jobs
+under a lease they renew while grading; a job whose worker died is claimed
+again once its lease expires. The database keeps a rollback journal rather
+than WAL, which needs shared memory that processes on other machines lack.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from app import (
+    GradingError,
+    available_cpus,
+    diag,
+    dump_result,
+    grading_pool,
+    load_batch_jobs,
+    run_pool_job,
+    tree_rss_mb,
+)
+from service import PRIORITIES, ServiceError, check_service_job
+
+logger = logging.getLogger(__name__)
+
+QUEUE_LEASE_S = 120
+QUEUE_MAX_ATTEMPTS = 3
+QUEUE_RETRY_DELAY_S = 5  # times the attempts made so far
+QUEUE_POLL_S = 1.0
+QUEUE_STATES = ("queued", "running", "done", "failed")
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    batch TEXT NOT NULL,
+    job_key TEXT NOT NULL,
+    job TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 1,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (batch, job_key)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, priority, id);
+"""
+
+
+def open_queue(path):
+    """Open (creating if needed) a queue database in autocommit mode."""
+    import sqlite3
+
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout = 30000")
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.executescript(QUEUE_SCHEMA)
+    return conn
+
+
+@contextlib.contextmanager
+def _queue_transaction(conn):
+    # IMMEDIATE takes the write lock up front: two workers can never both
+    # read the same job as claimable
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def enqueue_batch(conn, source, batch_id=None, test_id=None, n=0, output_dir=None):
+    """
+    Record every sheet of a manifest or directory (see load_batch_jobs()) as
+    a job of `batch_id` (default: the source's absolute path). Jobs are keyed
+    by test and student ID, so enqueueing the same batch again only adds the
+    sheets it did not have. Returns counts of added and already known jobs.
+    """
+    jobs = load_batch_jobs(source, test_id, n)
+    batch_id = batch_id or os.path.abspath(source)
+    now = time.time()
+    rows = []
+    for job in jobs:
+        try:
+            check_service_job(job)
+        except ServiceError as e:
+            raise GradingError(f"Job {job.get('id')}: {str(e)}")
+        if job.get("shm"):
+            # A shared memory segment does not outlive a restart
+            raise GradingError(f"Job {job.get('id')}: shm inputs cannot be queued")
+        if output_dir:
+            job.setdefault("output", output_dir)
+        priority = job.pop("priority", "batch")
+        if priority not in PRIORITIES:
+            raise GradingError(f"Unknown priority: {priority}")
+        key = f"{job['test_id']}-{job['student_id']}"
+        rows.append(
+            (batch_id, key, json.dumps(job), PRIORITIES[priority], now, now, now)
+        )
+
+    with _queue_transaction(conn):
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO jobs (batch, job_key, job, priority, available_at, "
+            "created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        added = conn.total_changes - before
+    return {
+        "batch": batch_id,
+        "jobs": len(rows),
+        "added": added,
+        "known": len(rows) - added,
+    }
+
+
+def claim_job(conn, owner, lease_s=QUEUE_LEASE_S, max_attempts=QUEUE_MAX_ATTEMPTS):
+    """
+    Lease the next job: queued ones by priority and age, then ones whose lease
+    expired. Jobs that used up their attempts fail instead. Returns
+    (row id, batch, job key, job dict) or None when nothing is claimable.
+    """
+    now = time.time()
+    with _queue_transaction(conn):
+        conn.execute(
+            "UPDATE jobs SET state = 'failed', lease_owner = NULL, updated = ?, "
+            "error = 'lease expired after ' || attempts || ' attempts' "
+            "WHERE state = 'running' AND lease_expires < ? AND attempts >= ?",
+            (now, now, max_attempts),
+        )
+        row = conn.execute(
+            "SELECT id, batch, job_key, job FROM jobs WHERE (state = 'queued' AND available_at <= ?) "
+            "OR (state = 'running' AND lease_expires < ?) ORDER BY priority, id LIMIT 1",
+            (now, now),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE jobs SET state = 'running', attempts = attempts + 1, "
+            "lease_owner = ?, lease_expires = ?, updated = ? WHERE id = ?",
+            (owner, now + lease_s, now, row[0]),
+        )
+    return row[0], row[1], row[2], json.loads(row[3])
+
+
+def renew_leases(conn, owner, lease_s=QUEUE_LEASE_S):
+    conn.execute(
+        "UPDATE jobs SET lease_expires = ? WHERE lease_owner = ? AND state = 'running'",
+        (time.time() + lease_s, owner),
+    )
+
+
+def finish_job(conn, row_id, owner, response, max_attempts=QUEUE_MAX_ATTEMPTS):
+    """
+    Record a job's result. Retryable failures go back to the queue after a
+    delay until the attempts run out. Returns the new state, or None when the
+    lease was lost to another worker (whose result then counts).
+    """
+    now = time.time()
+    error = None if response["ok"] else response.get("error")
+    with _queue_transaction(conn):
+        row = conn.execute(
+            "SELECT attempts FROM jobs WHERE id = ? AND lease_owner = ? "
+            "AND state = 'running'",
+            (row_id, owner),
+        ).fetchone()
+        if row is None:
+            return None
+        if response["ok"]:
+            state = "done"
+        elif response.get("retryable") and row[0] < max_attempts:
+            state = "queued"
+        else:
+            state = "failed"
+        conn.execute(
+            "UPDATE jobs SET state = ?, result = ?, error = ?, lease_owner = NULL, "
+            "lease_expires = NULL, available_at = ?, updated = ? WHERE id = ?",
+            (
+                state,
+                None if state == "queued" else json.dumps(response),
+                error,
+                now + QUEUE_RETRY_DELAY_S * row[0],
+                now,
+                row_id,
+            ),
+        )
+    return state
+
+
+def pending_jobs(conn):
+    """Jobs that are not finished yet, including ones leased by other workers."""
+    return conn.execute(
+        "SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running')"
+    ).fetchone()[0]
+
+
+def release_leases(conn, owner):
+    """Hand this worker's unfinished jobs back without using up an attempt."""
+    conn.execute(
+        "UPDATE jobs SET state = 'queued', attempts = attempts - 1, "
+        "lease_owner = NULL, lease_expires = NULL, updated = ? "
+        "WHERE lease_owner = ? AND state = 'running'",
+        (time.time(), owner),
+    )
+
+
+def queue_status(conn, batch_id=None):
+    """
+    Per-batch job counts by state; with `batch_id`, one entry per job of that
+    batch with its state, attempts, last error and result.
+    """
+    if batch_id is None:
+        batches = {}
+        for batch, state, count in conn.execute(
+            "SELECT batch, state, COUNT(*) FROM jobs GROUP BY batch, state"
+        ):
+            entry = batches.setdefault(
+                batch, {"batch": batch, "total": 0, **dict.fromkeys(QUEUE_STATES, 0)}
+            )
+            entry[state] = count
+            entry["total"] += count
+        return list(batches.values())
+    return [
+        {
+            "batch": batch_id,
+            "key": key,
+            "state": state,
+            "attempts": attempts,
+            "error": error,
+            "result": json.loads(result) if result else None,
+        }
+        for key, state, attempts, error, result in conn.execute(
+            "SELECT job_key, state, attempts, error, result FROM jobs "
+            "WHERE batch = ? ORDER BY id",
+            (batch_id,),
+        )
+    ]
+
+
+def run_queue_worker(
+    db_path,
+    output_dir=None,
+    n=0,
+    jobs_count=0,
+    options=None,
+    lease_s=QUEUE_LEASE_S,
+    max_attempts=QUEUE_MAX_ATTEMPTS,
+    follow=False,
+    max_rss_mb=0,
+):
+    """
+    Claim and grade queued jobs with a pool of worker processes until no job
+    is left unfinished (with `follow`, keep polling for new jobs).
+    Leases are renewed while sheets are graded; SIGINT/SIGTERM stops claiming,
+    finishes the sheets in progress and exits. Each finished job is written
+    as one JSON line on stdout. Returns the number of jobs that failed.
+    """
+    import signal
+    import socket
+    from concurrent.futures import FIRST_COMPLETED, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    conn = open_queue(db_path)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    workers = jobs_count or available_cpus()
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop.set())
+    diag(
+        f"[GRADING] queue worker {owner} on {db_path} with {workers} worker processes",
+        file=sys.stderr,
+    )
+
+    graded = failed = 0
+    in_flight = {}
+    renewed = time.monotonic()
+    pool = grading_pool(workers)
+    try:
+        while True:
+            held = max_rss_mb and in_flight and tree_rss_mb() >= max_rss_mb
+            while not stop.is_set() and not held and len(in_flight) < workers:
+                claimed = claim_job(conn, owner, lease_s, max_attempts)
+                if claimed is None:
+                    break
+                row_id, batch_id, key, job = claimed
+                future = pool.submit(run_pool_job, job, output_dir, n, options)
+                in_flight[future] = (row_id, batch_id, key, job, pool)
+
+            if not in_flight:
+                # Retries wait out their delay and other workers' jobs may
+                # come back when a lease expires, so only an empty queue ends
+                # a drain
+                if stop.is_set() or not (follow or pending_jobs(conn)):
+                    break
+                stop.wait(QUEUE_POLL_S)
+                continue
+
+            done, _ = wait(in_flight, timeout=0.25, return_when=FIRST_COMPLETED)
+            for future in done:
+                row_id, batch_id, key, job, submitted_to = in_flight.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    # The worker process died (or the job did not reach it)
+                    logger.error(f"Error grading queued job: {str(e)}")
+                    response = {
+                        "id": job.get("id"),
+                        "ok": False,
+                        "error": str(e) or type(e).__name__,
+                        "retryable": True,
+                    }
+                    # Every job in flight fails with the pool: replace it once
+                    if isinstance(e, BrokenProcessPool) and submitted_to is pool:
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        pool = grading_pool(workers)
+                state = finish_job(conn, row_id, owner, response, max_attempts)
+                if state is None:
+                    logger.error(
+                        f"Lease on queued job {row_id} was lost; result dropped"
+                    )
+                    continue
+                graded += 1
+                failed += state == "failed"
+                sys.stdout.write(
+                    dump_result(
+                        {**response, "batch": batch_id, "key": key, "state": state}
+                    )
+                )
+                sys.stdout.flush()
+
+            if time.monotonic() - renewed > lease_s / 3:
+                renew_leases(conn, owner, lease_s)
+                renewed = time.monotonic()
+    finally:
+        release_leases(conn, owner)
+        pool.shutdown(wait=True, cancel_futures=True)
+        conn.close()
+
+    diag(
+        f"[GRADING] queue worker finished: {graded - failed} graded, {failed} failed",
+        file=sys.stderr,
+    )
+    return failed
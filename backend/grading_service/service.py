@@ -0,0 +1,524 @@
+"""
+HTTP grading service (app.py --serve): an asyncio front end that queues
+sheets for a warm pool of grading processes. Interactive regrades are
+dispatched ahead of batch sheets and are still admitted when batches have
+filled the queue; past the queue limit submissions get 429 so callers back
+off instead of piling up work.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+from app import (
+    GradingError,
+    available_cpus,
+    diag,
+    dump_result,
+    get_presets,
+    grading_pool,
+    load_batch_jobs,
+    load_module,
+    run_pool_job,
+    tree_rss_mb,
+)
+
+logger = logging.getLogger(__name__)
+
+SERVE_QUEUE_SIZE = 256
+# Finished jobs are kept for status queries, oldest dropped first past either
+# limit; a batch goes once all of its jobs have. An inline image is handed
+# out once and then dropped: it dwarfs the rest of a result.
+SERVE_HISTORY = 10000
+SERVE_HISTORY_MB = 64
+SERVE_MAX_BODY_MB = 64
+PRIORITIES = {"interactive": 0, "batch": 1}
+HTTP_REASONS = {
+    200: "OK",
+    202: "Accepted",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+
+class ServiceError(Exception):
+    """An HTTP error response: status code plus message."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _warm_process():
+    # Pay the imports and preset set-up before the process's first sheet
+    load_module("numpy")
+    load_module("cv2")
+    load_module("boxdetect.pipelines")
+    get_presets()
+    return os.getpid()
+
+
+def new_service(workers, queue_size, output_dir=None, n=0, options=None, max_rss_mb=0):
+    """Service state shared by the HTTP handlers and the dispatchers."""
+    import asyncio
+    import itertools
+    from collections import deque
+
+    return {
+        "workers": workers,
+        "queue_size": queue_size,
+        "output_dir": output_dir,
+        "n": n,
+        "options": options or {},
+        "max_rss_mb": max_rss_mb,
+        "pool": None,
+        "queue": asyncio.PriorityQueue(),
+        "seq": itertools.count(),
+        "queued": {priority: 0 for priority in PRIORITIES},
+        "running": 0,
+        "jobs": {},
+        "events": {},
+        "batches": {},
+        "finished": deque(),
+        "result_bytes": {},
+        "retained_bytes": 0,
+    }
+
+
+def check_service_job(job):
+    """Reject malformed jobs at submission instead of failing them later."""
+    if not isinstance(job, dict):
+        raise ServiceError(400, "A job must be a JSON object")
+    missing = [field for field in ("test_id", "student_id") if not job.get(field)]
+    if missing:
+        raise ServiceError(400, f"Job is missing {', '.join(missing)}")
+    if not (job.get("input") or job.get("image_b64") or job.get("shm")):
+        raise ServiceError(400, "Job needs input, image_b64 or shm + shape")
+
+
+def admit(service, priority, count):
+    """Back-pressure: whether `count` more sheets of `priority` fit in the queue."""
+    queued = service["queued"]
+    if priority == "interactive":
+        return queued["interactive"] + count <= service["queue_size"]
+    return sum(queued.values()) + count <= service["queue_size"]
+
+
+def enqueue(service, job, priority, batch_id=None, data=None):
+    """Queue one checked job; returns its status record."""
+    import asyncio
+    import uuid
+
+    job_id = uuid.uuid4().hex[:16]
+    job = {**job, "id": job_id}
+    record = {
+        "id": job_id,
+        "state": "queued",
+        "priority": priority,
+        "batch": batch_id,
+        "test_id": job["test_id"],
+        "student_id": job["student_id"],
+        "submitted": time.time(),
+        "started": None,
+        "finished": None,
+        "result": None,
+    }
+    service["jobs"][job_id] = record
+    service["events"][job_id] = asyncio.Event()
+    service["queued"][priority] += 1
+    service["queue"].put_nowait((PRIORITIES[priority], next(service["seq"]), job, data))
+    return record
+
+
+async def _dispatch(service):
+    # One dispatcher per worker process: at most `workers` sheets in flight,
+    # the rest wait in the priority queue
+    import asyncio
+    from concurrent.futures.process import BrokenProcessPool
+
+    loop = asyncio.get_running_loop()
+    while True:
+        _, _, job, data = await service["queue"].get()
+        record = service["jobs"][job["id"]]
+        service["queued"][record["priority"]] -= 1
+        # Same memory budget as --batch: hold new sheets while over it
+        while (
+            service["max_rss_mb"]
+            and service["running"]
+            and tree_rss_mb() >= service["max_rss_mb"]
+        ):
+            await asyncio.sleep(0.25)
+
+        record.update(state="running", started=time.time())
+        service["running"] += 1
+        pool = service["pool"]
+        try:
+            response = await loop.run_in_executor(
+                pool,
+                run_pool_job,
+                job,
+                service["output_dir"],
+                service["n"],
+                service["options"],
+                data,
+            )
+        except BrokenProcessPool as e:
+            logger.error(f"Grading process died: {str(e)}")
+            response = {"id": job["id"], "ok": False, "error": "Grading process died"}
+            if service["pool"] is pool:
+                service["pool"] = grading_pool(service["workers"])
+        except Exception as e:
+            logger.error(f"Error dispatching job: {str(e)}")
+            response = {"id": job["id"], "ok": False, "error": str(e)}
+        finally:
+            service["running"] -= 1
+
+        record.update(
+            state="done" if response["ok"] else "failed",
+            finished=time.time(),
+            result=response,
+        )
+        service["events"].pop(job["id"]).set()
+        service["finished"].append(job["id"])
+        _retain(service, job["id"])
+        evict_history(service)
+
+
+def _retain(service, job_id):
+    # Serialised size of a finished record's result, for the history budget
+    size = len(dump_result(service["jobs"][job_id]["result"]))
+    service["retained_bytes"] += size - service["result_bytes"].get(job_id, 0)
+    service["result_bytes"][job_id] = size
+
+
+def evict_history(service, max_jobs=SERVE_HISTORY, max_mb=SERVE_HISTORY_MB):
+    """Forget the oldest finished jobs (and emptied batches) past the limits."""
+    finished = service["finished"]
+    while finished and (
+        len(finished) > max_jobs or service["retained_bytes"] > max_mb * 1024 * 1024
+    ):
+        job_id = finished.popleft()
+        service["retained_bytes"] -= service["result_bytes"].pop(job_id, 0)
+        record = service["jobs"].pop(job_id, None)
+        batch = record and service["batches"].get(record["batch"])
+        if batch is not None:
+            batch["retained"] -= 1
+            if not batch["retained"]:
+                del service["batches"][batch["id"]]
+
+
+def deliver(service, record):
+    """
+    The record to answer a status query with. A finished job's inline image
+    is included this once and then dropped from the stored result.
+    """
+    result = record["result"]
+    if not result or "image_b64" not in result:
+        return record
+    delivered = {**record, "result": dict(result)}
+    del result["image_b64"]
+    if record["id"] in service["result_bytes"]:
+        _retain(service, record["id"])
+    return delivered
+
+
+def batch_view(service, batch):
+    """Progress of a batch: counts per state plus every job's id and state."""
+    jobs = []
+    counts = {"queued": 0, "running": 0, "done": 0, "failed": 0, "expired": 0}
+    for job_id in batch["jobs"]:
+        record = service["jobs"].get(job_id)
+        state = record["state"] if record else "expired"
+        counts[state] += 1
+        jobs.append(
+            {
+                "id": job_id,
+                "student_id": record and record["student_id"],
+                "state": state,
+            }
+        )
+    return {
+        "id": batch["id"],
+        "submitted": batch["submitted"],
+        "total": len(jobs),
+        **counts,
+        "complete": counts["queued"] + counts["running"] == 0,
+        "jobs": jobs,
+    }
+
+
+def _query_flag(query, name):
+    return query.get(name, ["0"])[-1].lower() in ("1", "true", "yes")
+
+
+async def _service_route(service, method, target, headers, body):
+    """Handle one request; returns (status, JSON payload)."""
+    from urllib.parse import parse_qs, urlsplit
+
+    url = urlsplit(target)
+    query = parse_qs(url.query)
+    parts = [p for p in url.path.split("/") if p]
+    is_json = headers.get("content-type", "").startswith("application/json")
+
+    def json_body():
+        try:
+            return json.loads(body or b"{}")
+        except ValueError as e:
+            raise ServiceError(400, f"Invalid JSON: {str(e)}")
+
+    if parts == ["health"] and method == "GET":
+        return 200, {
+            "ok": True,
+            "workers": service["workers"],
+            "running": service["running"],
+            "queued": dict(service["queued"]),
+            "queue_size": service["queue_size"],
+        }
+
+    if parts == ["grade"] and method == "POST":
+        data = None
+        if is_json:
+            job = json_body()
+        else:
+            # Raw scan bytes in the body, job fields in the query string
+            job = {name: values[-1] for name, values in query.items()}
+            job.pop("wait", None)
+            if "n" in job:
+                try:
+                    job["n"] = int(job["n"])
+                except ValueError:
+                    raise ServiceError(400, "n must be an integer")
+            if "inline_image" in job:
+                job["inline_image"] = _query_flag(query, "inline_image")
+            job.setdefault("input", "-")
+            data = body
+        check_service_job(job)
+        priority = (
+            job.pop("priority", None) or query.get("priority", ["interactive"])[-1]
+        )
+        if priority not in PRIORITIES:
+            raise ServiceError(400, f"Unknown priority: {priority}")
+        if not admit(service, priority, 1):
+            raise ServiceError(429, "Grading queue is full")
+        record = enqueue(service, job, priority, data=data)
+        if _query_flag(query, "wait"):
+            await service["events"][record["id"]].wait()
+            return 200, deliver(service, record)
+        return 202, record
+
+    if parts == ["batches"] and method == "POST":
+        request = json_body()
+        if not isinstance(request, dict):
+            raise ServiceError(400, "A batch must be a JSON object")
+        if "source" in request:
+            # Manifest or directory on the grader's filesystem, as with --batch
+            try:
+                jobs = load_batch_jobs(
+                    request["source"], request.get("test_id"), request.get("n", 0)
+                )
+            except (OSError, ValueError, GradingError) as e:
+                raise ServiceError(400, f"Cannot load batch: {str(e)}")
+        else:
+            jobs = request.get("jobs")
+            if not isinstance(jobs, list) or not jobs:
+                raise ServiceError(400, "A batch needs source or a non-empty jobs list")
+        for job in jobs:
+            check_service_job(job)
+        priority = request.get("priority", "batch")
+        if priority not in PRIORITIES:
+            raise ServiceError(400, f"Unknown priority: {priority}")
+        if not admit(service, priority, len(jobs)):
+            raise ServiceError(
+                429, f"Grading queue cannot take {len(jobs)} more sheets"
+            )
+
+        import uuid
+
+        batch = {
+            "id": uuid.uuid4().hex[:16],
+            "submitted": time.time(),
+            "jobs": [],
+            "retained": len(jobs),  # jobs not yet evicted from the history
+        }
+        for job in jobs:
+            batch["jobs"].append(enqueue(service, job, priority, batch["id"])["id"])
+        service["batches"][batch["id"]] = batch
+        return 202, batch_view(service, batch)
+
+    if len(parts) == 2 and parts[0] == "jobs" and method == "GET":
+        record = service["jobs"].get(parts[1])
+        if record is None:
+            raise ServiceError(404, f"Unknown job: {parts[1]}")
+        event = service["events"].get(parts[1])
+        if event is not None and _query_flag(query, "wait"):
+            await event.wait()
+        return 200, deliver(service, record)
+
+    if len(parts) == 2 and parts[0] == "batches" and method == "GET":
+        batch = service["batches"].get(parts[1])
+        if batch is None:
+            raise ServiceError(404, f"Unknown batch: {parts[1]}")
+        return 200, batch_view(service, batch)
+
+    if parts in (["health"], ["grade"], ["batches"]) or (
+        len(parts) == 2 and parts[0] in ("jobs", "batches")
+    ):
+        raise ServiceError(405, f"{method} not allowed on {url.path}")
+    raise ServiceError(404, f"Not found: {url.path}")
+
+
+async def _read_request(reader):
+    """(method, target, headers, body) of the next request; None at EOF."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split()
+    except ValueError:
+        raise ServiceError(400, "Malformed request line")
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = header.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise ServiceError(400, "Invalid Content-Length")
+    if length > SERVE_MAX_BODY_MB * 1024 * 1024:
+        raise ServiceError(413, f"Body over {SERVE_MAX_BODY_MB} MB")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, headers, body
+
+
+async def _write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    head = [
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Error')}",
+        "Content-Type: application/json",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    if status == 429:
+        head.append("Retry-After: 1")
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+async def _handle_connection(service, reader, writer):
+    import asyncio
+
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                status, payload = await _service_route(
+                    service, method, target, headers, body
+                )
+            except ServiceError as e:
+                # The rest of a rejected request cannot be trusted: close after
+                keep_alive = e.status not in (400, 413)
+                status, payload = e.status, {"ok": False, "error": str(e)}
+            except Exception as e:
+                logger.error(f"Error handling request: {str(e)}")
+                keep_alive = False
+                status, payload = 500, {"ok": False, "error": str(e)}
+            await _write_response(writer, status, payload, keep_alive)
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve(host, port, service):
+    import asyncio
+    import signal
+
+    loop = asyncio.get_running_loop()
+    service["pool"] = grading_pool(service["workers"])
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_connection(service, reader, writer),
+        host,
+        port,
+    )
+    # Warm every worker process; sheets submitted meanwhile queue behind it
+    for _ in range(service["workers"]):
+        loop.run_in_executor(service["pool"], _warm_process)
+    dispatchers = [
+        asyncio.create_task(_dispatch(service)) for _ in range(service["workers"])
+    ]
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    bound = server.sockets[0].getsockname()
+    diag(
+        f"[GRADING] serving on http://{bound[0]}:{bound[1]} with "
+        f"{service['workers']} worker processes, queue size {service['queue_size']}",
+        file=sys.stderr,
+        flush=True,
+    )
+    async with server:
+        await stop.wait()
+
+    diag("[GRADING] shutting down; finishing sheets in progress", file=sys.stderr)
+    for task in dispatchers:
+        task.cancel()
+    service["pool"].shutdown(wait=True, cancel_futures=True)
+
+
+def parse_address(address):
+    """[HOST:]PORT -> (host, port); the host defaults to localhost."""
+    host, _, port = address.rpartition(":")
+    try:
+        port = int(port)
+    except ValueError:
+        raise GradingError(f"Invalid address {address!r}: expected [HOST:]PORT")
+    return host or "127.0.0.1", port
+
+
+def run_service(
+    address,
+    output_dir=None,
+    n=0,
+    jobs_count=0,
+    options=None,
+    queue_size=SERVE_QUEUE_SIZE,
+    max_rss_mb=0,
+):
+    """
+    Serve grading over HTTP until SIGINT/SIGTERM (see _service_route()):
+
+      POST /grade      one sheet: a job object as JSON (see run_job()), or the
+                       raw scan as the body with the job fields in the query;
+                       ?wait=1 answers once it is graded. Interactive priority.
+      POST /batches    {"jobs": [...]} or {"source": manifest or directory,
+                       "test_id", "n"} as with --batch. Batch priority.
+      GET /jobs/ID     job status and, once finished, its result (?wait=1);
+                       an inline image_b64 is only returned the first time
+      GET /batches/ID  batch progress
+      GET /health      workers and queue depth
+
+    Submissions that do not fit in the queue get 429 with Retry-After.
+    """
+    import asyncio
+
+    host, port = parse_address(address)
+    service = new_service(
+        jobs_count or available_cpus(), queue_size, output_dir, n, options, max_rss_mb
+    )
+    asyncio.run(_serve(host, port, service))
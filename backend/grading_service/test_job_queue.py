@@ -0,0 +1,234 @@
+"""State machine of the durable job queue: claims, leases, retries, status."""
+
+import json
+import multiprocessing
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import job_queue
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A settable time.time() for lease and retry deadlines."""
+    now = [1000.0]
+    monkeypatch.setattr(job_queue.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / "queue.db")
+
+
+@pytest.fixture
+def conn(db):
+    conn = job_queue.open_queue(db)
+    yield conn
+    conn.close()
+
+
+def write_manifest(tmp_path, jobs, name="batch.jsonl"):
+    path = tmp_path / name
+    path.write_text("".join(json.dumps(job) + "\n" for job in jobs))
+    return str(path)
+
+
+def sheets(count, **extra):
+    return [
+        {"input": f"/scans/{i}.jpg", "test_id": "T", "student_id": str(i), **extra}
+        for i in range(count)
+    ]
+
+
+def job_row(conn, key):
+    return conn.execute(
+        "SELECT state, attempts, lease_owner, error FROM jobs WHERE job_key = ?",
+        (key,),
+    ).fetchone()
+
+
+def test_enqueue_is_idempotent(tmp_path, conn):
+    manifest = write_manifest(tmp_path, sheets(3))
+    first = job_queue.enqueue_batch(conn, manifest, "B")
+    assert (first["jobs"], first["added"], first["known"]) == (3, 3, 0)
+
+    more = write_manifest(tmp_path, sheets(4), "more.jsonl")
+    again = job_queue.enqueue_batch(conn, more, "B")
+    assert (again["jobs"], again["added"], again["known"]) == (4, 1, 3)
+
+
+def test_enqueue_rejects_bad_jobs(tmp_path, conn):
+    missing = write_manifest(tmp_path, [{"input": "/scans/1.jpg", "test_id": "T"}])
+    with pytest.raises(job_queue.GradingError, match="student_id"):
+        job_queue.enqueue_batch(conn, missing)
+    shm = write_manifest(
+        tmp_path,
+        [{"shm": "seg", "shape": "10x10", "test_id": "T", "student_id": "1"}],
+        "shm.jsonl",
+    )
+    with pytest.raises(job_queue.GradingError, match="shm"):
+        job_queue.enqueue_batch(conn, shm)
+    assert job_queue.pending_jobs(conn) == 0
+
+
+def test_enqueue_fills_output_dir_and_priority(tmp_path, conn):
+    manifest = write_manifest(
+        tmp_path, sheets(1) + sheets(1, priority="interactive", student_id="9")
+    )
+    job_queue.enqueue_batch(conn, manifest, "B", output_dir="/out")
+    _, _, key, job = job_queue.claim_job(conn, "w")
+    assert key == "T-9"
+    assert job["output"] == "/out"
+    assert "priority" not in job
+
+
+def test_claims_in_submission_order(tmp_path, conn):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(3)), "B")
+    keys = [job_queue.claim_job(conn, "w")[2] for _ in range(3)]
+    assert keys == ["T-0", "T-1", "T-2"]
+    assert job_queue.claim_job(conn, "w") is None
+
+
+def drain(db, owner):
+    # One queue worker process: claim and finish until nothing is left
+    conn = job_queue.open_queue(db)
+    claimed = []
+    try:
+        while True:
+            job = job_queue.claim_job(conn, owner)
+            if job is None:
+                return claimed
+            claimed.append(job[2])
+            job_queue.finish_job(conn, job[0], owner, {"ok": True})
+    finally:
+        conn.close()
+
+
+def test_concurrent_workers_claim_each_job_once(tmp_path, db, conn):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(200)), "B")
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        claims = pool.starmap(drain, [(db, f"w{i}") for i in range(4)])
+
+    claimed = [key for keys in claims for key in keys]
+    assert sorted(claimed) == sorted(f"T-{i}" for i in range(200))
+    (status,) = job_queue.queue_status(conn)
+    assert (status["done"], status["running"], status["queued"]) == (200, 0, 0)
+
+
+def test_expired_lease_is_taken_over(tmp_path, conn, clock):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(1)), "B")
+    row_id = job_queue.claim_job(conn, "dead", lease_s=10)[0]
+
+    clock[0] += 5
+    assert job_queue.claim_job(conn, "w2", lease_s=10) is None
+    clock[0] += 6
+    assert job_queue.claim_job(conn, "w2", lease_s=10)[0] == row_id
+    assert job_row(conn, "T-0")[:3] == ("running", 2, "w2")
+
+    # The first worker's late result no longer counts
+    assert job_queue.finish_job(conn, row_id, "dead", {"ok": True}) is None
+    assert job_queue.finish_job(conn, row_id, "w2", {"ok": True}) == "done"
+
+
+def test_renewed_lease_is_not_taken_over(tmp_path, conn, clock):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(1)), "B")
+    job_queue.claim_job(conn, "w1", lease_s=10)
+    clock[0] += 8
+    job_queue.renew_leases(conn, "w1", lease_s=10)
+    clock[0] += 8
+    assert job_queue.claim_job(conn, "w2", lease_s=10) is None
+
+
+def test_expired_lease_without_attempts_left_fails(tmp_path, conn, clock):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(1)), "B")
+    job_queue.claim_job(conn, "dead", lease_s=10, max_attempts=1)
+    clock[0] += 11
+    assert job_queue.claim_job(conn, "w2", lease_s=10, max_attempts=1) is None
+    state, attempts, owner, error = job_row(conn, "T-0")
+    assert (state, attempts, owner) == ("failed", 1, None)
+    assert "lease expired" in error
+
+
+def test_retryable_failure_backs_off_then_fails(tmp_path, conn, clock):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(1)), "B")
+    failure = {"ok": False, "error": "disk full", "retryable": True}
+
+    row_id = job_queue.claim_job(conn, "w", max_attempts=2)[0]
+    assert job_queue.finish_job(conn, row_id, "w", failure, max_attempts=2) == "queued"
+
+    clock[0] += job_queue.QUEUE_RETRY_DELAY_S - 1
+    assert job_queue.claim_job(conn, "w", max_attempts=2) is None
+    clock[0] += 1
+    row_id = job_queue.claim_job(conn, "w", max_attempts=2)[0]
+    assert job_queue.finish_job(conn, row_id, "w", failure, max_attempts=2) == "failed"
+
+    state, attempts, _, error = job_row(conn, "T-0")
+    assert (state, attempts, error) == ("failed", 2, "disk full")
+    assert job_queue.pending_jobs(conn) == 0
+
+
+def test_permanent_failure_is_not_retried(tmp_path, conn):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(1)), "B")
+    row_id = job_queue.claim_job(conn, "w")[0]
+    failure = {"ok": False, "error": "No answer boxes", "retryable": False}
+    assert job_queue.finish_job(conn, row_id, "w", failure) == "failed"
+
+
+def test_released_leases_refund_the_attempt(tmp_path, conn):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(2)), "B")
+    job_queue.claim_job(conn, "w")
+    job_queue.release_leases(conn, "w")
+    assert job_row(conn, "T-0")[:3] == ("queued", 0, None)
+    assert job_queue.claim_job(conn, "w2")[2] == "T-0"
+
+
+class DeadPool:
+    """A process pool whose worker processes have all died."""
+
+    def __init__(self, pools):
+        pools.append(self)
+        self.shutdowns = 0
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("worker killed"))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shutdowns += 1
+
+
+def test_crashed_pool_is_replaced_once(tmp_path, db, conn, monkeypatch, capsys):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(3)), "B")
+    pools = []
+    monkeypatch.setattr(job_queue, "grading_pool", lambda workers: DeadPool(pools))
+
+    failed = job_queue.run_queue_worker(db, "/out", jobs_count=3, max_attempts=1)
+
+    # All three jobs were in flight on the first pool when it broke
+    assert failed == 3
+    assert len(pools) == 2
+    assert [pool.shutdowns for pool in pools] == [1, 1]
+    assert len(capsys.readouterr().out.splitlines()) == 3
+
+
+def test_status_per_batch_and_per_job(tmp_path, conn):
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(2)), "A")
+    job_queue.enqueue_batch(conn, write_manifest(tmp_path, sheets(1)), "B")
+    row_id = job_queue.claim_job(conn, "w")[0]
+    job_queue.finish_job(conn, row_id, "w", {"ok": True, "answers": {"1": "A"}})
+
+    batches = {entry["batch"]: entry for entry in job_queue.queue_status(conn)}
+    a, b = batches["A"], batches["B"]
+    assert (a["total"], a["done"], a["queued"]) == (2, 1, 1)
+    assert (b["total"], b["queued"]) == (1, 1)
+
+    jobs = job_queue.queue_status(conn, "A")
+    assert [(job["key"], job["state"]) for job in jobs] == [
+        ("T-0", "done"),
+        ("T-1", "queued"),
+    ]
+    assert jobs[0]["result"]["answers"] == {"1": "A"}
@@ -1,6 +1,8 @@
 import { spawn } from "child_process";
 import fs from "fs";
 import path from "path";
+import readline from "readline";
+import type { Readable } from "stream";
 import { promisify } from "util";
 import type { Student, Test, TestAnswer, TestImage } from "../types";
 import database from "./database";
@@ -88,6 +90,31 @@ const nowLocalString = () => {
 	return `${yyyy}-${mm}-${dd}T${hh}:${mi}:${ss}+02:00`; // Cairo timezone (UTC+2)
 };
 
+// Helper: log grading script stderr. It carries progress diagnostics plus
+// the script's "[GRADING] ERROR:" lines, which belong in the error log.
+// readline joins lines that arrive split across chunks.
+const logGradingStderr = (stderr: Readable | null) => {
+	if (!stderr) return;
+	readline.createInterface({ input: stderr }).on("line", (line) => {
+		const msg = line.trim();
+		if (!msg) return;
+		if (msg.includes("ERROR:")) console.error(`[GRADING ERROR] ${msg}`);
+		else console.log(`[GRADING] ${msg}`);
+	});
+};
+
+// Helper: why a --json grading run failed. The script still prints its
+// {"ok": false, "error": ...} document on stdout when it exits non-zero.
+const gradingFailureReason = (stdoutText: string, exitCode: number | null) => {
+	try {
+		const result = JSON.parse(stdoutText);
+		if (result && result.error) return `${result.error} (exit code ${exitCode})`;
+	} catch {
+		// No result document (crash before grading started)
+	}
+	return `exit code ${exitCode}`;
+};
+
 interface CreateTestData {
 	title: string;
 	grade: string;
@@ -299,6 +326,7 @@ class TestService {
 				outDir,
 				"-i",
 				fullImagePath,
+				"--json",
 			];
 			console.log(
 				`[REGRADE] Running grading script for submission ${submissionId}`,
@@ -322,6 +350,9 @@ class TestService {
 				}
 			} catch {}
 
+			// With --json the script prints one result document on stdout;
+			// diagnostics arrive on stderr
+			let stdoutText = "";
 			const exitCode = await new Promise<number | null>((resolve) => {
 				const child = spawn(pyExec, args, {
 					cwd: scriptDir,
@@ -329,13 +360,9 @@ class TestService {
 					shell: process.platform === "win32",
 				});
 				child.stdout?.on("data", (data: Buffer) => {
-					const msg = data.toString().trim();
-					if (msg) console.log(`[GRADING] ${msg}`);
-				});
-				child.stderr?.on("data", (data: Buffer) => {
-					const msg = data.toString().trim();
-					if (msg) console.error(`[GRADING ERROR] ${msg}`);
+					stdoutText += data.toString();
 				});
+				logGradingStderr(child.stderr);
 				child.on("close", (code) => {
 					console.log(
 						`[REGRADE] Script finished for submission ${submissionId} (exit ${code})`,
@@ -355,23 +382,21 @@ class TestService {
 				return {
 					success: false,
 					score: null,
-					message: `Grading script failed with exit code ${exitCode}`,
+					message: `Grading script failed: ${gradingFailureReason(stdoutText, exitCode)}`,
 				};
 			}
 
-			// Read the output JSON
-			const outJson = path.join(outDir, `${testId}-${studentId}.json`);
-			const outImg = path.join(outDir, `${testId}-${studentId}.jpg`);
-			console.log(
-				`[REGRADE] Output status for submission ${submissionId}: json=${fs.existsSync(outJson)} image=${fs.existsSync(outImg)}`,
-			);
+			// Parse the result document from stdout
 			let detected: Record<string, string> | null = null;
 			try {
-				const raw = fs.readFileSync(outJson, "utf8");
-				detected = JSON.parse(raw);
+				const result = JSON.parse(stdoutText);
+				detected = result.ok ? result.answers : null;
+				console.log(
+					`[REGRADE] Result for submission ${submissionId}: preset=${result.preset} detected_boxes=${result.detected_boxes} image=${result.output_image}`,
+				);
 			} catch (parseError) {
 				console.error(
-					`[REGRADE] Failed to parse output JSON for submission ${submissionId}:`,
+					`[REGRADE] Failed to parse grading result for submission ${submissionId}:`,
 					parseError instanceof Error ? parseError.message : parseError,
 				);
 				detected = null;
@@ -579,6 +604,7 @@ class TestService {
 				outDir,
 				"-i",
 				inputPath,
+				"--json",
 			];
 			console.log(`[GRADING] Running script for student ${studentId}`);
 			console.log(`[GRADING] Student ${studentId} input: ${inputPath}`);
@@ -597,6 +623,9 @@ class TestService {
 				// Ignore stale output cleanup errors
 			}
 
+			// With --json the script prints one result document on stdout;
+			// diagnostics arrive on stderr
+			let stdoutText = "";
 			const exitCode = await new Promise<number | null>((resolve) => {
 				const child = spawn(pyExec, args, {
 					cwd: scriptDir,
@@ -604,13 +633,9 @@ class TestService {
 					shell: process.platform === "win32",
 				});
 				child.stdout?.on("data", (data: Buffer) => {
-					const msg = data.toString().trim();
-					if (msg) console.log(`[GRADING] ${msg}`);
-				});
-				child.stderr?.on("data", (data: Buffer) => {
-					const msg = data.toString().trim();
-					if (msg) console.error(`[GRADING ERROR] ${msg}`);
+					stdoutText += data.toString();
 				});
+				logGradingStderr(child.stderr);
 				child.on("close", (code) => {
 					console.log(
 						`[GRADING] Script finished for student ${studentId} (exit ${code})`,
@@ -627,7 +652,7 @@ class TestService {
 
 			if (exitCode !== 0) {
 				logger.error(
-					`Batch grading script failed for student ${studentId} with exit code ${exitCode}`,
+					`Batch grading script failed for student ${studentId}: ${gradingFailureReason(stdoutText, exitCode)}`,
 				);
 				results.push({
 					student_id: studentId as number,
@@ -638,19 +663,17 @@ class TestService {
 				continue;
 			}
 
-			// After script finishes, read JSON and image
-			const outJson = path.join(outDir, `${testId}-${studentId}.json`);
-			const outImg = path.join(outDir, `${testId}-${studentId}.jpg`);
-			console.log(
-				`[GRADING] Student ${studentId} output status: json=${fs.existsSync(outJson)} image=${fs.existsSync(outImg)}`,
-			);
+			// After script finishes, parse the result document from stdout
 			let detected: Record<string, string> | null = null;
 			try {
-				const raw = fs.readFileSync(outJson, "utf8");
-				detected = JSON.parse(raw);
+				const result = JSON.parse(stdoutText);
+				detected = result.ok ? result.answers : null;
+				console.log(
+					`[GRADING] Student ${studentId} result: preset=${result.preset} detected_boxes=${result.detected_boxes} image=${result.output_image}`,
+				);
 			} catch (parseError) {
 				console.error(
-					`[GRADING ERROR] Failed to parse JSON for student ${studentId}:`,
+					`[GRADING ERROR] Failed to parse grading result for student ${studentId}:`,
 					parseError instanceof Error ? parseError.message : parseError,
 				);
 				detected = null;
@@ -0,0 +1,360 @@
+"""
+Throughput and accuracy benchmark for the grading service.
+
+Grades the sample scans through each invocation style and reports sheets/sec,
+p50/p95 latency per sheet, peak RSS and per-question agreement with golden
+answer files:
+
+  cli     one `app.py -i ...` process per sheet (what the backend does today)
+  batch   one `app.py --batch` run over all sheets
+  worker  one `app.py --worker` process, jobs sent one at a time
+
+Latency is the wall time per process for cli and the request/response round
+trip for worker; batch sheets overlap, so their latency is the in-process
+grading time reported under "timings". Peak RSS is the largest resident set of
+any single grading process.
+
+Usage:
+  python bench.py                          # built-in sample scans, all styles
+  python bench.py -r 5 --modes worker      # 5 passes over the samples
+  python bench.py -- --detect-threads 4    # extra app.py flags after "--"
+  python bench.py -- --engine contour      # contour engine vs the default run
+"""
+
+import os
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Sample scans shipped next to this script; goldens are earlier graded outputs
+SAMPLE_SHEETS = [
+    {"input": "111.jpg", "golden": "111/111-111.json"},
+    {"input": "143.jpg"},
+    {"input": "145.jpg", "golden": "hh/10-11.json"},
+]
+MODES = ("cli", "batch", "worker")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        help="JSON list of {input, golden (optional), n (optional)}; "
+        "paths are relative to the manifest (default: the sample scans)",
+    )
+    parser.add_argument(
+        "--app",
+        default=os.path.join(script_dir, "app.py"),
+        help="grading script to benchmark",
+    )
+    parser.add_argument(
+        "--modes",
+        default=",".join(MODES),
+        help=f"comma separated invocation styles ({', '.join(MODES)})",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=1, help="passes over the sheet list"
+    )
+    parser.add_argument(
+        "-n",
+        dest="n",
+        type=int,
+        default=0,
+        help="questions to grade (default: golden length, else 55)",
+    )
+    parser.add_argument("--json", dest="json_path", help="also write the report here")
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the graded outputs directory"
+    )
+    parser.add_argument(
+        "app_args",
+        nargs=argparse.REMAINDER,
+        help='extra app.py flags, given after "--"',
+    )
+    return parser
+
+
+def load_sheets(manifest):
+    if manifest:
+        with open(manifest) as f:
+            entries = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(manifest))
+    else:
+        entries, base_dir = SAMPLE_SHEETS, script_dir
+
+    sheets = []
+    for entry in entries:
+        sheet = dict(entry)
+        for field in ("input", "golden"):
+            if sheet.get(field) and not os.path.isabs(sheet[field]):
+                sheet[field] = os.path.join(base_dir, sheet[field])
+        if sheet.get("golden"):
+            with open(sheet["golden"]) as f:
+                sheet["answers"] = json.load(f)
+        sheets.append(sheet)
+    return sheets
+
+
+def build_jobs(sheets, repeat, n, output_dir):
+    jobs = []
+    for r in range(repeat):
+        for sheet in sheets:
+            stem = os.path.splitext(os.path.basename(sheet["input"]))[0]
+            golden = sheet.get("answers")
+            jobs.append(
+                {
+                    "id": len(jobs),
+                    "input": sheet["input"],
+                    "test_id": "bench",
+                    "student_id": f"{stem}-{r}",
+                    "n": n or sheet.get("n") or (len(golden) if golden else 55),
+                    "output": output_dir,
+                    "golden": golden,
+                }
+            )
+    return jobs
+
+
+def job_line(job):
+    return json.dumps({k: v for k, v in job.items() if k != "golden"}) + "\n"
+
+
+def run_child(cmd, stdin_lines=None, on_line=None, on_eof=None):
+    """
+    Run `cmd`, feeding `stdin_lines` (an iterator, may block) and passing each
+    stdout line to `on_line`. `on_eof` is called once stdout closes, so an
+    iterator waiting on replies can stop when the child dies.
+    Returns (exit code, peak RSS in MB).
+    """
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if stdin_lines is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    feeder = None
+    if stdin_lines is not None:
+
+        def feed():
+            try:
+                for line in stdin_lines:
+                    proc.stdin.write(line)
+                    proc.stdin.flush()
+            except BrokenPipeError:
+                pass  # the child exited; its exit code reports why
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+    for line in proc.stdout:
+        if on_line is not None and line.strip():
+            on_line(line)
+    proc.stdout.close()
+    if on_eof is not None:
+        on_eof()
+    if feeder is not None:
+        feeder.join()
+
+    # wait4 rather than wait(): its rusage covers this child and the
+    # processes it reaped (the batch pool), not every child so far
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, usage.ru_maxrss / 1024.0
+
+
+def app_cmd(args):
+    return [sys.executable, args.app] + [a for a in args.app_args if a != "--"]
+
+
+def bench_cli(args, jobs):
+    latencies, answers, peak = {}, {}, 0.0
+    for job in jobs:
+        cmd = app_cmd(args) + [
+            "-i", job["input"],
+            "-o", job["output"],
+            "-t", job["test_id"],
+            "-s", job["student_id"],
+            "-n", str(job["n"]),
+        ]  # fmt: skip
+        started = time.perf_counter()
+        code, rss = run_child(cmd)
+        latencies[job["id"]] = time.perf_counter() - started
+        peak = max(peak, rss)
+        if code == 0:
+            output_json = os.path.join(
+                job["output"], f"{job['test_id']}-{job['student_id']}.json"
+            )
+            with open(output_json) as f:
+                answers[job["id"]] = json.load(f)
+    return latencies, answers, peak
+
+
+def bench_batch(args, jobs):
+    manifest = os.path.join(jobs[0]["output"], "bench-batch.jsonl")
+    with open(manifest, "w") as f:
+        f.writelines(job_line(job) for job in jobs)
+
+    latencies, answers = {}, {}
+
+    def on_line(line):
+        result = json.loads(line)
+        if result.get("ok"):
+            latencies[result["id"]] = result["timings"]["total_ms"] / 1000.0
+            answers[result["id"]] = result["answers"]
+
+    _, peak = run_child(app_cmd(args) + ["--batch", manifest], on_line=on_line)
+    return latencies, answers, peak
+
+
+def bench_worker(args, jobs):
+    latencies, answers = {}, {}
+    replies = threading.Semaphore(0)
+    closed = threading.Event()
+    sent = {}
+
+    def requests():
+        # One job in flight at a time, like an interactive caller
+        for job in jobs:
+            sent[job["id"]] = time.perf_counter()
+            yield job_line(job)
+            replies.acquire()
+            if closed.is_set():
+                return
+
+    def on_eof():
+        # The worker is gone (finished or crashed): wake the feeder
+        closed.set()
+        replies.release()
+
+    def on_line(line):
+        result = json.loads(line)
+        latencies[result["id"]] = time.perf_counter() - sent[result["id"]]
+        if result.get("ok"):
+            answers[result["id"]] = result["answers"]
+        replies.release()
+
+    _, peak = run_child(app_cmd(args) + ["--worker"], requests(), on_line, on_eof)
+    return latencies, answers, peak
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def agreement(jobs, answers):
+    """Per-question agreement with the goldens; failed sheets count as misses."""
+    matched, total, mismatches = 0, 0, {}
+    for job in jobs:
+        golden = job["golden"]
+        if not golden:
+            continue
+        got = answers.get(job["id"], {})
+        for q, expected in golden.items():
+            total += 1
+            if got.get(q) == expected:
+                matched += 1
+            else:
+                name = os.path.basename(job["input"])
+                mismatches.setdefault(name, set()).add(int(q))
+    return matched, total, {k: sorted(v) for k, v in mismatches.items()}
+
+
+def run_mode(mode, args, jobs):
+    runner = {"cli": bench_cli, "batch": bench_batch, "worker": bench_worker}[mode]
+    started = time.perf_counter()
+    latencies, answers, peak = runner(args, jobs)
+    wall = time.perf_counter() - started
+
+    values = list(latencies.values())
+    matched, total, mismatches = agreement(jobs, answers)
+    return {
+        "mode": mode,
+        "sheets": len(jobs),
+        "ok": len(answers),
+        "wall_s": round(wall, 3),
+        "sheets_per_s": round(len(answers) / wall, 3) if wall else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 1),
+        "p95_ms": round(percentile(values, 95) * 1000, 1),
+        "peak_rss_mb": round(peak, 1),
+        "agreement": round(matched / total, 4) if total else None,
+        "questions_checked": total,
+        "mismatches": mismatches,
+    }
+
+
+def print_report(report):
+    header = f"{'mode':<8}{'ok':>8}{'sheets/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'RSS MB':>9}{'agree':>9}"
+    print(header)
+    print("-" * len(header))
+    for row in report:
+        agree = (
+            f"{row['agreement'] * 100:.1f}%" if row["agreement"] is not None else "n/a"
+        )
+        print(
+            f"{row['mode']:<8}{row['ok']:>4}/{row['sheets']:<3}{row['sheets_per_s']:>10.2f}"
+            f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['peak_rss_mb']:>9.1f}{agree:>9}"
+        )
+    for row in report:
+        for name, questions in row["mismatches"].items():
+            print(
+                f"{row['mode']}: {name} disagrees on Q{', Q'.join(map(str, questions))}"
+            )
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        print(f"Unknown mode(s): {', '.join(unknown)}", file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        sheets = load_sheets(args.manifest)
+    except (OSError, ValueError) as e:
+        print(f"Cannot load sheets: {str(e)}", file=sys.stderr)
+        sys.exit(1)
+
+    output_root = tempfile.mkdtemp(prefix="grading-bench-")
+    report = []
+    try:
+        for mode in modes:
+            # Fresh output directory per style so results never leak across
+            output_dir = os.path.join(output_root, mode)
+            os.makedirs(output_dir)
+            jobs = build_jobs(sheets, max(1, args.repeat), args.n, output_dir)
+            report.append(run_mode(mode, args, jobs))
+    finally:
+        if args.keep:
+            print(f"Outputs kept in {output_root}", file=sys.stderr)
+        else:
+            shutil.rmtree(output_root, ignore_errors=True)
+
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
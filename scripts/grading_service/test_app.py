@@ -0,0 +1,90 @@
+"""Grading core entry points: the --worker loop, batch manifests, grade_sheet()."""
+
+import io
+import json
+import time
+
+import pytest
+
+import app
+
+
+def test_worker_answers_non_object_jobs_and_keeps_serving(monkeypatch, tmp_path):
+    lines = ["123", "[1]", "not json", '{"id": 7, "test_id": "T", "student_id": "1"}']
+    monkeypatch.setattr(app.sys, "stdin", io.StringIO("\n".join(lines) + "\n"))
+    out = io.StringIO()
+    monkeypatch.setattr(app.sys, "stdout", out)
+
+    app.run_worker(default_output_dir=str(tmp_path))
+
+    responses = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [response["ok"] for response in responses] == [False] * 4
+    assert responses[0]["error"] == responses[1]["error"] == "Job is not a JSON object"
+    assert responses[0]["retryable"] is False
+    assert responses[2]["error"].startswith("Invalid job")
+    assert responses[3]["id"] == 7
+
+
+def test_stage_timings_do_not_overlap(monkeypatch):
+    def fake_import(ms):
+        time.sleep(ms / 1000.0)
+        monkeypatch.setattr(app, "IMPORT_MS", app.IMPORT_MS + ms)
+
+    timer = app.StageTimer()
+    with timer.stage("detect"):
+        fake_import(60)
+        time.sleep(0.02)
+        with timer.stage("preprocess"):
+            fake_import(60)
+            time.sleep(0.02)
+    timings = timer.as_dict()
+
+    stages = timings["stages_ms"]
+    assert stages["import"] == 120
+    assert 20 <= stages["detect"] < 50 and 20 <= stages["preprocess"] < 50
+    assert sum(stages.values()) <= timings["total_ms"]
+
+
+@pytest.mark.parametrize(
+    "manifest", ['[{"input": "a.jpg"}, 5]', '{"input": "a.jpg"}\n[1]\n']
+)
+def test_manifest_entries_must_be_objects(tmp_path, manifest):
+    path = tmp_path / "batch.json"
+    path.write_text(manifest)
+    with pytest.raises(app.GradingError, match="Manifest entry 2 is not an object"):
+        app.load_batch_jobs(str(path), test_id="T")
+
+
+def test_failed_redetect_keeps_the_fast_result(monkeypatch, tmp_path):
+    np = app.load_module("numpy")
+    page = np.full((1400, 1000, 3), 255, dtype=np.uint8)
+    boxes = {
+        q: {"rect": (100, 100 + 60 * q, 400, 50), "detected": True} for q in range(1, 6)
+    }
+    # An undetected box sends the sheet on to the full search
+    boxes[5]["detected"] = False
+    searches = []
+
+    def find_answer_boxes(src_bgr, *args):
+        searches.append(args[6])
+        if len(searches) > 1:
+            raise app.GradingError("No answer boxes detected")
+        rects = [box["rect"] for box in boxes.values()]
+        return boxes, rects, rects, 2, src_bgr, "original", "fast"
+
+    monkeypatch.setattr(app, "find_answer_boxes", find_answer_boxes)
+    result = app.grade_sheet(
+        "sheet.png",
+        str(tmp_path),
+        "T",
+        "1",
+        5,
+        image=page,
+        normalize=False,
+        render=False,
+        min_confidence=0.99,
+    )
+    # The full search ran and failed; the fast path's answers stand
+    assert searches == ["boxdetect", "boxdetect"]
+    assert result["tier"] == "fast"
+    assert result["preset"] == "fast"
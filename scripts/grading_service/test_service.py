@@ -0,0 +1,234 @@
+"""HTTP grading service: admission, priorities, dispatch, history and routing."""
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import service
+
+
+def sheet(student_id, **extra):
+    return {
+        "input": f"/scans/{student_id}.jpg",
+        "test_id": "T",
+        "student_id": student_id,
+        **extra,
+    }
+
+
+@pytest.fixture
+def graded(monkeypatch):
+    """Replace the grading processes with threads running a recording stub."""
+    calls = []
+
+    def fake_job(job, output_dir, n, options, data=None):
+        calls.append(job["student_id"])
+        return {
+            "id": job["id"],
+            "ok": True,
+            "answers": {"1": "A"},
+            **job.get("extra", {}),
+        }
+
+    monkeypatch.setattr(service, "run_pool_job", fake_job)
+    monkeypatch.setattr(
+        service, "grading_pool", lambda workers: ThreadPoolExecutor(workers)
+    )
+    return calls
+
+
+def new_service(workers=1, queue_size=10):
+    svc = service.new_service(workers, queue_size, output_dir="/out")
+    svc["pool"] = service.grading_pool(workers)
+    return svc
+
+
+async def settle(svc, records):
+    """Run one dispatcher until every record has finished."""
+    dispatcher = asyncio.create_task(service._dispatch(svc))
+    try:
+        for record in records:
+            while record["state"] in ("queued", "running"):
+                await asyncio.sleep(0.01)
+    finally:
+        dispatcher.cancel()
+        svc["pool"].shutdown()
+
+
+async def request(svc, method, target, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b""
+    headers = {"content-type": "application/json"}
+    try:
+        return await service._service_route(svc, method, target, headers, body)
+    except service.ServiceError as e:
+        return e.status, {"ok": False, "error": str(e)}
+
+
+def test_admit_keeps_room_for_interactive():
+    svc = service.new_service(1, 3)
+    for i in range(3):
+        service.enqueue(svc, sheet(str(i)), "batch")
+    assert not service.admit(svc, "batch", 1)
+    assert service.admit(svc, "interactive", 3)
+    for i in range(3):
+        service.enqueue(svc, sheet(f"i{i}"), "interactive")
+    assert not service.admit(svc, "interactive", 1)
+
+
+def test_interactive_jobs_go_first(graded):
+    async def run():
+        svc = new_service()
+        records = [service.enqueue(svc, sheet(s), "batch") for s in ("b1", "b2")]
+        records.append(service.enqueue(svc, sheet("i1"), "interactive"))
+        records.append(service.enqueue(svc, sheet("b3"), "batch"))
+        await settle(svc, records)
+        return records
+
+    records = asyncio.run(run())
+    assert graded == ["i1", "b1", "b2", "b3"]
+    assert all(record["state"] == "done" for record in records)
+
+
+def test_full_queue_answers_429(graded):
+    async def run():
+        svc = new_service(queue_size=2)
+        status, _ = await request(
+            svc, "POST", "/batches", {"jobs": [sheet("1"), sheet("2")]}
+        )
+        assert status == 202
+        status, payload = await request(svc, "POST", "/batches", {"jobs": [sheet("3")]})
+        assert status == 429
+        # Interactive regrades are still admitted past a full batch queue
+        status, record = await request(svc, "POST", "/grade", sheet("4"))
+        assert (status, record["priority"]) == (202, "interactive")
+        svc["pool"].shutdown()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "method, target, payload, status",
+    [
+        ("POST", "/grade", {"input": "/scans/1.jpg", "test_id": "T"}, 400),
+        ("POST", "/grade", sheet("1", priority="urgent"), 400),
+        ("POST", "/batches", {"jobs": []}, 400),
+        ("GET", "/jobs/nope", None, 404),
+        ("GET", "/batches/nope", None, 404),
+        ("DELETE", "/grade", None, 405),
+        ("GET", "/nowhere", None, 404),
+    ],
+)
+def test_bad_requests(method, target, payload, status):
+    svc = service.new_service(1, 10)
+    assert asyncio.run(request(svc, method, target, payload))[0] == status
+
+
+def test_broken_pool_fails_the_job_and_is_replaced(monkeypatch, graded):
+    def dying_job(job, output_dir, n, options, data=None):
+        raise BrokenProcessPool("worker killed")
+
+    monkeypatch.setattr(service, "run_pool_job", dying_job)
+
+    async def run():
+        svc = new_service()
+        broken = svc["pool"]
+        record = service.enqueue(svc, sheet("1"), "interactive")
+        await settle(svc, [record])
+        return svc, broken, record
+
+    svc, broken, record = asyncio.run(run())
+    assert record["state"] == "failed"
+    assert record["result"]["error"] == "Grading process died"
+    assert svc["pool"] is not broken
+
+
+def test_wait_returns_the_result_and_the_image_once(graded):
+    async def run():
+        svc = new_service()
+        dispatcher = asyncio.create_task(service._dispatch(svc))
+        status, record = await request(
+            svc, "POST", "/grade?wait=1", sheet("1", extra={"image_b64": "x" * 100})
+        )
+        assert (status, record["state"]) == (200, "done")
+        assert record["result"]["image_b64"] == "x" * 100
+        status, again = await request(svc, "GET", f"/jobs/{record['id']}")
+        assert status == 200 and "image_b64" not in again["result"]
+        assert svc["retained_bytes"] == len(service.dump_result(again["result"]))
+        dispatcher.cancel()
+        svc["pool"].shutdown()
+
+    asyncio.run(run())
+
+
+def test_history_evicts_oldest_jobs_and_empty_batches(graded):
+    async def run():
+        svc = new_service()
+        _, first = await request(
+            svc, "POST", "/batches", {"jobs": [sheet("1"), sheet("2")]}
+        )
+        _, second = await request(svc, "POST", "/batches", {"jobs": [sheet("3")]})
+        await settle(svc, list(svc["jobs"].values()))
+        return svc, first, second
+
+    svc, first, second = asyncio.run(run())
+    assert set(svc["batches"]) == {first["id"], second["id"]}
+
+    service.evict_history(svc, max_jobs=2)
+    assert len(svc["jobs"]) == 2
+    status, view = asyncio.run(request(svc, "GET", f"/batches/{first['id']}"))
+    assert (status, view["expired"], view["done"]) == (200, 1, 1)
+
+    service.evict_history(svc, max_jobs=1)
+    assert list(svc["jobs"]) == [second["jobs"][0]["id"]]
+    assert set(svc["batches"]) == {second["id"]}
+
+    service.evict_history(svc, max_mb=0)
+    assert svc["jobs"] == {} and svc["batches"] == {}
+    assert svc["retained_bytes"] == 0
+
+
+def test_http_round_trip(graded):
+    async def run():
+        svc = new_service()
+        dispatcher = asyncio.create_task(service._dispatch(svc))
+        server = await asyncio.start_server(
+            lambda reader, writer: service._handle_connection(svc, reader, writer),
+            "127.0.0.1",
+            0,
+        )
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        responses = []
+        for target, payload in (("/grade?wait=1", sheet("1")), ("/health", None)):
+            body = json.dumps(payload).encode() if payload else b""
+            method = "POST" if payload else "GET"
+            writer.write(
+                f"{method} {target} HTTP/1.1\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            headers = {}
+            while (line := await reader.readline()) != b"\r\n":
+                name, _, value = line.decode().partition(":")
+                headers[name.lower()] = value.strip()
+            payload = json.loads(
+                await reader.readexactly(int(headers["content-length"]))
+            )
+            responses.append((status, payload))
+        writer.close()
+        server.close()
+        dispatcher.cancel()
+        svc["pool"].shutdown()
+        return responses
+
+    (status, record), (health_status, health) = asyncio.run(run())
+    assert (status, record["state"], record["result"]["answers"]) == (
+        200,
+        "done",
+        {"1": "A"},
+    )
+    assert (health_status, health["running"]) == (200, 0)